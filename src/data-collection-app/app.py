@@ -1,10 +1,53 @@
 from flask import Flask, render_template, request, jsonify
-import boto3
-from botocore.exceptions import NoCredentialsError
 import base64
 import os
+import re
+import threading
+from scripts.ingest import get_backend, ShardWriter, PNG_SIGNATURE
 
 app = Flask(__name__)
+# Shared storage backend and shard writer, drawings are buffered and uploaded as tar shards
+storage = get_backend()
+shard_writer = None
+shard_writer_lock = threading.Lock()
+MAX_DRAWINGS_PER_REQUEST = 500
+MAX_DRAWING_BYTES = 256 * 1024
+
+
+def get_shard_writer():
+    """
+    Create the shard writer on first use, so only the process serving requests owns the spool,
+    not e.g. the parent process of the debug reloader.
+    """
+    global shard_writer
+    with shard_writer_lock:
+        if shard_writer is None:
+            shard_writer = ShardWriter(storage,
+                                       spool_dir=os.environ.get('SHARD_SPOOL_DIR', 'shard_spool'),
+                                       max_drawings=int(os.environ.get('SHARD_MAX_DRAWINGS', 256)),
+                                       max_age_seconds=float(os.environ.get('SHARD_MAX_AGE', 30)))
+        return shard_writer
+
+
+def decode_drawing(image):
+    """
+    Decode a base64 PNG, optionally as a data URL, raising ValueError when it is not a PNG.
+    """
+    if not isinstance(image, str):
+        raise ValueError("Expected a base64 encoded image")
+    if image.startswith('data:'):
+        image = image.split(',', 1)[1]
+    data = base64.b64decode(image, validate=True)
+    if not data.startswith(PNG_SIGNATURE) or len(data) > MAX_DRAWING_BYTES:
+        raise ValueError("Expected a PNG image")
+    return data
+
+
+def check_subject(subject):
+    if not isinstance(subject, str) or not re.fullmatch(r'[A-Za-z][A-Za-z_\-]{0,63}', subject):
+        raise ValueError(f"Invalid sketch subject {subject!r}")
+    return subject
+
 
 @app.route('/')
 def index():
@@ -12,19 +55,41 @@ def index():
 
 @app.route('/save', methods=['POST'])
 def save():
-    img_data = request.form['imgData']
-    img_data = base64.b64decode(img_data.split(',')[1])
-    
-    # Specify the path to save the image
-    img_path = 'saved_images/drawing.png'
-    
-    # Ensure directory exists
-    os.makedirs(os.path.dirname(img_path), exist_ok=True)
-    
-    with open(img_path, 'wb') as f:
-        f.write(img_data)
-    
-    return 'Drawing saved successfully', 200
+    try:
+        img_data = decode_drawing(request.form['imgData'])
+        subject = check_subject(request.form.get('sketchsubject', 'Unknown'))
+    except (KeyError, ValueError) as e:
+        return f'Invalid drawing: {e}', 400
+
+    # Spool the drawing under a unique name, it is uploaded with the next shard
+    try:
+        name = get_shard_writer().add(subject, img_data)
+    except OSError as e:
+        return f'Could not store the drawing: {e}', 503
+
+    return jsonify({'name': name}), 200
+
+
+@app.route('/upload_batch', methods=['POST'])
+def upload_batch():
+    # Many drawings per request: {"drawings": [{"sketchsubject": "Car", "image": "<base64 PNG>"}, ...]}
+    drawings = (request.get_json(silent=True) or {}).get('drawings')
+    if not isinstance(drawings, list) or not 0 < len(drawings) <= MAX_DRAWINGS_PER_REQUEST:
+        return jsonify({'error': f'Expected 1 to {MAX_DRAWINGS_PER_REQUEST} drawings'}), 400
+    try:
+        decoded = [(check_subject(drawing['sketchsubject']), decode_drawing(drawing['image'])) for drawing in drawings]
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'error': f'Invalid drawing: {e}'}), 400
+    try:
+        names = get_shard_writer().add_many(decoded)
+    except OSError as e:
+        return jsonify({'error': f'Could not store the drawings: {e}'}), 503
+    return jsonify({'saved': len(names), 'names': names}), 202
+
+
+@app.route('/upload_stats', methods=['GET'])
+def upload_stats():
+    return jsonify(get_shard_writer().stats())
 
 
 @app.route('/generate-presigned-url', methods=['POST'])
@@ -34,14 +99,12 @@ def generate_presigned_url():
     filename = data.get('filename')
     subject = data.get('sketchsubject')
     
+    from botocore.exceptions import NoCredentialsError
     try:
-        s3_client = boto3.client('s3')
-        presigned_url = s3_client.generate_presigned_url('put_object',
-                                                         Params={'Bucket': 'ai-pictionary-data',
-                                                                 'Key': f"{subject}/{filename}",
-                                                                 'ContentType': 'image/png'},
-                                                         ExpiresIn=3600)
+        presigned_url = storage.presigned_put_url(f"{subject}/{filename}", 'image/png')
         return jsonify({'url': presigned_url})
+    except NotImplementedError as e:
+        return jsonify({'error': str(e)}), 501
     except NoCredentialsError:
         return jsonify({'error': 'Credentials not available'}), 403
 
@@ -50,4 +113,4 @@ if __name__ == '__main__':
 
 # Things to add:
     # unkown class
-    # "helpful tips": "Hint: The object of the game is to score as many points as possible." "Hint: Make your drawings better." 
\ No newline at end of file
+    # "helpful tips": "Hint: The object of the game is to score as many points as possible." "Hint: Make your drawings better."
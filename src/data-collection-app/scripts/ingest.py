@@ -0,0 +1,355 @@
+import io
+import os
+import time
+import fcntl
+import queue
+import atexit
+import secrets
+import tarfile
+import threading
+from functools import lru_cache
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+@lru_cache(maxsize=None)
+def get_s3_client(endpoint_url=None, max_pool_connections=32):
+    """
+    Get the shared S3 client. boto3 clients are thread-safe, so one client and its connection pool
+    are reused by every request instead of creating a client per request.
+
+    Args:
+        endpoint_url: Optional S3-compatible endpoint, e.g. a local MinIO server for testing
+        max_pool_connections: The maximum number of pooled HTTP connections
+
+    Returns:
+        s3_client: boto3 S3 client
+    """
+    # boto3 is slow to import, so it is only imported when S3 is used
+    import boto3
+    from botocore.config import Config
+    return boto3.client('s3', endpoint_url=endpoint_url, config=Config(max_pool_connections=max_pool_connections))
+
+
+class S3Backend:
+    """
+    Stores objects in an S3 bucket, or a bucket of an S3-compatible server such as MinIO.
+    """
+    def __init__(self, bucket, endpoint_url=None):
+        """
+        Args:
+            bucket: The bucket name
+            endpoint_url: Optional S3-compatible endpoint, defaults to AWS
+        """
+        self.bucket = bucket
+        self.endpoint_url = endpoint_url
+
+    @property
+    def client(self):
+        return get_s3_client(self.endpoint_url)
+
+    def put(self, key, data, content_type) -> None:
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data, ContentType=content_type)
+
+    def presigned_put_url(self, key, content_type, expires_in=3600) -> str:
+        return self.client.generate_presigned_url('put_object',
+                                                  Params={'Bucket': self.bucket, 'Key': key, 'ContentType': content_type},
+                                                  ExpiresIn=expires_in)
+
+
+class LocalBackend:
+    """
+    Stores objects as files under a directory, a stand-in for S3 in tests and local development.
+    """
+    def __init__(self, root_dir):
+        """
+        Args:
+            root_dir: The directory the object keys are relative to
+        """
+        self.root_dir = root_dir
+
+    def put(self, key, data, content_type) -> None:
+        path = os.path.join(self.root_dir, *key.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so readers never see a partial object
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, 'wb') as f:
+            f.write(data)
+        os.replace(temporary_path, path)
+
+    def presigned_put_url(self, key, content_type, expires_in=3600) -> str:
+        raise NotImplementedError("The local backend does not support presigned URLs, use the bulk upload instead")
+
+
+def get_backend():
+    """
+    Create the storage backend configured by the STORAGE_BACKEND ("s3", the default, or "local"), S3_BUCKET,
+    S3_ENDPOINT_URL and LOCAL_STORAGE_DIR environment variables. The S3 backend raises RuntimeError
+    when no AWS credentials are configured, instead of failing every upload later.
+    """
+    backend = os.environ.get('STORAGE_BACKEND', 's3')
+    if backend == 'local':
+        return LocalBackend(os.environ.get('LOCAL_STORAGE_DIR', 'saved_images'))
+    if backend != 's3':
+        raise ValueError(f"Unknown storage backend {backend!r}, expected 's3' or 'local'")
+    import boto3
+    if boto3.Session().get_credentials() is None:
+        raise RuntimeError("The S3 storage backend needs AWS credentials, configure them or set STORAGE_BACKEND=local")
+    return S3Backend(os.environ.get('S3_BUCKET', 'ai-pictionary-data'), os.environ.get('S3_ENDPOINT_URL'))
+
+
+def unique_drawing_name(subject) -> str:
+    """
+    A unique object name for a drawing, e.g. "Car_1712345678901234567_9f2c4a1b.png".
+    """
+    return f"{subject}_{time.time_ns()}_{secrets.token_hex(4)}.png"
+
+
+class ShardWriter:
+    """
+    Buffers drawings and uploads them in batches, packed into uncompressed tar shards of
+    "<subject>/<name>.png" members, so thousands of drawings cost a few uploads instead of one request each.
+
+    Drawings are appended to the current shard file in spool_dir and synced to disk before add returns,
+    so an accepted drawing survives a restart or an unavailable backend. A shard is closed and uploaded
+    in the background once it holds max_drawings drawings or max_bytes bytes, or max_age_seconds after its
+    first drawing was added, and deleted from the spool once uploaded. Failed uploads stay in the spool
+    and are retried with exponential backoff, also after a restart. Only one writer may use a spool directory,
+    which is enforced with a lock file.
+    """
+    def __init__(self, backend, spool_dir="shard_spool", prefix="shards", max_drawings=256, max_bytes=8 * 2**20,
+                 max_age_seconds=30.0, num_uploaders=2, max_retry_delay=300.0):
+        """
+        Args:
+            backend: The storage backend, S3Backend or LocalBackend
+            spool_dir: The local directory holding the shards until they are uploaded
+            prefix: The key prefix of the shards
+            max_drawings: The maximum number of drawings in a shard
+            max_bytes: The maximum total size of the drawings in a shard
+            max_age_seconds: The maximum time a drawing is buffered before its shard is uploaded
+            num_uploaders: The number of shards uploaded at the same time
+            max_retry_delay: The maximum number of seconds between two upload attempts of a failed shard
+        """
+        self.backend = backend
+        self.spool_dir = spool_dir
+        self.prefix = prefix
+        self.max_drawings = max_drawings
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.max_retry_delay = max_retry_delay
+        self._lock = threading.Lock()
+        self._shard = None
+        self._drawings = 0
+        self._size = 0
+        self._first_added = None
+        # Closed shards waiting for an upload, and failed ones waiting for their next attempt: path -> (attempts, next attempt)
+        self._ready = queue.Queue()
+        self._retries = {}
+        self._spooled = {}
+        self._uploaded_shards = 0
+        self._uploaded_drawings = 0
+        self._failed_uploads = 0
+        self._closed = False
+        os.makedirs(spool_dir, exist_ok=True)
+        # Held until the writer is closed, a second writer would upload and repack the same shards
+        self._spool_lock = open(os.path.join(spool_dir, ".lock"), 'w')
+        try:
+            fcntl.flock(self._spool_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._spool_lock.close()
+            raise RuntimeError(f"The spool directory {spool_dir} is used by another shard writer") from None
+        self._recover()
+        # The writer owns its threads, so the final flush does not depend on an executor that may already be shut down at exit
+        self._uploaders = [threading.Thread(target=self._upload_ready, daemon=True, name=f"shard-upload-{i}")
+                           for i in range(num_uploaders)]
+        self._timer = threading.Thread(target=self._maintain, daemon=True, name="shard-timer")
+        for thread in [*self._uploaders, self._timer]:
+            thread.start()
+        atexit.register(self.close)
+
+    def add(self, subject, data) -> str:
+        """
+        Store one drawing for upload.
+
+        Args:
+            subject: The class of the drawing, used as its folder in the shard
+            data: The PNG bytes of the drawing
+
+        Returns:
+            name: The unique name of the drawing in the shard
+        """
+        return self.add_many([(subject, data)])[0]
+
+    def add_many(self, drawings) -> list:
+        """
+        Store drawings for upload, synced to the spool before returning.
+
+        Args:
+            drawings: List of (subject, PNG bytes) pairs
+
+        Returns:
+            names: The unique name of each drawing in the shards
+        """
+        names = []
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("The shard writer is closed")
+            for subject, data in drawings:
+                name = unique_drawing_name(subject)
+                self._append_locked(f"{subject}/{name}", data)
+                names.append(name)
+            if self._shard is not None:
+                self._shard[1].flush()
+                os.fsync(self._shard[1].fileno())
+        return names
+
+    def flush(self) -> None:
+        """
+        Upload the buffered drawings now.
+        """
+        with self._lock:
+            self._close_shard_locked()
+
+    def close(self) -> None:
+        """
+        Upload the buffered drawings and wait for the uploads to finish. Shards whose upload fails stay in the
+        spool, and are uploaded by the next writer using it.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._close_shard_locked()
+            self._closed = True
+        for _ in self._uploaders:
+            self._ready.put(None)
+        for thread in self._uploaders:
+            thread.join()
+        self._spool_lock.close()
+        if self._retries:
+            print(f"{len(self._retries)} shards could not be uploaded and are kept in {self.spool_dir}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'buffered_drawings': self._drawings, 'buffered_bytes': self._size,
+                    'uploaded_shards': self._uploaded_shards, 'uploaded_drawings': self._uploaded_drawings,
+                    'spooled_shards': len(self._spooled), 'spooled_drawings': sum(self._spooled.values()),
+                    'failed_uploads': self._failed_uploads}
+
+    def _append_locked(self, member_name, data) -> None:
+        if self._shard is None:
+            filename = f"{time.strftime('%Y%m%d-%H%M%S')}_{secrets.token_hex(4)}.tar"
+            # Shards being written have a .part suffix, so a restart can tell them from closed shards
+            fileobj = open(os.path.join(self.spool_dir, f"{filename}.part"), 'wb')
+            self._shard = (filename, fileobj, tarfile.open(fileobj=fileobj, mode='w'))
+            self._first_added = time.monotonic()
+        info = tarfile.TarInfo(member_name)
+        info.size = len(data)
+        info.mtime = time.time()
+        self._shard[2].addfile(info, io.BytesIO(data))
+        self._drawings += 1
+        self._size += len(data)
+        if self._drawings >= self.max_drawings or self._size >= self.max_bytes:
+            self._close_shard_locked()
+
+    def _close_shard_locked(self) -> None:
+        if self._shard is None:
+            return
+        filename, fileobj, archive = self._shard
+        archive.close()
+        fileobj.flush()
+        os.fsync(fileobj.fileno())
+        fileobj.close()
+        path = os.path.join(self.spool_dir, filename)
+        os.replace(f"{path}.part", path)
+        self._spooled[path] = self._drawings
+        self._shard, self._drawings, self._size = None, 0, 0
+        self._ready.put(path)
+
+    def _upload_ready(self) -> None:
+        while True:
+            path = self._ready.get()
+            if path is None:
+                return
+            self._upload(path)
+
+    def _upload(self, path) -> None:
+        key = f"{self.prefix}/{os.path.basename(path)}"
+        try:
+            with open(path, 'rb') as f:
+                self.backend.put(key, f.read(), 'application/x-tar')
+        except FileNotFoundError:
+            # Already uploaded and removed, e.g. queued by both a retry and a restart
+            with self._lock:
+                self._forget_locked(path)
+            return
+        except Exception as e:
+            with self._lock:
+                self._failed_uploads += 1
+                attempts = self._retries.get(path, (0, 0))[0] + 1
+                delay = min(2 ** attempts, self.max_retry_delay)
+                self._retries[path] = (attempts, time.monotonic() + delay)
+            print(f"Failed to upload shard {key} (attempt {attempts}, retrying in {delay:.0f}s): {e!r}")
+            return
+        try:
+            os.remove(path)
+        except OSError as e:
+            print(f"Could not remove the uploaded shard {path}: {e!r}")
+        with self._lock:
+            self._uploaded_shards += 1
+            self._uploaded_drawings += self._spooled.get(path, 0)
+            self._forget_locked(path)
+
+    def _forget_locked(self, path) -> None:
+        self._retries.pop(path, None)
+        self._spooled.pop(path, None)
+
+    def _maintain(self) -> None:
+        while True:
+            time.sleep(min(1.0, self.max_age_seconds))
+            with self._lock:
+                if self._closed:
+                    return
+                if self._shard is not None and time.monotonic() - self._first_added >= self.max_age_seconds:
+                    self._close_shard_locked()
+                now = time.monotonic()
+                for path, (attempts, next_attempt) in self._retries.items():
+                    if next_attempt <= now:
+                        self._retries[path] = (attempts, float("inf"))
+                        self._ready.put(path)
+
+    def _recover(self) -> None:
+        """
+        Queue the shards left in the spool by a previous run, and repack the drawings of shards it was
+        still writing, keeping every complete drawing of a shard cut short by a crash.
+        """
+        for filename in sorted(os.listdir(self.spool_dir)):
+            path = os.path.join(self.spool_dir, filename)
+            if filename.endswith(".tar"):
+                self._spooled[path] = count_shard_drawings(path)
+                self._ready.put(path)
+            elif filename.endswith(".tar.part"):
+                for member_name, data in read_shard_drawings(path):
+                    self._append_locked(member_name, data)
+                os.remove(path)
+        self._close_shard_locked()
+
+
+def read_shard_drawings(path) -> list:
+    """
+    Read the (member name, PNG bytes) pairs of a shard, stopping at the first incomplete member.
+    """
+    drawings = []
+    try:
+        with tarfile.open(path, 'r:') as archive:
+            for member in archive:
+                data = archive.extractfile(member).read()
+                if len(data) != member.size:
+                    break
+                drawings.append((member.name, data))
+    except (tarfile.TarError, OSError, EOFError):
+        pass
+    return drawings
+
+
+def count_shard_drawings(path) -> int:
+    return len(read_shard_drawings(path))
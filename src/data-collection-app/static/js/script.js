@@ -9,6 +9,8 @@ document.addEventListener('DOMContentLoaded', () => {
     shuffleArray(sketchSubjects);
     let currentSubjectIndex = 0;
     let saveCount = 0;
+    let pendingDrawings = []; // Drawings waiting to be uploaded
+    const uploadBatchSize = 5; // Upload the drawings of each subject together
     let totalSaveCount = 0;
     const gridSize = 128;
     let currentColor = '#000000'; // Default color
@@ -253,45 +255,53 @@ document.addEventListener('DOMContentLoaded', () => {
             }
         }
     
-        canvas.toBlob(async (blob) => {
-            // Get the current sketch subject and generate a unique filename
-            const sketchSubject = sketchSubjects[immediateSubjectIndex];
-            const uniqueSequence = Date.now(); 
-            const fileName = `${sketchSubject}_${uniqueSequence}.png`;
-    
-            try {
-                // Fetch the presigned URL from your server, including the dynamic filename in the request
-                const response = await fetch('/generate-presigned-url', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json'
-                    },
-                    body: JSON.stringify({ filename: fileName,
-                                           sketchsubject: sketchSubject})
-                });
-                const data = await response.json();
-    
-                // Use the presigned URL to upload the image
-                const uploadResponse = await fetch(data.url, {
-                    method: 'PUT',
-                    headers: {
-                        'Content-Type': 'image/png'
-                    },
-                    body: blob
-                });
-    
-                if (uploadResponse.ok) {
-                    console.log('Upload successful');
-                } else {
-                    console.log(uploadResponse)
-                    console.error('Upload failed');
-                }
-            } catch (error) {
-                console.error('Error generating presigned URL or uploading:', error);
+        // Queue the drawing, drawings are sent to the server in batches
+        pendingDrawings.push({
+            sketchsubject: sketchSubjects[immediateSubjectIndex],
+            image: canvas.toDataURL('image/png')
+        });
+        if (pendingDrawings.length >= uploadBatchSize) {
+            await uploadPendingDrawings();
+        }
+    }
+
+
+    // Send the queued drawings in one request, they are kept queued if the upload fails
+    async function uploadPendingDrawings() {
+        if (pendingDrawings.length === 0) {
+            return;
+        }
+        const drawings = pendingDrawings;
+        pendingDrawings = [];
+        try {
+            const response = await fetch('/upload_batch', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify({ drawings: drawings })
+            });
+            if (response.ok) {
+                console.log('Upload successful');
+            } else {
+                console.error('Upload failed');
+                pendingDrawings = drawings.concat(pendingDrawings);
             }
-        }, 'image/png');
+        } catch (error) {
+            console.error('Error uploading drawings:', error);
+            pendingDrawings = drawings.concat(pendingDrawings);
+        }
     }
 
+    // Send any remaining drawings when the page is closed
+    window.addEventListener('pagehide', () => {
+        if (pendingDrawings.length > 0) {
+            const body = new Blob([JSON.stringify({ drawings: pendingDrawings })], { type: 'application/json' });
+            navigator.sendBeacon('/upload_batch', body);
+            pendingDrawings = [];
+        }
+    });
+
 
         
     resetBtn.addEventListener('click', clearCanvas);
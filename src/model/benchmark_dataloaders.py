@@ -0,0 +1,50 @@
+import os
+import time
+from torch.utils.data import DataLoader
+from data_processing import get_dataloaders
+
+
+def benchmark_dataloader(loader: DataLoader, epochs: int = 2) -> float:
+    """
+    Measure how many images per second a dataloader produces.
+    The first epoch is not timed so worker startup and cache building are excluded.
+
+    Args:
+    - loader: The dataloader to benchmark.
+    - epochs: The number of epochs to time.
+
+    Returns:
+    - images_per_second: The number of images (including augmented views) produced per second.
+    """
+    for _ in loader:
+        pass
+    num_images = 0
+    start = time.perf_counter()
+    for _ in range(epochs):
+        for images, _ in loader:
+            num_images += len(images)
+    return num_images / (time.perf_counter() - start)
+
+
+def main(data_root_dir: str = "../../data/", cache_dir: str = "../../cache/"):
+    """
+    Report the training dataloader throughput for a range of loader settings on the bundled data.
+    """
+    num_cpus = os.cpu_count() or 1
+    settings = {
+        "baseline": {},
+        "decoded cache": {"cache_dir": cache_dir},
+        "batched augmentation": {"cache_dir": cache_dir, "batched_augmentation": True},
+        f"{num_cpus} workers": {"num_workers": num_cpus, "persistent_workers": True},
+        f"{num_cpus} workers, pinned, prefetch 4": {"num_workers": num_cpus, "persistent_workers": True,
+                                                     "pin_memory": True, "prefetch_factor": 4},
+        f"{num_cpus} workers, cache, batched augmentation": {"num_workers": num_cpus, "persistent_workers": True,
+                                                              "cache_dir": cache_dir, "batched_augmentation": True},
+    }
+    for name, kwargs in settings.items():
+        train_loader, val_loader, test_loader = get_dataloaders(data_root_dir, batch_size=32, **kwargs)
+        print(f"{name}: {benchmark_dataloader(train_loader):.1f} images/sec")
+
+
+if __name__ == "__main__":
+    main()
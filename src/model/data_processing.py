@@ -1,17 +1,79 @@
 import os
+import hashlib
+import numpy as np
 import torch
-from torch.utils.data import Dataset, DataLoader
+import torch.nn.functional as F
+from torch.utils.data import Dataset, DataLoader, get_worker_info
 from torchvision import transforms
 from PIL import Image
 from sklearn.model_selection import train_test_split
+from packed_dataset import PackedDataset
+
+
+class DecodedImageCache:
+    def __init__(self, image_paths, cache_dir):
+        """
+        Decoded uint8 RGB copies of a set of images, stored on disk as one memory-mapped array.
+        The cache file is keyed by the image paths and their modification times,
+        so it is rebuilt whenever an image is added, removed or changed.
+
+        Args:
+        - image_paths: The paths of the images to cache. All images must have the same size.
+        - cache_dir: The directory to store the cache file in.
+        """
+        self.index = {path: row for row, path in enumerate(image_paths)}
+        fingerprint = hashlib.sha1()
+        for path in image_paths:
+            fingerprint.update(f"{os.path.abspath(path)}:{os.stat(path).st_mtime_ns}\n".encode())
+        self.cache_path = os.path.join(cache_dir, f"decoded_images_{fingerprint.hexdigest()[:16]}.npy")
+        if not os.path.exists(self.cache_path):
+            os.makedirs(cache_dir, exist_ok=True)
+            self._build(image_paths)
+        # Opened lazily so the cache can be sent to dataloader worker processes
+        self._array = None
+
+    def _build(self, image_paths):
+        """
+        Decode every image once and write it into the cache file.
+        """
+        tmp_path = self.cache_path + ".tmp"
+        shape = np.asarray(Image.open(image_paths[0]).convert("RGB")).shape
+        array = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.uint8, shape=(len(image_paths), *shape))
+        for row, path in enumerate(image_paths):
+            image = np.asarray(Image.open(path).convert("RGB"))
+            if image.shape != shape:
+                raise ValueError(f"Cannot cache {path}: expected shape {shape}, got {image.shape}")
+            array[row] = image
+        array.flush()
+        del array
+        os.replace(tmp_path, self.cache_path)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, path):
+        return path in self.index
+
+    def __getitem__(self, path):
+        if self._array is None:
+            self._array = np.load(self.cache_path, mmap_mode="r")
+        return self._array[self.index[path]]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_array"] = None
+        return state
 
 
 class CustomImageFolderDataset(Dataset):
-    def __init__(self, image_paths, extra_transforms=True):
+    def __init__(self, image_paths, extra_transforms=True, image_cache=None, batched_augmentation=False, packed_dataset=None):
         """
         Custom dataset for loading images from a folder structure.
         Applies a base transform for train, val, and test sets.
         Applies extra transforms for training/val when specified.
+        Reads decoded images from image_cache instead of the PNG files when given.
+        With packed_dataset, image_paths are indices into the PackedDataset, whose shards the images are read from.
+        With batched_augmentation, returns the raw uint8 image and leaves all transforms to BatchAugmentCollate.
         """
         self.base_transform = transforms.Compose([
                             transforms.ToTensor(),
@@ -21,17 +83,37 @@ class CustomImageFolderDataset(Dataset):
                             ])
         self.images = image_paths
         self.extra_transforms = extra_transforms
+        self.image_cache = image_cache
+        self.batched_augmentation = batched_augmentation
+        self.packed_dataset = packed_dataset
         self.label_map = {"Airplane": 0, "Bicycle": 1, "Butterfly": 2, "Car": 3, "Flower": 4, "House": 5, "Ladybug": 6, "Train": 7, "Tree": 8, "Whale": 9}
 
     def __len__(self):
         return len(self.images)
 
-    def __getitem__(self, idx):
+    def _read(self, idx):
+        """
+        Read an image as a uint8 array of shape (H, W, 3), along with its label.
+        """
         img_path = self.images[idx]
-        image = Image.open(img_path).convert("RGB")
+        if self.packed_dataset is not None:
+            category = self.packed_dataset.classes[self.packed_dataset.labels[img_path]]
+            return self.packed_dataset.read_image(img_path), self.label_map[category]
+        # Assuming the folder names represent the labels, extract label from the file path
+        label = self.label_map[img_path.split(os.sep)[-2]]
+        if self.image_cache is not None:
+            return np.array(self.image_cache[img_path]), label
+        return np.array(Image.open(img_path).convert("RGB")), label
+
+    def __getitem__(self, idx):
+        image_array, label = self._read(idx)
+        if self.batched_augmentation:
+            image = torch.from_numpy(image_array).permute(2, 0, 1)
+            return image, label
         images = []
-        # Apply base transform
-        images.append(self.base_transform(image))
+        # Apply base transform straight to the decoded array
+        images.append(self.base_transform(image_array))
+        image = Image.fromarray(image_array) if self.extra_transforms else None
         # Horizontal flip
         if self.extra_transforms:
             images.append(self.base_transform(transforms.functional.hflip(image)))
@@ -43,9 +125,6 @@ class CustomImageFolderDataset(Dataset):
         if self.extra_transforms:
             translation_transform = transforms.RandomAffine(0, translate=(0.2, 0.2), scale=(0.6, 1.4), fill=(255, 255, 255))
             images.append(self.base_transform(translation_transform(image)))
-        # Assuming the folder names represent the labels, extract label from the file path
-        label = img_path.split(os.sep)[-2]
-        label = self.label_map[label]
         return images, label
     
 
@@ -75,30 +154,150 @@ def custom_collate_fn(batch):
     return images_tensor, labels_tensor
 
 
-def get_dataloaders(data_root_dir: str, batch_size: int = 8):
+def augment_batch(images, generator=None, max_rotation=30, max_translation=0.2, scale_range=(0.6, 1.4)):
+    """
+    Apply the training augmentations to a whole batch at once with affine grids.
+    Produces the same 4 views as CustomImageFolderDataset: original, horizontal flip,
+    random rotation and random translation/scaling, with white fill outside the image.
+
+    Args:
+    - images: A uint8 tensor of shape (N, 3, H, W). May live on any device.
+    - generator: Optional torch.Generator for the per-sample augmentation parameters.
+    - max_rotation: The maximum rotation in degrees.
+    - max_translation: The maximum translation as a fraction of the image size.
+    - scale_range: The (min, max) scaling factor.
+
+    Returns:
+    - views: A float tensor of shape (N, 4, 3, H, W) with values in [0, 1].
+    """
+    images = images.float() / 255
+    n, _, h, w = images.shape
+
+    def uniform(low, high):
+        return (low + (high - low) * torch.rand(n, generator=generator)).to(images.device)
+
+    zeros = torch.zeros(n, device=images.device)
+    # Inverse rotation, corrected for the aspect ratio of the normalized grid coordinates
+    angles = torch.deg2rad(uniform(-max_rotation, max_rotation))
+    cos, sin = angles.cos(), angles.sin()
+    rotation = torch.stack([torch.stack([cos, -sin * h / w, zeros], dim=1),
+                            torch.stack([sin * w / h, cos, zeros], dim=1)], dim=1)
+    # Inverse translation and scaling, translations are doubled since the grid spans [-1, 1]
+    scale = uniform(*scale_range)
+    tx = 2 * uniform(-max_translation, max_translation)
+    ty = 2 * uniform(-max_translation, max_translation)
+    translation = torch.stack([torch.stack([1 / scale, zeros, -tx / scale], dim=1),
+                               torch.stack([zeros, 1 / scale, -ty / scale], dim=1)], dim=1)
+    # Warp the inverted images so the zero padding outside the grid becomes a white fill
+    inverted = 1 - torch.cat([images, images])
+    grid = F.affine_grid(torch.cat([rotation, translation]), inverted.shape, align_corners=False)
+    warped = 1 - F.grid_sample(inverted, grid, mode="nearest", padding_mode="zeros", align_corners=False)
+    return torch.stack([images, images.flip(-1), warped[:n], warped[n:]], dim=1)
+
+
+class BatchAugmentCollate:
+    def __init__(self, extra_transforms=True, seed=None):
+        """
+        Collate function for datasets created with batched_augmentation=True.
+        Augments and normalizes the whole batch at once, and returns the same layout as custom_collate_fn.
+
+        Args:
+        - extra_transforms: Whether to add the augmented views or only return the original images.
+        - seed: Optional seed for the augmentation parameters. Each dataloader worker offsets it by its id.
+        """
+        self.extra_transforms = extra_transforms
+        self.seed = seed
+        self.normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+        self._generator = None
+
+    def _get_generator(self):
+        if self.seed is None:
+            return None
+        if self._generator is None:
+            worker_info = get_worker_info()
+            worker_id = worker_info.id if worker_info is not None else 0
+            self._generator = torch.Generator().manual_seed(self.seed + worker_id)
+        return self._generator
+
+    def __call__(self, batch):
+        images = torch.stack([image for image, _ in batch])
+        labels = torch.tensor([label for _, label in batch])
+        if self.extra_transforms:
+            views = augment_batch(images, generator=self._get_generator())
+        else:
+            views = (images.float() / 255).unsqueeze(1)
+        num_views = views.shape[1]
+        images_tensor = self.normalize(views.flatten(0, 1))
+        labels_tensor = labels.repeat_interleave(num_views)
+        return images_tensor, labels_tensor
+
+
+def get_dataloaders(data_root_dir: str,
+                    batch_size: int = 8,
+                    cache_dir: str = None,
+                    batched_augmentation: bool = False,
+                    seed: int = None,
+                    eval_batch_size: int = 1,
+                    num_workers: int = 0,
+                    pin_memory: bool = False,
+                    persistent_workers: bool = False,
+                    prefetch_factor: int = None,
+                    packed_dir: str = None,
+                    split_seed: int = None):
     """
     Get the dataloaders for the train, val, and test sets.
 
     Args:
     - data_root_dir: The root directory containing the image folders.
     - batch_size: The batch size to use for the dataloaders.
+    - cache_dir: Optional directory for a decoded image cache, so PNGs are only decoded once.
+    - batched_augmentation: Whether to augment whole batches at once instead of each image with PIL.
+    - seed: Optional seed for the batched augmentation parameters.
+    - eval_batch_size: The batch size to use for the validation and test dataloaders.
+    - num_workers: The number of worker processes loading batches in parallel.
+    - pin_memory: Whether to copy batches into pinned memory for faster transfer to the GPU.
+    - persistent_workers: Whether to keep the worker processes alive between epochs. Requires num_workers > 0.
+    - prefetch_factor: The number of batches each worker loads in advance. Requires num_workers > 0.
+    - packed_dir: Optional directory of a dataset packed with packed_dataset.pack_dataset, read instead of data_root_dir.
+    - split_seed: Optional seed for the train/val/test split, so every run gets the same split.
 
     Returns:
     - train_loader: DataLoader for the training set.
     - val_loader: DataLoader for the validation set.
     - test_loader: DataLoader for the test set.
     """
-    # Collect imagefolder data paths
-    all_image_paths = [os.path.join(dp, f) for dp, dn, filenames in os.walk(data_root_dir) for f in filenames if os.path.splitext(f)[1].lower() in ['.png', '.jpg', '.jpeg']]
-    train_image_paths, test_image_paths = train_test_split(all_image_paths, test_size=0.1)
-    train_image_paths, val_image_paths = train_test_split(train_image_paths, test_size=0.1)
+    if packed_dir and cache_dir:
+        raise ValueError("cache_dir cannot be used with packed_dir")
+    if packed_dir:
+        # The packed index lists every image, without touching the image files
+        packed_dataset = PackedDataset(packed_dir)
+        all_image_paths = list(range(len(packed_dataset)))
+    else:
+        # Collect imagefolder data paths
+        packed_dataset = None
+        # Sorted since os.walk order depends on the filesystem, so a seeded split is reproducible
+        all_image_paths = sorted(os.path.join(dp, f) for dp, dn, filenames in os.walk(data_root_dir) for f in filenames if os.path.splitext(f)[1].lower() in ['.png', '.jpg', '.jpeg'])
+    image_cache = DecodedImageCache(all_image_paths, cache_dir) if cache_dir else None
+    train_image_paths, test_image_paths = train_test_split(all_image_paths, test_size=0.1, random_state=split_seed)
+    train_image_paths, val_image_paths = train_test_split(train_image_paths, test_size=0.1, random_state=split_seed)
     # Create datasets
-    train_dataset = CustomImageFolderDataset(train_image_paths, extra_transforms=True)
-    val_dataset = CustomImageFolderDataset(val_image_paths, extra_transforms=True)
-    test_dataset = CustomImageFolderDataset(test_image_paths, extra_transforms=False)
+    dataset_kwargs = {"image_cache": image_cache, "batched_augmentation": batched_augmentation, "packed_dataset": packed_dataset}
+    train_dataset = CustomImageFolderDataset(train_image_paths, extra_transforms=True, **dataset_kwargs)
+    val_dataset = CustomImageFolderDataset(val_image_paths, extra_transforms=True, **dataset_kwargs)
+    test_dataset = CustomImageFolderDataset(test_image_paths, extra_transforms=False, **dataset_kwargs)
     # Create dataloaders
-    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=0, collate_fn=custom_collate_fn)
-    val_loader = DataLoader(val_dataset, batch_size=1, shuffle=True, num_workers=0, collate_fn=custom_collate_fn)
-    test_loader = DataLoader(test_dataset, batch_size=1, shuffle=False, num_workers=0, collate_fn=custom_collate_fn)
+    if batched_augmentation:
+        augment_collate_fn = BatchAugmentCollate(extra_transforms=True, seed=seed)
+        test_collate_fn = BatchAugmentCollate(extra_transforms=False)
+    else:
+        augment_collate_fn = test_collate_fn = custom_collate_fn
+    loader_kwargs = {"num_workers": num_workers, "pin_memory": pin_memory}
+    if num_workers > 0:
+        loader_kwargs["persistent_workers"] = persistent_workers
+        if prefetch_factor is not None:
+            loader_kwargs["prefetch_factor"] = prefetch_factor
+    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, collate_fn=augment_collate_fn, **loader_kwargs)
+    val_loader = DataLoader(val_dataset, batch_size=eval_batch_size, shuffle=True, collate_fn=augment_collate_fn, **loader_kwargs)
+    test_loader = DataLoader(test_dataset, batch_size=eval_batch_size, shuffle=False, collate_fn=test_collate_fn, **loader_kwargs)
     return train_loader, val_loader, test_loader
 
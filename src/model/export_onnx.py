@@ -0,0 +1,64 @@
+import argparse
+import torch
+from resnet18 import CustomResNet18
+from resnet50 import CustomResNet50
+
+
+def load_custom_resnet(arch: str, weights_path: str) -> torch.nn.Module:
+    """
+    Instantiate a CustomResNet18/CustomResNet50 and load trained weights into it.
+
+    Args:
+    - arch: "resnet18" or "resnet50".
+    - weights_path: A state dict saved from the custom model, or from its inner torchvision ResNet
+      (as used by the pictionary-app).
+
+    Returns:
+    - model: The model in eval mode, on the CPU.
+    """
+    model = {"resnet18": CustomResNet18, "resnet50": CustomResNet50}[arch]()
+    state_dict = torch.load(weights_path, map_location="cpu")
+    if all(key.startswith("model.") for key in state_dict):
+        model.load_state_dict(state_dict)
+    else:
+        model.model.load_state_dict(state_dict)
+    return model.cpu().eval()
+
+
+def export_onnx(model: torch.nn.Module, output_path: str, image_size: tuple = (128, 128), opset_version: int = 17, **export_kwargs) -> None:
+    """
+    Export a model to ONNX with a dynamic batch dimension.
+
+    Args:
+    - model: The model to export.
+    - output_path: The path to save the ONNX model to.
+    - image_size: The (height, width) of the example input.
+    - opset_version: The ONNX opset to target.
+    - export_kwargs: Extra arguments for torch.onnx.export.
+    """
+    model = model.cpu().eval()
+    example_input = torch.rand(1, 3, *image_size)
+    with torch.no_grad():
+        torch.onnx.export(model, (example_input,), output_path,
+                          input_names=["image"],
+                          output_names=["scores"],
+                          dynamic_axes={"image": {0: "batch"}, "scores": {0: "batch"}},
+                          opset_version=opset_version,
+                          **export_kwargs)
+
+
+def main():
+    """
+    Export a trained CustomResNet18/CustomResNet50 to ONNX.
+    """
+    parser = argparse.ArgumentParser(description="Export a trained model to ONNX.")
+    parser.add_argument("--arch", default="resnet18", choices=["resnet18", "resnet50"])
+    parser.add_argument("--weights", default="../../saved_models/resnet18.pth")
+    parser.add_argument("--output", default="../../saved_models/resnet18.onnx")
+    args = parser.parse_args()
+    model = load_custom_resnet(args.arch, args.weights)
+    export_onnx(model, args.output)
+
+
+if __name__ == "__main__":
+    main()
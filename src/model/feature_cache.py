@@ -0,0 +1,192 @@
+import os
+import hashlib
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+from train_model import train_model
+from data_processing import BatchAugmentCollate
+
+
+def get_backbone(model: torch.nn.Module) -> torch.nn.Module:
+    """
+    Get the frozen trunk of a ResNet model, i.e. every layer before the classifier.
+
+    Args:
+    - model: A CustomResNet18/CustomResNet50 model or a torchvision ResNet.
+
+    Returns:
+    - backbone: A module mapping images to their pooled embeddings (512 or 2048 dimensions).
+    """
+    net = model.model if hasattr(model, "model") else model
+    return torch.nn.Sequential(*list(net.children())[:-1], torch.nn.Flatten(1))
+
+
+def get_head(model: torch.nn.Module) -> torch.nn.Module:
+    """
+    Get the trainable classifier of a ResNet model.
+
+    Args:
+    - model: A CustomResNet18/CustomResNet50 model or a torchvision ResNet.
+
+    Returns:
+    - head: The classifier module, shared with the model.
+    """
+    net = model.model if hasattr(model, "model") else model
+    return net.fc
+
+
+def get_embedding_dim(model: torch.nn.Module) -> int:
+    """
+    Get the size of the backbone embeddings, i.e. the number of input features of the classifier.
+
+    Args:
+    - model: A CustomResNet18/CustomResNet50 model or a torchvision ResNet.
+
+    Returns:
+    - embedding_dim: 512 for ResNet18, 2048 for ResNet50.
+    """
+    head = get_head(model)
+    return next(module for module in head.modules() if isinstance(module, torch.nn.Linear)).in_features
+
+
+def feature_store_key(model: torch.nn.Module, dataset, num_views: int) -> str:
+    """
+    Fingerprint of everything the stored embeddings depend on: the backbone architecture and embedding size,
+    the number of views and augmentations, and the dataset's images and their modification times.
+
+    Args:
+    - model: The model whose backbone produces the embeddings.
+    - dataset: A CustomImageFolderDataset.
+    - num_views: The number of passes over the dataset, see extract_features.
+
+    Returns:
+    - key: Hex digest identifying the embeddings.
+    """
+    fingerprint = hashlib.sha1(f"{num_views}:{dataset.extra_transforms}:{get_embedding_dim(model)}\n".encode())
+    # The parameter names and shapes tell the architectures apart, e.g. ResNet18 from ResNet50
+    for name, tensor in get_backbone(model).state_dict().items():
+        fingerprint.update(f"{name}:{tuple(tensor.shape)}\n".encode())
+    if dataset.packed_dataset is not None:
+        # Images of a packed dataset are indices, which change whenever it is packed again
+        index_path = os.path.join(dataset.packed_dataset.packed_dir, "index.npy")
+        fingerprint.update(f"{os.path.abspath(index_path)}:{os.stat(index_path).st_mtime_ns}\n".encode())
+        fingerprint.update(f"{sorted(dataset.images)}".encode())
+    else:
+        for path in sorted(dataset.images):
+            fingerprint.update(f"{os.path.abspath(path)}:{os.stat(path).st_mtime_ns}\n".encode())
+    return fingerprint.hexdigest()[:16]
+
+
+def extract_features(model: torch.nn.Module, dataset, num_views: int = 1, batch_size: int = 64, device: str = "cpu"):
+    """
+    Run every image of a dataset through the frozen backbone once.
+
+    Args:
+    - model: The model whose backbone produces the embeddings.
+    - dataset: A CustomImageFolderDataset. With batched_augmentation, its raw images are augmented with BatchAugmentCollate.
+    - num_views: The number of passes over the dataset. The first pass keeps every view of an image;
+      later passes only keep the randomly augmented views, since the base and flipped views never change.
+    - batch_size: The number of images per backbone forward pass.
+    - device: The device to use for the backbone.
+
+    Returns:
+    - features: A tensor of shape (N, embedding_dim).
+    - labels: A tensor of shape (N,).
+    """
+    # The backbone is frozen, so run it in eval mode to keep batch norm statistics fixed
+    backbone = get_backbone(model).to(device).eval()
+    num_passes = num_views if dataset.extra_transforms else 1
+    # Datasets with batched augmentation return one raw uint8 image, so its views are built here
+    augment = BatchAugmentCollate(extra_transforms=dataset.extra_transforms) if dataset.batched_augmentation else None
+    features = []
+    labels = []
+    pending_images = []
+    pending_labels = []
+
+    def flush():
+        features.append(backbone(torch.stack(pending_images).to(device)).cpu())
+        labels.extend(pending_labels)
+        pending_images.clear()
+        pending_labels.clear()
+
+    with torch.no_grad():
+        for view_pass in range(num_passes):
+            for idx in range(len(dataset)):
+                images, label = dataset[idx]
+                if augment is not None:
+                    images, _ = augment([(images, label)])
+                if view_pass > 0:
+                    images = images[2:]
+                pending_images.extend(images)
+                pending_labels.extend([label] * len(images))
+                if len(pending_images) >= batch_size:
+                    flush()
+        if pending_images:
+            flush()
+    return torch.cat(features), torch.tensor(labels)
+
+
+def build_feature_store(model: torch.nn.Module, dataset, store_dir: str = None, num_views: int = 1, batch_size: int = 64, device: str = "cpu") -> TensorDataset:
+    """
+    Get the backbone embeddings for a dataset, loading them from store_dir when they were already computed.
+    Stored embeddings are keyed by the backbone architecture, the dataset's images and the number of views, see feature_store_key.
+
+    Args:
+    - model: The model whose backbone produces the embeddings.
+    - dataset: A CustomImageFolderDataset.
+    - store_dir: Optional directory to save and load the embeddings.
+    - num_views: The number of passes over the dataset, see extract_features.
+    - batch_size: The number of images per backbone forward pass.
+    - device: The device to use for the backbone.
+
+    Returns:
+    - feature_dataset: A TensorDataset of (embedding, label) pairs.
+    """
+    store_path = None
+    if store_dir is not None:
+        store_path = os.path.join(store_dir, f"features_{feature_store_key(model, dataset, num_views)}.pt")
+        if os.path.exists(store_path):
+            store = torch.load(store_path)
+            return TensorDataset(store["features"], store["labels"])
+    features, labels = extract_features(model, dataset, num_views=num_views, batch_size=batch_size, device=device)
+    if store_path is not None:
+        os.makedirs(store_dir, exist_ok=True)
+        torch.save({"features": features, "labels": labels}, store_path)
+    return TensorDataset(features, labels)
+
+
+def train_head_on_features(model: torch.nn.Module,
+                           train_loader: DataLoader,
+                           val_loader: DataLoader,
+                           num_views: int = 4,
+                           store_dir: str = None,
+                           batch_size: int = 256,
+                           lr: float = 0.001,
+                           epochs: int = 100,
+                           device: str = "cpu",
+                           best_model_path: str = "../../saved_models/best_model.pth"):
+    """
+    Train only the classifier of a frozen-backbone model on cached backbone embeddings.
+    The backbone runs once per image view instead of once per image per epoch.
+
+    Args:
+    - model: The model to train. Its classifier is updated in place.
+    - train_loader: DataLoader for the training set.
+    - val_loader: DataLoader for the validation set.
+    - num_views: The number of passes over the training set used to cache augmented views.
+    - store_dir: Optional directory to save and load the embeddings.
+    - batch_size: The batch size used to train the classifier.
+    - lr: The learning rate to use.
+    - epochs: The number of epochs to train for.
+    - device: The device to use for training.
+    - best_model_path: The path to save the best classifier weights. Used for early stopping.
+
+    Returns:
+    - train_losses: List of training losses for each epoch.
+    - val_losses: List of validation losses for each epoch.
+    """
+    train_features = build_feature_store(model, train_loader.dataset, store_dir, num_views=num_views, device=device)
+    val_features = build_feature_store(model, val_loader.dataset, store_dir, num_views=1, device=device)
+    feature_train_loader = DataLoader(train_features, batch_size=batch_size, shuffle=True)
+    feature_val_loader = DataLoader(val_features, batch_size=batch_size, shuffle=False)
+    return train_model(get_head(model), feature_train_loader, feature_val_loader,
+                       lr=lr, epochs=epochs, device=device, best_model_path=best_model_path)
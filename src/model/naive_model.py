@@ -1,12 +1,96 @@
 import json
+from functools import lru_cache
 import torch
 from torchvision import transforms
 import numpy as np
-from collections import Counter
 from PIL import Image
 from data_processing import get_dataloaders
 
 
+class ColorClassifier:
+    def __init__(self, colormap_path: str = "colormap.json", seed: int = None):
+        """
+        Classify images based on their dominant color.
+        The color map is loaded and validated once, and queries are answered with
+        one vectorized nearest-neighbour search over the class colors.
+
+        Args:
+        - colormap_path: The path to the json file that contains the dominant color for each class.
+        - seed: Optional seed for choosing between labels that share a color. Uses np.random when not given.
+        """
+        with open(colormap_path, "r") as f:
+            rgb_color_classes = json.load(f)
+        if not isinstance(rgb_color_classes, dict) or not rgb_color_classes:
+            raise ValueError(f"{colormap_path} must map at least one color to its labels")
+        colors = []
+        labels = []
+        for color, color_labels in rgb_color_classes.items():
+            # The keys are strings of tuples, e.g. "(0, 83, 0)"
+            try:
+                color = tuple(int(c) for c in color.strip("()").split(","))
+            except ValueError:
+                raise ValueError(f"Invalid color {color!r} in {colormap_path}")
+            if len(color) != 3 or not all(0 <= c <= 255 for c in color):
+                raise ValueError(f"Invalid color {color!r} in {colormap_path}")
+            if not isinstance(color_labels, list) or not color_labels or not all(isinstance(l, int) for l in color_labels):
+                raise ValueError(f"Color {color} in {colormap_path} must map to a non-empty list of labels")
+            colors.append(color)
+            labels.append(color_labels)
+        self.centroids = np.array(colors, dtype=np.float64)
+        # Pad the labels of each color into one array so random selection can be vectorized
+        self.num_labels = np.array([len(color_labels) for color_labels in labels])
+        self.labels = np.zeros((len(labels), self.num_labels.max()), dtype=np.int64)
+        for i, color_labels in enumerate(labels):
+            self.labels[i, :len(color_labels)] = color_labels
+        self.rng = np.random.default_rng(seed) if seed is not None else np.random
+
+    def predict(self, image: Image) -> int:
+        """
+        Classify a single image.
+
+        Args:
+        - image: A PIL Image object.
+
+        Returns:
+        - label: The predicted label for the image.
+        """
+        return int(self.predict_batch([image])[0])
+
+    def predict_batch(self, images=None, dominant_colors=None, quantize_bits=None) -> np.ndarray:
+        """
+        Classify many images at once, from the images or from their precomputed dominant colors.
+        Each image gets the labels of the closest class color. If there are multiple labels for the color, random selection.
+
+        Args:
+        - images: A list of PIL Image objects or an RGB uint8 array of shape (N, H, W, 3).
+        - dominant_colors: An array of shape (N, 3) with the dominant color of each image, used instead of images.
+        - quantize_bits: Optional number of bits to keep per color channel when computing dominant colors.
+
+        Returns:
+        - labels: An array of shape (N,) with the predicted label for each image.
+        """
+        if dominant_colors is None:
+            if images is None:
+                raise ValueError("Either images or dominant_colors must be given")
+            if not isinstance(images, np.ndarray):
+                images = np.stack([np.asarray(image, dtype=np.uint8) for image in images])
+            dominant_colors = get_dominant_colors(images, quantize_bits)
+        dominant_colors = np.asarray(dominant_colors, dtype=np.float64).reshape(-1, 3)
+        # Squared distance from every dominant color to every class color
+        distances = ((dominant_colors[:, np.newaxis, :] - self.centroids[np.newaxis, :, :]) ** 2).sum(axis=2)
+        nearest = distances.argmin(axis=1)
+        choice = (self.rng.random(len(nearest)) * self.num_labels[nearest]).astype(np.int64)
+        return self.labels[nearest, choice]
+
+
+@lru_cache(maxsize=None)
+def load_color_classifier(colormap_path: str = "colormap.json") -> ColorClassifier:
+    """
+    Load a ColorClassifier, reusing it for later calls with the same color map path.
+    """
+    return ColorClassifier(colormap_path)
+
+
 def color_classifier(image: Image, colormap_path: str = "colormap.json") -> int:
     """
     Classify an image based on its dominant color.
@@ -18,56 +102,54 @@ def color_classifier(image: Image, colormap_path: str = "colormap.json") -> int:
     Returns:
     - label: The predicted label for the image.
     """
-    # Load the json file that contains the dominant color for each class
-    with open(colormap_path, "r") as f:
-        rgb_color_classes = json.load(f)
-    # The keys are strings of tuples, convert them to actual tuples
-    rgb_color_classes = {tuple(eval(k)): v for k, v in rgb_color_classes.items()}
-    # rgb_color_classes = {(131, 0, 131): [2], (255, 0, 0): [4, 6], (0, 0, 0): [0, 1, 3, 5, 7], (0, 83, 0): [8], (0, 0, 255): [9]}
-
-    # Get the dominant color of the image
-    dominant_rgb_color = get_dominant_color(image)
-    
-    # Find the closest dominant color in the dictionary. If there are multiple labels for the color, random selection.
-    min_distance = np.inf
-    label = None
-    for rgb_color, labels in rgb_color_classes.items():
-        distance = np.linalg.norm(np.array(rgb_color) - np.array(dominant_rgb_color))
-        if distance < min_distance:
-            min_distance = distance
-            label = labels
-    if len(label) > 1:
-        label = np.random.choice(label)
-    else:
-        label = label[0]
-    return label
-
-
-def get_dominant_color(image):
+    return load_color_classifier(colormap_path).predict(image)
+
+
+def get_dominant_color(image, quantize_bits=None):
     """
     Get the dominant color in an image.
     
     Args:
-    - image: A PIL Image object.
+    - image: A PIL Image object or an RGB uint8 array of shape (H, W, 3).
+    - quantize_bits: Optional number of bits to keep per color channel before counting.
     
     Returns:
     - dominant_color: A tuple representing the RGB values of the dominant color.
     """
-    # Get the RGB values of all pixels
-    pixels = np.array(image)
-    pixels = pixels.reshape(-1, 3)
-    
-    # Count the frequency of each color
-    counter = Counter(map(tuple, pixels))
-    
-    # Get the second most common color (most common is the background)
-    try:
-        dominant_color = counter.most_common(2)[1][0]
-    except IndexError:
-        # If the image is blank
-        dominant_color = counter.most_common(1)[0][0]
-    
-    return dominant_color
+    pixels = np.asarray(image, dtype=np.uint8)
+    return tuple(get_dominant_colors(pixels[np.newaxis], quantize_bits)[0].tolist())
+
+
+def get_dominant_colors(images, quantize_bits=None):
+    """
+    Get the dominant color of each image in a batch.
+    The second most common color is used, since the most common is the background.
+    Ties are broken by which color appears first, and blank images return their only color.
+
+    Args:
+    - images: An RGB uint8 array of shape (N, H, W, 3).
+    - quantize_bits: Optional number of bits to keep per color channel before counting.
+
+    Returns:
+    - dominant_colors: A uint8 array of shape (N, 3).
+    """
+    images = np.asarray(images, dtype=np.uint8)
+    num_images = images.shape[0]
+    pixels = images.reshape(num_images, -1, 3)
+    if quantize_bits is not None:
+        shift = 8 - quantize_bits
+        pixels = (pixels >> shift) << shift
+    # Pack each RGB pixel into one integer, offset by the image index so all images are counted together
+    packed = (pixels[..., 0].astype(np.int64) << 16) | (pixels[..., 1].astype(np.int64) << 8) | pixels[..., 2]
+    packed |= np.arange(num_images, dtype=np.int64)[:, np.newaxis] << 24
+    colors, first_index, counts = np.unique(packed.ravel(), return_index=True, return_counts=True)
+    image_index = colors >> 24
+    # Order the colors of each image by count, most common first, then by first appearance
+    order = np.lexsort((first_index, -counts, image_index))
+    group_start = np.searchsorted(image_index[order], np.arange(num_images))
+    group_size = np.bincount(image_index, minlength=num_images)
+    dominant = colors[order[group_start + (group_size > 1)]] & 0xFFFFFF
+    return np.stack([dominant >> 16, (dominant >> 8) & 0xFF, dominant & 0xFF], axis=1).astype(np.uint8)
 
 
 def unnormalize_image(image):
@@ -98,20 +180,17 @@ def create_color_classifier_json(train_loader, output_path="colormap.json"):
     - output_path: The path to save the json file.
     """
     dominant_colors = {}
+    mean = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
+    std = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
     # Get the dominant color for each class
     for images, labels in train_loader:
+        # Unnormalize the whole batch and convert it to uint8 the same way ToPILImage does
+        images_unnorm = (images * std + mean).clip(0, 1)
+        images_unnorm = images_unnorm.mul(255).byte().permute(0, 2, 3, 1).numpy()
+        batch_dominant_colors = get_dominant_colors(images_unnorm)
         for i in range(len(images)):
-            image = images[i]
             label = labels[i].item()
-            
-            # Unnormalize the image
-            mean = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
-            std = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
-            image_unnorm = image * std + mean
-            image_unnorm = image_unnorm.clip(0, 1) 
-            
-            image_unnorm = transforms.ToPILImage()(image_unnorm[0])
-            dominant_color = get_dominant_color(image_unnorm)
+            dominant_color = tuple(batch_dominant_colors[i].tolist())
             if label not in dominant_colors:
                 dominant_colors[label] = {dominant_color: 1}
             else:
@@ -0,0 +1,186 @@
+import os
+import re
+import json
+import tarfile
+import argparse
+import numpy as np
+from io import BytesIO
+from PIL import Image
+
+# One row per image: the shard it is stored in, its byte range there, its label and its size
+INDEX_DTYPE = np.dtype([("shard", "<u4"), ("offset", "<u8"), ("length", "<u4"), ("label", "<u2"), ("height", "<u2"), ("width", "<u2")])
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+# The members of the drawing shards uploaded by the data collection app, e.g. "Car/Car_1712345678901234567_9f2c4a1b.png"
+SHARD_MEMBER_PATTERN = re.compile(r"([A-Za-z][A-Za-z_\-]{0,63})/([A-Za-z0-9_\-]+\.png)")
+
+
+def unpack_shards(shard_dir: str, data_root_dir: str) -> int:
+    """
+    Extract the drawings of the tar shards uploaded by the data collection app into the image folder tree
+    read by pack_dataset, e.g. after syncing the shards/ prefix of the bucket to shard_dir.
+    Drawings that are already in the tree are skipped, so the shards can be unpacked again after new ones arrived.
+    Members that are not "<class>/<name>.png" files are ignored.
+
+    Args:
+    - shard_dir: The directory containing the .tar shards.
+    - data_root_dir: The root directory containing one folder of images per class.
+
+    Returns:
+    - num_added: The number of drawings added to the tree.
+    """
+    num_added = 0
+    for shard_name in sorted(os.listdir(shard_dir)):
+        if not shard_name.endswith(".tar"):
+            continue
+        with tarfile.open(os.path.join(shard_dir, shard_name), "r:") as archive:
+            for member in archive:
+                match = SHARD_MEMBER_PATTERN.fullmatch(member.name)
+                if not member.isfile() or match is None:
+                    continue
+                path = os.path.join(data_root_dir, match[1], match[2])
+                if os.path.exists(path):
+                    continue
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(f"{path}.tmp", "wb") as f:
+                    f.write(archive.extractfile(member).read())
+                os.replace(f"{path}.tmp", path)
+                num_added += 1
+    return num_added
+
+
+def pack_dataset(data_root_dir: str, output_dir: str, shard_size: int = 64 * 2**20, seed: int = None) -> "PackedDataset":
+    """
+    Pack an image folder tree (one folder per class) into a few large shard files and an index.
+    The encoded image bytes are copied as is, so packing does not change the images.
+
+    Args:
+    - data_root_dir: The root directory containing one folder of images per class.
+    - output_dir: The directory to write the shards, the index and the metadata to.
+    - shard_size: The size in bytes after which a new shard is started.
+    - seed: Optional seed to shuffle the images before packing, so reading a shard sequentially mixes the classes.
+
+    Returns:
+    - dataset: The PackedDataset reading from output_dir.
+    """
+    classes = sorted(entry for entry in os.listdir(data_root_dir) if os.path.isdir(os.path.join(data_root_dir, entry)))
+    sources = [(os.path.join(category, name), label)
+               for label, category in enumerate(classes)
+               for name in sorted(os.listdir(os.path.join(data_root_dir, category)))
+               if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS]
+    if seed is not None:
+        sources = [sources[i] for i in np.random.default_rng(seed).permutation(len(sources))]
+    os.makedirs(output_dir, exist_ok=True)
+    index = np.empty(len(sources), dtype=INDEX_DTYPE)
+    shard_names = []
+    shard_file = None
+    offset = 0
+    for row, (relative_path, label) in enumerate(sources):
+        with open(os.path.join(data_root_dir, relative_path), "rb") as f:
+            data = f.read()
+        if shard_file is None or offset >= shard_size:
+            if shard_file is not None:
+                shard_file.close()
+            shard_names.append(f"shard-{len(shard_names):05d}.bin")
+            shard_file = open(os.path.join(output_dir, shard_names[-1]), "wb")
+            offset = 0
+        # Only the image header is parsed to get the size
+        width, height = Image.open(BytesIO(data)).size
+        shard_file.write(data)
+        index[row] = (len(shard_names) - 1, offset, len(data), label, height, width)
+        offset += len(data)
+    if shard_file is not None:
+        shard_file.close()
+    np.save(os.path.join(output_dir, "index.npy"), index)
+    with open(os.path.join(output_dir, "paths.txt"), "w") as f:
+        f.writelines(f"{relative_path}\n" for relative_path, _ in sources)
+    # The metadata is written last, so an interrupted packing is not mistaken for a complete one
+    with open(os.path.join(output_dir, "meta.json"), "w") as f:
+        json.dump({"classes": classes, "shards": shard_names, "num_images": len(sources), "shuffled": seed is not None}, f)
+    return PackedDataset(output_dir)
+
+
+class PackedDataset:
+    def __init__(self, packed_dir: str):
+        """
+        Random access to the images of a dataset packed with pack_dataset.
+        Listing the dataset only reads the index, and images are read from memory-mapped shards
+        with their offsets, so no per-image files are opened.
+
+        Args:
+        - packed_dir: The directory written by pack_dataset.
+        """
+        self.packed_dir = packed_dir
+        with open(os.path.join(packed_dir, "meta.json")) as f:
+            meta = json.load(f)
+        self.classes = meta["classes"]
+        self.shard_names = meta["shards"]
+        # Whether the images were shuffled when packing, otherwise the shards hold one class after another
+        self.shuffled = meta.get("shuffled", False)
+        self.index = np.load(os.path.join(packed_dir, "index.npy"))
+        self.labels = self.index["label"].astype(np.int64)
+        # Opened lazily so the dataset can be sent to dataloader worker processes
+        self._shards = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_shards"] = None
+        return state
+
+    @property
+    def paths(self) -> list:
+        """
+        The path of every image relative to the original data root, e.g. "Car/Car_1708472914479.png".
+        """
+        with open(os.path.join(self.packed_dir, "paths.txt")) as f:
+            return f.read().splitlines()
+
+    def read_bytes(self, i: int) -> np.ndarray:
+        """
+        The encoded bytes of an image, as a read-only uint8 view of its shard.
+        """
+        if self._shards is None:
+            self._shards = [np.memmap(os.path.join(self.packed_dir, name), dtype=np.uint8, mode="r") for name in self.shard_names]
+        entry = self.index[i]
+        offset = int(entry["offset"])
+        return self._shards[entry["shard"]][offset:offset + int(entry["length"])]
+
+    def read_image(self, i: int) -> np.ndarray:
+        """
+        Decode an image.
+
+        Returns:
+        - image: A uint8 RGB array of shape (H, W, 3).
+        """
+        return np.array(Image.open(BytesIO(self.read_bytes(i))).convert("RGB"))
+
+    def sequential_order(self, indices) -> np.ndarray:
+        """
+        Sort indices by their position in the shards, so reading them streams through each shard once.
+        The classes are only mixed in this order when the dataset was shuffled when packing, see shuffled.
+        """
+        indices = np.asarray(indices)
+        return indices[np.lexsort((self.index["offset"][indices], self.index["shard"][indices]))]
+
+
+def main():
+    """
+    Pack the drawing folders into shards, after unpacking the drawing shards uploaded by the data collection app if given.
+    """
+    parser = argparse.ArgumentParser(description="Pack an image folder tree into shards with an index.")
+    parser.add_argument("--data", default="../../data")
+    parser.add_argument("--output", default="../../packed_data")
+    parser.add_argument("--shard-size-mb", type=float, default=64)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--shards", default=None, help="Directory of drawing shards to unpack into --data before packing")
+    args = parser.parse_args()
+    if args.shards:
+        print(f"Unpacked {unpack_shards(args.shards, args.data)} new drawings into {args.data}")
+    dataset = pack_dataset(args.data, args.output, int(args.shard_size_mb * 2**20), args.seed)
+    print(f"Packed {len(dataset)} images into {len(dataset.shard_names)} shards in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
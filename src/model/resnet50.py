@@ -4,6 +4,7 @@ import numpy as np
 from collections import OrderedDict
 from data_processing import get_dataloaders
 from train_model import train_model
+from feature_cache import train_head_on_features
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 
 
@@ -33,16 +34,22 @@ class CustomResNet50(torch.nn.Module):
         return self.model(x)
 
 
-def main():
+def main(feature_store_dir: str = None):
     """
     Instantiate the CustomResNet50 model and train it.
+    When feature_store_dir is given, only the classifier is trained on cached backbone embeddings.
     """
     # Instantiate model
     model = CustomResNet50()
     # Setup dataloaders
-    train_loader, val_loader, test_loader = get_dataloaders("../../data/")
+    # The stored embeddings are only reused when every run gets the same split
+    split_seed = 0 if feature_store_dir is not None else None
+    train_loader, val_loader, test_loader = get_dataloaders("../../data/", split_seed=split_seed)
     # Train model
-    train_losses, val_losses = train_model(model, train_loader, val_loader, device=DEVICE)
+    if feature_store_dir is not None:
+        train_losses, val_losses = train_head_on_features(model, train_loader, val_loader, store_dir=feature_store_dir, device=DEVICE)
+    else:
+        train_losses, val_losses = train_model(model, train_loader, val_loader, device=DEVICE)
     # Save model
     torch.save(model.state_dict(), "../../saved_models/resnet50.pth")
 
@@ -1,20 +1,135 @@
 import cv2
 import os
 import numpy as np
-from typing import Tuple
+from concurrent.futures import ProcessPoolExecutor
+from typing import Tuple, Iterator
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import StandardScaler
+from sklearn.decomposition import IncrementalPCA
+from sklearn.random_projection import SparseRandomProjection
+from sklearn.linear_model import SGDClassifier
+from sklearn.pipeline import Pipeline
 from sklearn.svm import SVC
 from joblib import dump
+from packed_dataset import PackedDataset, IMAGE_EXTENSIONS
 
 
-def create_svm_dataset(data_root_dir: str = "../../data/", image_size: tuple = (128, 128)) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+def list_svm_images(data_root_dir: str = "../../data/") -> Tuple[list, np.ndarray]:
+    """
+    List the image paths and labels without reading any images.
+
+    Args:
+    - data_root_dir: The root directory containing the image folders.
+
+    Returns:
+    - image_paths: The path of every image.
+    - labels: The label of every image, the index of its category in sorted order, as in a packed dataset.
+    """
+    categories = sorted(entry for entry in os.listdir(data_root_dir) if os.path.isdir(os.path.join(data_root_dir, entry)))
+    image_paths = []
+    labels = []
+    for label, category in enumerate(categories):
+        category_path = os.path.join(data_root_dir, category)
+        for image_name in sorted(os.listdir(category_path)):
+            if os.path.splitext(image_name)[1].lower() in IMAGE_EXTENSIONS:
+                image_paths.append(os.path.join(category_path, image_name))
+                labels.append(label)
+    return image_paths, np.array(labels)
+
+
+def list_packed_images(packed_dir: str) -> Tuple[PackedDataset, np.ndarray, np.ndarray]:
+    """
+    List the images of a packed dataset from its index, without opening any image.
+
+    Args:
+    - packed_dir: The directory of a dataset packed with packed_dataset.pack_dataset.
+
+    Returns:
+    - packed_dataset: The PackedDataset, passed to the readers along with the indices.
+    - indices: The index of every image, used in place of the image paths.
+    - labels: The label of every image, the same as list_svm_images gives it in the unpacked folders.
+    """
+    packed_dataset = PackedDataset(packed_dir)
+    return packed_dataset, np.arange(len(packed_dataset)), packed_dataset.labels
+
+
+def _read_images(image_paths: list, image_size: tuple, dtype, packed_dataset: PackedDataset = None) -> np.ndarray:
+    """
+    Read, resize and flatten a list of images into a new matrix.
+    With packed_dataset, image_paths are indices into it and the images are decoded from its shards.
+    """
+    X = np.empty((len(image_paths), image_size[0] * image_size[1] * 3), dtype=dtype)
+    for row, image_path in enumerate(image_paths):
+        if packed_dataset is not None:
+            image = cv2.imdecode(packed_dataset.read_bytes(image_path), cv2.IMREAD_COLOR)
+        else:
+            image = cv2.imread(image_path, cv2.IMREAD_COLOR)
+        X[row] = cv2.resize(image, image_size).ravel()
+    return X
+
+
+# The packed dataset of a load_images worker process, opened once by _open_packed_dataset
+_worker_packed_dataset = None
+
+
+def _open_packed_dataset(packed_dir: str):
+    """
+    Process pool initializer opening the packed dataset in a worker, so tasks only carry their indices.
+    """
+    global _worker_packed_dataset
+    _worker_packed_dataset = PackedDataset(packed_dir)
+
+
+def _read_packed_images(indices: np.ndarray, image_size: tuple, dtype) -> np.ndarray:
+    return _read_images(indices, image_size, dtype, _worker_packed_dataset)
+
+
+def load_images(image_paths: list, image_size: tuple = (128, 128), dtype=np.uint8, num_workers: int = None, chunk_size: int = 64, packed_dataset: PackedDataset = None) -> np.ndarray:
+    """
+    Read, resize and flatten images into one preallocated matrix, decoding them in a process pool.
+    Each decoded chunk is written into its rows of the matrix as soon as it arrives.
+
+    Args:
+    - image_paths: The paths of the images to read.
+    - image_size: The size to resize the images to.
+    - dtype: The dtype of the matrix, e.g. np.uint8 to keep memory low or np.float32.
+    - num_workers: The number of worker processes. Defaults to the number of CPUs, 1 reads in this process.
+    - chunk_size: The number of images decoded per task.
+    - packed_dataset: Optional PackedDataset to read from, image_paths are then indices into it.
+
+    Returns:
+    - X: A matrix of shape (len(image_paths), image_size[0] * image_size[1] * 3).
+    """
+    num_workers = num_workers or os.cpu_count() or 1
+    if num_workers == 1 or len(image_paths) <= chunk_size:
+        return _read_images(image_paths, image_size, dtype, packed_dataset)
+    X = np.empty((len(image_paths), image_size[0] * image_size[1] * 3), dtype=dtype)
+    starts = range(0, len(image_paths), chunk_size)
+    chunks = [image_paths[start:start + chunk_size] for start in starts]
+    if packed_dataset is not None:
+        # Each worker opens the dataset itself, sending it with every task would pickle its whole index each time
+        read_chunk = _read_packed_images
+        executor_kwargs = {"initializer": _open_packed_dataset, "initargs": (packed_dataset.packed_dir,)}
+    else:
+        read_chunk = _read_images
+        executor_kwargs = {}
+    with ProcessPoolExecutor(max_workers=num_workers, **executor_kwargs) as executor:
+        results = executor.map(read_chunk, chunks, [image_size] * len(chunks), [dtype] * len(chunks))
+        for start, X_chunk in zip(starts, results):
+            X[start:start + len(X_chunk)] = X_chunk
+    return X
+
+
+def create_svm_dataset(data_root_dir: str = "../../data/", image_size: tuple = (128, 128), dtype=np.uint8, num_workers: int = None, packed_dir: str = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
     """
     Create a dataset for training the SVM model.
 
     Args:
     - data_root_dir: The root directory containing the image folders.
     - image_size: The size to resize the images to.
+    - dtype: The dtype used to hold the images before scaling.
+    - num_workers: The number of worker processes used to read the images. Defaults to the number of CPUs.
+    - packed_dir: Optional directory of a packed dataset, read instead of data_root_dir.
 
     Returns:
     - X_train: The scaled training data.
@@ -23,20 +138,12 @@ def create_svm_dataset(data_root_dir: str = "../../data/", image_size: tuple = (
     - y_test: The test labels.
     """
     # Load the image data and set labels
-    categories = os.listdir(data_root_dir)
-    labels = []
-    images = []
-    for category in categories:
-        category_path = os.path.join(data_root_dir, category)
-        for image_name in os.listdir(category_path):
-            image_path = os.path.join(category_path, image_name)
-            image = cv2.imread(image_path, cv2.IMREAD_COLOR)
-            image = cv2.resize(image, image_size)
-            images.append(image.flatten())
-            labels.append(categories.index(category))
-    # Create numpy arrays
-    X = np.array(images)
-    y = np.array(labels)
+    if packed_dir:
+        packed_dataset, image_paths, y = list_packed_images(packed_dir)
+    else:
+        packed_dataset = None
+        image_paths, y = list_svm_images(data_root_dir)
+    X = load_images(image_paths, image_size, dtype=dtype, num_workers=num_workers, packed_dataset=packed_dataset)
     # Make train-test splits
     X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=0)
     # Scale the data
@@ -62,12 +169,124 @@ def train_svm(X_train: np.ndarray, y_train: np.ndarray) -> SVC:
     return model
 
 
-def main():
+def iter_image_chunks(image_paths: list, labels: np.ndarray, image_size: tuple = (128, 128), chunk_size: int = 256, packed_dataset: PackedDataset = None) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Read the images in chunks so only one chunk is held in memory at a time.
+
+    Args:
+    - image_paths: The paths of the images to read.
+    - labels: The label of every image.
+    - image_size: The size to resize the images to. Smaller sizes reduce the number of features.
+    - chunk_size: The number of images per chunk.
+    - packed_dataset: Optional PackedDataset to read from, image_paths are then indices into it.
+
+    Yields:
+    - X_chunk: The flattened images of the chunk, as float32.
+    - y_chunk: The labels of the chunk.
+    """
+    for start in range(0, len(image_paths), chunk_size):
+        X_chunk = load_images(image_paths[start:start + chunk_size], image_size, dtype=np.float32, num_workers=1, packed_dataset=packed_dataset)
+        yield X_chunk, labels[start:start + chunk_size]
+
+
+def train_svm_streaming(image_paths: list,
+                        labels: np.ndarray,
+                        image_size: tuple = (128, 128),
+                        chunk_size: int = 256,
+                        reduction: str = None,
+                        n_components: int = 128,
+                        epochs: int = 5,
+                        packed_dataset: PackedDataset = None) -> Pipeline:
+    """
+    Train a linear SVM out-of-core, reading the images in chunks on every pass.
+    Uses a partial-fit scaler, an optional incremental feature reduction and an SGD classifier with hinge loss,
+    so peak memory depends on the chunk size rather than the number of images.
+
+    Args:
+    - image_paths: The paths of the training images.
+    - labels: The label of every training image.
+    - image_size: The size to resize the images to.
+    - chunk_size: The number of images read per chunk. Must be at least n_components when reduction is "pca".
+    - reduction: None, "pca" (incremental PCA) or "random_projection" (sparse random projection).
+    - n_components: The number of features kept by the reduction.
+    - epochs: The number of passes used to train the classifier.
+    - packed_dataset: Optional PackedDataset to read from, image_paths are then indices into it.
+
+    Returns:
+    - model: A fitted Pipeline of the scaler, the optional reduction and the classifier.
+    """
+    if reduction not in (None, "pca", "random_projection"):
+        raise ValueError(f"Unknown reduction {reduction!r}, expected None, 'pca' or 'random_projection'")
+    classes = np.unique(labels)
+    # First pass: fit the scaler
+    scaler = StandardScaler()
+    for X_chunk, _ in iter_image_chunks(image_paths, labels, image_size, chunk_size, packed_dataset):
+        scaler.partial_fit(X_chunk)
+    steps = [("scaler", scaler)]
+    # Second pass (PCA only): fit the reduction on the scaled chunks
+    if reduction == "pca":
+        reducer = IncrementalPCA(n_components=n_components)
+        for X_chunk, _ in iter_image_chunks(image_paths, labels, image_size, chunk_size, packed_dataset):
+            reducer.partial_fit(scaler.transform(X_chunk))
+        steps.append(("reduction", reducer))
+    elif reduction == "random_projection":
+        # The projection only depends on the number of features, so fit it on a single row
+        num_features = image_size[0] * image_size[1] * 3
+        reducer = SparseRandomProjection(n_components=n_components, random_state=0).fit(np.zeros((1, num_features), dtype=np.float32))
+        steps.append(("reduction", reducer))
+    # Remaining passes: train the classifier
+    model = Pipeline(steps + [("classifier", SGDClassifier(loss="hinge", random_state=0))])
+    features = Pipeline(steps)
+    for _ in range(epochs):
+        for X_chunk, y_chunk in iter_image_chunks(image_paths, labels, image_size, chunk_size, packed_dataset):
+            model.named_steps["classifier"].partial_fit(features.transform(X_chunk), y_chunk, classes=classes)
+    return model
+
+
+def evaluate_streaming(model: Pipeline, image_paths: list, labels: np.ndarray, image_size: tuple = (128, 128), chunk_size: int = 256, packed_dataset: PackedDataset = None) -> float:
+    """
+    Compute the accuracy of a model, reading the images in chunks.
+
+    Args:
+    - model: The fitted model.
+    - image_paths: The paths of the test images.
+    - labels: The label of every test image.
+    - image_size: The size to resize the images to.
+    - chunk_size: The number of images read per chunk.
+    - packed_dataset: Optional PackedDataset to read from, image_paths are then indices into it.
+
+    Returns:
+    - accuracy: The fraction of correctly predicted images.
+    """
+    correct = 0
+    for X_chunk, y_chunk in iter_image_chunks(image_paths, labels, image_size, chunk_size, packed_dataset):
+        correct += np.sum(model.predict(X_chunk) == y_chunk)
+    return correct / len(labels)
+
+
+def main(streaming: bool = False, packed_dir: str = None):
     """
     Train an SVM model on the image data and save it.
+    With streaming, the images are read in chunks and a linear SVM is trained out-of-core.
+    With packed_dir, the images are read from a packed dataset instead of the image folders.
     """
-    X_train, X_test, y_train, y_test = create_svm_dataset()
-    model = train_svm(X_train, y_train)
+    if streaming:
+        if packed_dir:
+            packed_dataset, image_paths, labels = list_packed_images(packed_dir)
+        else:
+            packed_dataset = None
+            image_paths, labels = list_svm_images()
+        train_paths, test_paths, y_train, y_test = train_test_split(image_paths, labels, test_size=0.2, random_state=0)
+        if packed_dataset is not None and packed_dataset.shuffled:
+            # Stream through the shards front to back, the packer already shuffled the classes.
+            # Unshuffled shards hold one class after another, so they keep the random split order
+            train_paths = packed_dataset.sequential_order(train_paths)
+            y_train = labels[train_paths]
+        model = train_svm_streaming(train_paths, y_train, packed_dataset=packed_dataset)
+        print(f"Test accuracy: {evaluate_streaming(model, test_paths, y_test, packed_dataset=packed_dataset)}")
+    else:
+        X_train, X_test, y_train, y_test = create_svm_dataset(packed_dir=packed_dir)
+        model = train_svm(X_train, y_train)
     dump(model, '../../saved_models/svm_model.joblib')
 
 
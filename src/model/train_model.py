@@ -24,7 +24,8 @@ def train_model(model: torch.nn.Module,
     - val_losses: List of validation losses for each epoch.
     """
     # Setup optimizer and loss function
-    optimizer = torch.optim.Adam(model.fc.parameters(), lr=lr)
+    # Only the unfrozen parameters (the classifier) are trained
+    optimizer = torch.optim.Adam([param for param in model.parameters() if param.requires_grad], lr=lr)
     criterion = torch.nn.CrossEntropyLoss()
     
     best_model = model.state_dict()
@@ -1,52 +1,315 @@
-from flask import Flask, render_template, request, jsonify
-import boto3
-from botocore.exceptions import NoCredentialsError
+import time
+import_start = time.perf_counter()
+from flask import Flask, Response, render_template, request, jsonify
 import base64
+import json
+import re
 import os
-import time
+import secrets
+import threading
+import importlib.util
+from functools import wraps
 from io import BytesIO
+import numpy as np
 from PIL import Image
-import torch
-from scripts.setup_model import load_model
-from scripts.pixel_importance import save_n_pixel_importance_images
-from scripts.feature_maps import create_feature_map_plot
+from scripts.inference_queue import BatchingPredictor
+from scripts.preprocessing import CanvasPreprocessor
+from scripts.prediction_cache import PredictionCache
+from scripts.stroke_sessions import StrokeSessionStore, DiskStrokeSessionStore
+from scripts.jobs import JobQueue, QueueFullError, job_id_for
+from scripts.artifact_store import ArtifactStore, DiskArtifactStore, parse_artifact_url
 
 
 app = Flask(__name__)
 label_map = {"Airplane": 0, "Bicycle": 1, "Butterfly": 2, "Car": 3, "Flower": 4, "House": 5, "Ladybug": 6, "Train": 7, "Tree": 8, "Whale": 9}
-model, device, input_transform, normalize_transform = load_model()
+startup_times = {'imports': time.perf_counter() - import_start}
+model_ready = threading.Event()
+startup_error = None
+model = device = input_transform = normalize_transform = activation_cache = inference_model = predictor = None
+# Set by gunicorn.conf.py: the model is loaded before forking and each worker starts its own batching thread
+prefork_server = os.environ.get('PREFORK_SERVER') == '1'
+# MODEL_BACKEND=onnx serves predictions with NumPy and ONNX Runtime only, torch is imported by the first explanation job
+model_backend = os.environ.get('MODEL_BACKEND', 'torch')
+torch_num_threads = None
+explanation_model_lock = threading.Lock()
+preprocessor = CanvasPreprocessor(crop_to_content=os.environ.get('PREDICT_CROP_TO_CONTENT') == '1')
+# PREDICTION_CACHE_SIZE=0 disables the cache, PREDICTION_CACHE_PERCEPTUAL=1 also shares results between near-identical canvases
+prediction_cache = PredictionCache(max_entries=int(os.environ.get('PREDICTION_CACHE_SIZE', 1024)),
+                                   ttl_seconds=float(os.environ.get('PREDICTION_CACHE_TTL', 300)),
+                                   perceptual=os.environ.get('PREDICTION_CACHE_PERCEPTUAL') == '1')
+# Live drawing sessions, re-inferred once STROKE_MIN_CHANGED_PIXELS pixels changed and at most every STROKE_DEBOUNCE_MS.
+# STROKE_SESSION_STORE=disk shares them between server workers, as a player's requests may reach any worker
+stroke_max_sessions = int(os.environ.get('STROKE_MAX_SESSIONS', 256))
+if os.environ.get('STROKE_SESSION_STORE', 'disk' if prefork_server else 'memory') == 'disk':
+    stroke_sessions = DiskStrokeSessionStore(os.environ.get('STROKE_SESSION_DIR', './stroke_sessions'), stroke_max_sessions)
+else:
+    stroke_sessions = StrokeSessionStore(stroke_max_sessions)
+stroke_min_changed_pixels = int(os.environ.get('STROKE_MIN_CHANGED_PIXELS', 32))
+stroke_debounce_seconds = float(os.environ.get('STROKE_DEBOUNCE_MS', 0)) / 1000
+# Saved drawings and explanation plots, namespaced per player session. ARTIFACT_STORE=disk shares them between server workers
+artifact_max_bytes = int(float(os.environ.get('ARTIFACT_STORE_MAX_MB', 256)) * 2**20)
+artifact_ttl_seconds = float(os.environ.get('ARTIFACT_TTL', 3600))
+if os.environ.get('ARTIFACT_STORE', 'disk' if prefork_server else 'memory') == 'disk':
+    artifact_store = DiskArtifactStore(os.environ.get('ARTIFACT_DIR', './artifacts'), artifact_max_bytes, artifact_ttl_seconds)
+else:
+    artifact_store = ArtifactStore(artifact_max_bytes, artifact_ttl_seconds)
+# Explanation results are content-addressed by job id, so they are shared by every session
+results_namespace = 'results'
+# Explanation plots run in the background, each job waits for queued predictions to finish before it starts.
+# Job statuses are published to the artifact store, so with ARTIFACT_STORE=disk every server worker can report them
+explanation_jobs = JobQueue(num_workers=int(os.environ.get('EXPLANATION_WORKERS', 1)),
+                            max_pending=int(os.environ.get('EXPLANATION_MAX_PENDING', 16)),
+                            wait_idle=lambda timeout: predictor.wait_idle(timeout),
+                            status_store=artifact_store)
+session_cookie = 'pictionary_session'
+
+
+def load_models():
+    """
+    Load the model weights. This starts no threads, so with PREFORK_SERVER=1 it runs once in the
+    server's parent process and the forked workers share the weights copy-on-write.
+    """
+    if model_backend != 'onnx':
+        start = time.perf_counter()
+        load_explanation_model()
+        startup_times['load_model'] = time.perf_counter() - start
+    # ONNX Runtime sessions own thread pools that do not survive a fork, so each worker creates its own
+    if not (prefork_server and model_backend == 'onnx'):
+        load_prediction_model()
+
+
+def load_prediction_model():
+    """
+    Load the model used by /predict for the configured MODEL_BACKEND.
+    """
+    global inference_model
+    start = time.perf_counter()
+    if model_backend == 'onnx':
+        from scripts.onnx_model import load_onnx_model
+        inference_model = load_onnx_model()
+    else:
+        from scripts.setup_model import load_inference_model
+        inference_model = load_inference_model(model, device, backend=model_backend)
+    startup_times['load_inference_model'] = time.perf_counter() - start
+
+
+def load_explanation_model():
+    """
+    Load the eager torch model used by the explanation plots, which hook into its layers.
+    With the torch backend this happens at startup, with the onnx backend on the first explanation job.
+    """
+    global model, device, input_transform, normalize_transform, activation_cache
+    with explanation_model_lock:
+        if model is not None:
+            return
+        import torch
+        from scripts.setup_model import load_model
+        from scripts.feature_maps import ActivationCache
+        if torch_num_threads:
+            torch.set_num_threads(torch_num_threads)
+        activation_cache = ActivationCache()
+        model, device, input_transform, normalize_transform = load_model()
+
+
+def start_predictor():
+    """
+    Start the batching thread and warm the model up. With PREFORK_SERVER=1 this runs in each worker after the fork.
+    """
+    global predictor
+    if inference_model is None:
+        load_prediction_model()
+    predictor = BatchingPredictor(inference_model,
+                                  max_batch_size=int(os.environ.get('PREDICT_MAX_BATCH_SIZE', 16)),
+                                  max_wait_ms=float(os.environ.get('PREDICT_MAX_WAIT_MS', 5)))
+    # Run one prediction so the first request does not pay for lazy initialisation
+    start = time.perf_counter()
+    predictor.predict(np.ones((1, 3, 128, 128), dtype=np.float32))
+    startup_times['warmup'] = time.perf_counter() - start
+    model_ready.set()
+
+
+def init_model(start=True):
+    """
+    Load the model and, when start is set, warm it up, recording the time spent in each phase.
+    """
+    global startup_error
+    try:
+        load_models()
+        if start:
+            start_predictor()
+    except Exception as e:
+        startup_error = repr(e)
+        raise
+
+
+def init_worker(num_threads=None):
+    """
+    Finish starting a pre-forked worker, called by the server after the fork.
+
+    Args:
+        num_threads: The number of torch or ONNX Runtime intra-op threads of this worker, so the workers together do not oversubscribe the CPUs
+    """
+    global startup_error, torch_num_threads
+    if num_threads:
+        torch_num_threads = num_threads
+        if model is not None:
+            import torch
+            torch.set_num_threads(num_threads)
+        os.environ.setdefault('ONNX_THREADS', str(num_threads))
+    try:
+        start_predictor()
+    except Exception as e:
+        startup_error = repr(e)
+        raise
+
+
+def requires_model(route):
+    """
+    Wait for the model to finish loading before handling a request, or respond 503 after MODEL_READY_TIMEOUT seconds.
+    """
+    @wraps(route)
+    def wrapper(*args, **kwargs):
+        if not model_ready.wait(timeout=float(os.environ.get('MODEL_READY_TIMEOUT', 30))):
+            return jsonify({'error': 'Model is not ready'}), 503
+        return route(*args, **kwargs)
+    return wrapper
+
+
+# With BACKGROUND_MODEL_LOAD=1 the server starts accepting requests while the model loads
+if prefork_server:
+    init_model(start=False)
+elif os.environ.get('BACKGROUND_MODEL_LOAD') == '1':
+    threading.Thread(target=init_model, daemon=True).start()
+else:
+    init_model()
+
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    status = {'ready': model_ready.is_set(), 'pid': os.getpid(),
+              'startup_times_ms': {phase: 1000 * seconds for phase, seconds in startup_times.items()}}
+    if startup_error is not None:
+        status['error'] = startup_error
+    return jsonify(status), 200 if model_ready.is_set() else 503
+
+
+def session_namespace():
+    """
+    The artifact namespace of the current player, from the session cookie set by index().
+    """
+    namespace = request.cookies.get(session_cookie, '')
+    return namespace if re.fullmatch(r'[A-Za-z0-9_\-]{16,64}', namespace) else 'anonymous'
 
 
 @app.route('/')
 def index():
-    # Delete all pngs in the static/images directory
-    for file in os.listdir('./static/images'):
-        if file.endswith('.png'):
-            os.remove(f"./static/images/{file}")
-    return render_template('index.html')
+    # Start a new game with a fresh artifact namespace, dropping the previous game's drawings
+    if session_namespace() != 'anonymous':
+        artifact_store.drop_namespace(session_namespace())
+    response = app.make_response(render_template('index.html'))
+    response.set_cookie(session_cookie, secrets.token_urlsafe(16), httponly=True, samesite='Lax')
+    return response
+
+
+@app.route('/artifacts/<namespace>/<path:name>', methods=['GET'])
+def get_artifact(namespace, name):
+    artifact = artifact_store.get(namespace, name)
+    if artifact is None:
+        return jsonify({'error': 'Unknown artifact'}), 404
+    data, content_type = artifact
+    # Artifact names are never reused for different content
+    return Response(data, mimetype=content_type, headers={'Cache-Control': 'private, max-age=3600'})
 
 
 @app.route('/predict', methods=['POST'])
+@requires_model
 def predict():
-    # Extract the image data from the request
-    data = request.json
-    image_data = data.get('image')
-    subject = data.get('sketchsubject')
-    # Decode and prepare the base64-encoded image data
-    image_data = base64.b64decode(image_data)
-    image = Image.open(BytesIO(image_data)).convert("RGB")
-    image = input_transform(image).unsqueeze(0).to(device)
-    # Perform inference
-    with torch.no_grad():
-        output = model(image)
+    # Extract the image data from the request, either base64 in JSON or the raw image as the body
+    if request.is_json:
+        data = request.json
+        image_data = base64.b64decode(data.get('image'))
+        subject = data.get('sketchsubject')
+    else:
+        image_data = request.get_data()
+        subject = request.args.get('sketchsubject')
+    # Decode the image and classify it
+    predicted_class, classes_and_scores = classify(preprocessor.decode(image_data))
+    return jsonify({'predicted_class': predicted_class, 'target': subject, 'all_predictions': classes_and_scores})
+
+
+def classify(pixels):
+    """
+    Classify a decoded canvas, reusing the cached result of an unchanged canvas (e.g. resent while idle).
+
+    Args:
+        pixels: uint8 array of shape (H, W, 3)
+
+    Returns:
+        predicted_class: The name of the predicted class
+        classes_and_scores: Dictionary of the score of every class
+    """
+    cache_key = prediction_cache.key(pixels) if prediction_cache.max_entries else None
+    cached = prediction_cache.get(cache_key) if cache_key else None
+    if cached is not None:
+        return cached
+    # Normalise the image into a reusable buffer
+    image = preprocessor.normalize(pixels)
+    # Perform inference, batched together with any concurrent requests
+    output = predictor.predict(image)
     # Get the predicted class
-    _, predicted = torch.max(output, 1)
+    scores = output[0]
+    predicted = int(scores.argmax())
     # print all classes and their scores
     classes_and_scores = {}
     for i, (key, value) in enumerate(label_map.items()):
-        classes_and_scores[key] = output[0][i].item()
-    predicted_class = list(label_map.keys())[list(label_map.values()).index(predicted.item())]
-    return jsonify({'predicted_class': predicted_class, 'target': subject, 'all_predictions': classes_and_scores})
+        classes_and_scores[key] = float(scores[i])
+    predicted_class = list(label_map.keys())[list(label_map.values()).index(predicted)]
+    if cache_key:
+        prediction_cache.put(cache_key, (predicted_class, classes_and_scores))
+    return predicted_class, classes_and_scores
+
+
+@app.route('/session', methods=['POST'])
+def create_session():
+    return jsonify({'session_id': stroke_sessions.create()})
+
+
+@app.route('/session/<session_id>', methods=['DELETE'])
+def delete_session(session_id):
+    if not stroke_sessions.delete(session_id):
+        return jsonify({'error': 'Unknown session'}), 404
+    return jsonify({'deleted': session_id})
+
+
+@app.route('/session/<session_id>/strokes', methods=['POST'])
+@requires_model
+def session_strokes(session_id):
+    # Apply the strokes drawn since the last update to the server-side canvas
+    data = request.get_json()
+    with stroke_sessions.session(session_id) as session:
+        if session is None:
+            return jsonify({'error': 'Unknown session'}), 404
+        if data.get('clear'):
+            session.clear()
+        try:
+            changed_pixels = session.apply_strokes(data.get('strokes', []))
+        except (KeyError, TypeError, ValueError) as e:
+            return jsonify({'error': f'Invalid strokes: {e}'}), 400
+        # Only re-run the model once the drawing changed enough, otherwise answer with the last result
+        updated = data.get('force') or session.needs_inference(stroke_min_changed_pixels, stroke_debounce_seconds)
+        if updated:
+            session.set_result(classify(session.pixels))
+        predicted_class, classes_and_scores = session.result
+    return jsonify({'predicted_class': predicted_class, 'target': data.get('sketchsubject'),
+                    'all_predictions': classes_and_scores, 'updated': bool(updated), 'changed_pixels': changed_pixels})
+
+
+@app.route('/predict_stats', methods=['GET'])
+@requires_model
+def predict_stats():
+    stats = predictor.stats()
+    stats['cache'] = prediction_cache.stats()
+    return jsonify(stats)
 
 
 @app.route('/generate-presigned-url', methods=['POST'])
@@ -56,6 +319,9 @@ def generate_presigned_url():
     filename = data.get('filename')
     subject = data.get('sketchsubject')
     
+    # boto3 is only imported when needed, it is slow to import and unused by the game itself
+    import boto3
+    from botocore.exceptions import NoCredentialsError
     try:
         s3_client = boto3.client('s3')
         presigned_url = s3_client.generate_presigned_url('put_object',
@@ -74,37 +340,113 @@ def save_image():
     data = request.get_json()
     image_data = data['image_data']
     sketch_subject = data['sketch_subject']
-    filename = f"{sketch_subject}_{int(time.time())}.png"
+    filename = f"{sketch_subject}_{secrets.token_hex(4)}.png"
 
-    # Convert the base64 string to an actual image
+    # Convert the base64 string to an actual image, and store it in the player's namespace
     image = Image.open(BytesIO(base64.b64decode(image_data)))
-    image.save(f"./static/images/{filename}")
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+    url = artifact_store.put(session_namespace(), filename, buffer.getvalue())
+
+    return jsonify({'filename': filename, 'url': url})
+
+
+def submit_explanation_job(kind, params, image_path, fn):
+    """
+    Submit an explanation job for a saved drawing. Its results are stored under the job id, the hash of
+    the drawing and the parameters, so identical requests share one job and its artifacts.
+    """
+    if importlib.util.find_spec('torch') is None:
+        return jsonify({'error': 'Explanations need PyTorch, which is not installed'}), 501
+    key = parse_artifact_url(image_path)
+    artifact = artifact_store.get(*key) if key else None
+    if artifact is None:
+        return jsonify({'error': 'Unknown image'}), 404
+    image_data = artifact[0]
+    job_id = job_id_for(kind, params, image_data)
+    # Run the job again if its artifacts were evicted since it finished
+    job = explanation_jobs.get(job_id)
+    if job is not None and job.status == 'done' and not all(artifact_store.contains(*parse_artifact_url(url)) for url in result_urls(job.result)):
+        explanation_jobs.discard(job_id)
+    try:
+        job = explanation_jobs.submit(job_id, kind, fn, image_data, job_id, **params)
+    except QueueFullError as e:
+        return jsonify({'error': str(e)}), 503
+    return job_response(job)
+
+
+def result_urls(result) -> list:
+    return [url for value in result.values() for url in (value if isinstance(value, list) else [value])]
+
+
+def job_response(job):
+    status = job.to_dict()
+    status['status_url'] = f"/jobs/{job.job_id}"
+    return jsonify(status), 200 if job.done.is_set() else 202
+
+
+def important_pixel_plots_job(image_data, job_id, target_class, num_plots, method):
+    load_explanation_model()
+    from scripts.pixel_importance import important_pixel_frames, save_frames
+    image = Image.open(BytesIO(image_data)).convert("RGB")
+    frames = important_pixel_frames(model, image, label_map[target_class], normalize_transform, num_plots, method)
+    buffers = [BytesIO() for _ in frames]
+    save_frames(frames, buffers)
+    filenames = [artifact_store.put(results_namespace, f"{job_id}/important_pixels_{i+1}.png", buffer.getvalue())
+                 for i, buffer in enumerate(buffers)]
+    return {'filepaths': filenames}
 
-    return jsonify({'filename': filename})
+
+def feature_maps_job(image_data, job_id, layer_name, k):
+    load_explanation_model()
+    from scripts.feature_maps import create_feature_map_plot
+    image = Image.open(BytesIO(image_data)).convert("RGB")
+    image = input_transform(image).unsqueeze(0).to(device)
+    buffer = BytesIO()
+    create_feature_map_plot(model, image, layer_name, filepath=buffer, k=k, activation_cache=activation_cache)
+    return {'filepath': artifact_store.put(results_namespace, f"{job_id}/feature_maps.png", buffer.getvalue())}
 
 
 @app.route('/create_important_pixel_plots', methods=['POST'])
+@requires_model
 def create_important_pixel_plots():
     data = request.get_json()
-    image_path = data['image_path']
-    target_class = data['sketch_subject']
-    num_plots = data['num_plots']
-    image = Image.open(image_path).convert("RGB")
-    filenames = save_n_pixel_importance_images(model, image, label_map[target_class], normalize_transform, num_plots)
-    return jsonify({'filepaths': filenames})
+    params = {'target_class': data['sketch_subject'],
+              'num_plots': data['num_plots'],
+              'method': data.get('method', 'occlusion')}
+    return submit_explanation_job('important_pixels', params, data['image_path'], important_pixel_plots_job)
 
 
 @app.route('/create_feature_maps', methods=['POST'])
+@requires_model
 def create_feature_maps():
     data = request.get_json()
-    image_path = data['image_path']
-    layer_name = data['layer_name']
-    k = data['k']
-    image = Image.open(image_path).convert("RGB")
-    image = input_transform(image).unsqueeze(0).to(device)
-    filepath = "./static/images/feature_maps.png"
-    create_feature_map_plot(model, image, layer_name, filepath=filepath, k=k)
-    return jsonify({'filepath': filepath})
+    params = {'layer_name': data['layer_name'], 'k': data['k']}
+    return submit_explanation_job('feature_maps', params, data['image_path'], feature_maps_job)
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = explanation_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return job_response(job)
+
+
+@app.route('/jobs/<job_id>/stream', methods=['GET'])
+def stream_job(job_id):
+    # Server-sent events with the job status, sent on completion and as a heartbeat while it runs
+    job = explanation_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    def events():
+        latest = job
+        while True:
+            yield f"data: {json.dumps(latest.to_dict())}\n\n"
+            if latest.done.is_set():
+                break
+            latest = explanation_jobs.wait(job_id, timeout=10) or latest
+    return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
 
 if __name__ == '__main__':
@@ -0,0 +1,30 @@
+# Production server: gunicorn -c gunicorn.conf.py app:app
+# The app is imported once in the parent process, which loads the model weights. The forked workers
+# share those pages copy-on-write, so memory grows by much less than one model per worker.
+import gc
+import os
+import multiprocessing
+
+os.environ["PREFORK_SERVER"] = "1"
+
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("WEB_CONCURRENCY", min(4, multiprocessing.cpu_count())))
+# A few threads per worker keep concurrent requests flowing into the batching predictor
+threads = int(os.environ.get("WORKER_THREADS", 4))
+timeout = int(os.environ.get("WORKER_TIMEOUT", 120))
+preload_app = True
+# Split the CPUs between the workers, by default
+torch_threads = int(os.environ.get("TORCH_THREADS_PER_WORKER", max(1, multiprocessing.cpu_count() // workers)))
+
+
+def when_ready(server):
+    # Move the loaded objects out of the garbage collector's reach, so collections in the workers
+    # do not write to (and un-share) the pages holding them
+    gc.collect()
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    # Threads do not survive a fork, so the batching thread is started in each worker
+    import app
+    app.init_worker(num_threads=torch_threads)
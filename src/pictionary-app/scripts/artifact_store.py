@@ -0,0 +1,220 @@
+import os
+import re
+import time
+import shutil
+import threading
+from collections import OrderedDict
+
+# Namespaces and artifact names are used in URLs and, for the disk store, as paths
+_SEGMENT = re.compile(r"^[A-Za-z0-9_\-][A-Za-z0-9_.\-]*$")
+
+
+def check_key(namespace, name) -> None:
+    """
+    Raise ValueError unless namespace is one path segment and name is one or more path segments, without "..".
+    """
+    if not _SEGMENT.match(namespace) or not all(_SEGMENT.match(part) for part in name.split("/")):
+        raise ValueError(f"Invalid artifact key {namespace!r}/{name!r}")
+
+
+def artifact_url(namespace, name) -> str:
+    return f"/artifacts/{namespace}/{name}"
+
+
+def parse_artifact_url(url):
+    """
+    Split an artifact URL into (namespace, name), or return None when it is not an artifact URL.
+    """
+    match = re.match(r"^\.?/artifacts/([^/]+)/(.+)$", url or "")
+    return (match.group(1), match.group(2)) if match else None
+
+
+class ArtifactStore:
+    """
+    In-memory store of generated files, such as saved drawings and explanation plots, grouped in namespaces
+    (one per player session). Artifacts are served straight from memory. The least recently used artifacts
+    are evicted once the total size exceeds max_bytes, and artifacts expire ttl_seconds after they are written.
+    """
+    def __init__(self, max_bytes=256 * 2**20, ttl_seconds=3600.0):
+        """
+        Args:
+            max_bytes: The maximum total size of the stored artifacts
+            ttl_seconds: How long an artifact is kept after it is written
+        """
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._artifacts = OrderedDict()
+        self._size = 0
+        self._evictions = 0
+        self._lock = threading.Lock()
+
+    def put(self, namespace, name, data, content_type="image/png") -> str:
+        """
+        Store an artifact, replacing any artifact with the same name in the namespace.
+
+        Args:
+            namespace: The namespace, e.g. a session id
+            name: The artifact name, may contain "/"
+            data: The artifact bytes
+            content_type: The MIME type the artifact is served with
+
+        Returns:
+            url: The URL the artifact is served from
+        """
+        check_key(namespace, name)
+        with self._lock:
+            self._remove((namespace, name))
+            self._artifacts[(namespace, name)] = (time.monotonic(), bytes(data), content_type)
+            self._size += len(data)
+            self._evict()
+        return artifact_url(namespace, name)
+
+    def get(self, namespace, name):
+        """
+        Get an artifact as (data, content_type), or None when it is missing or expired.
+        """
+        with self._lock:
+            entry = self._artifacts.get((namespace, name))
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] > self.ttl_seconds:
+                self._remove((namespace, name))
+                return None
+            self._artifacts.move_to_end((namespace, name))
+            return entry[1], entry[2]
+
+    def contains(self, namespace, name) -> bool:
+        return self.get(namespace, name) is not None
+
+    def delete(self, namespace, name) -> None:
+        with self._lock:
+            self._remove((namespace, name))
+
+    def drop_namespace(self, namespace) -> None:
+        """
+        Delete every artifact in a namespace.
+        """
+        with self._lock:
+            for key in [key for key in self._artifacts if key[0] == namespace]:
+                self._remove(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'artifacts': len(self._artifacts), 'bytes': self._size, 'max_bytes': self.max_bytes,
+                    'evictions': self._evictions}
+
+    def _remove(self, key) -> None:
+        entry = self._artifacts.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry[1])
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        while self._artifacts:
+            key, (written, data, _) = next(iter(self._artifacts.items()))
+            if self._size <= self.max_bytes and now - written <= self.ttl_seconds:
+                break
+            self._remove(key)
+            self._evictions += 1
+
+
+class DiskArtifactStore:
+    """
+    ArtifactStore interface backed by a directory, so every worker process of a pre-forking server sees
+    the same artifacts. Reads refresh a file's modification time, and a periodic sweep deletes expired
+    files, then the least recently used ones until the total size is below max_bytes.
+    """
+    def __init__(self, root_dir, max_bytes=1024 * 2**20, ttl_seconds=3600.0, sweep_interval=30.0):
+        """
+        Args:
+            root_dir: The directory holding one folder per namespace
+            max_bytes: The maximum total size of the stored artifacts
+            ttl_seconds: How long an artifact is kept after it was last written or read
+            sweep_interval: The minimum number of seconds between two sweeps
+        """
+        self.root_dir = root_dir
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.sweep_interval = sweep_interval
+        self._last_sweep = 0.0
+        self._evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(root_dir, exist_ok=True)
+
+    def _path(self, namespace, name) -> str:
+        check_key(namespace, name)
+        return os.path.join(self.root_dir, namespace, *name.split("/"))
+
+    def put(self, namespace, name, data, content_type="image/png") -> str:
+        path = self._path(namespace, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so readers never see a partial artifact
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary_path, "wb") as f:
+            f.write(data)
+        os.replace(temporary_path, path)
+        self._maybe_sweep()
+        return artifact_url(namespace, name)
+
+    def get(self, namespace, name):
+        try:
+            path = self._path(namespace, name)
+            if time.time() - os.path.getmtime(path) > self.ttl_seconds:
+                return None
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return data, "image/png" if name.endswith(".png") else "application/octet-stream"
+
+    def contains(self, namespace, name) -> bool:
+        try:
+            return time.time() - os.path.getmtime(self._path(namespace, name)) <= self.ttl_seconds
+        except (OSError, ValueError):
+            return False
+
+    def delete(self, namespace, name) -> None:
+        try:
+            os.remove(self._path(namespace, name))
+        except (OSError, ValueError):
+            pass
+
+    def drop_namespace(self, namespace) -> None:
+        check_key(namespace, "_")
+        shutil.rmtree(os.path.join(self.root_dir, namespace), ignore_errors=True)
+
+    def stats(self) -> dict:
+        files = self._list_files()
+        return {'artifacts': len(files), 'bytes': sum(size for _, _, size in files), 'max_bytes': self.max_bytes,
+                'evictions': self._evictions}
+
+    def _list_files(self) -> list:
+        files = []
+        for directory, _, filenames in os.walk(self.root_dir):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, path, stat.st_size))
+        return files
+
+    def _maybe_sweep(self) -> None:
+        with self._lock:
+            if time.monotonic() - self._last_sweep < self.sweep_interval:
+                return
+            self._last_sweep = time.monotonic()
+        files = sorted(self._list_files())
+        total = sum(size for _, _, size in files)
+        now = time.time()
+        for modified, path, size in files:
+            if total <= self.max_bytes and now - modified <= self.ttl_seconds:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self._evictions += 1
@@ -1,11 +1,15 @@
 import torch
 import math
-import matplotlib
-matplotlib.use('Agg')  # Set the backend before importing pyplot
-import matplotlib.pyplot as plt
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
+from functools import lru_cache
+from PIL import Image
 
 
-def create_feature_map_plot(model, img, layer_name="layer1", filepath='./static/images/feature_maps.png', k=10) -> None:
+def create_feature_map_plot(model, img, layer_name="layer1", filepath='./static/images/feature_maps.png', k=10, activation_cache=None) -> None:
     """
     Create a plot of the feature maps of a specific layer in a PyTorch model.
     
@@ -13,14 +17,95 @@ def create_feature_map_plot(model, img, layer_name="layer1", filepath='./static/
         model: PyTorch model
         img: torch tensor, already preprocessed by input transform
         layer_name: The layer name in the model to get the feature maps from. 
-        filepath: Filepath to save the plot
+        filepath: Filepath or file object to save the plot
         k: Number of feature map channels to display
+        activation_cache: Optional ActivationCache to reuse the forward pass across layers and k
     """
-    feature_maps = get_feature_maps(model, img, layer_name)
+    feature_maps = get_feature_maps(model, img, layer_name, activation_cache)
     show_k_feature_map_channels(feature_maps[0], filepath, k)
 
 
-def get_feature_maps(model, img, layer_name="layer1") -> list:
+@contextmanager
+def capture_activations(model, layer_names, detach=True):
+    """
+    Temporarily register forward hooks on the named layers of a model and collect their outputs.
+    The hooks are removed on exit, and only record forward passes run by the calling thread,
+    so concurrent predictions on the shared model are not affected.
+
+    Args:
+        model: PyTorch model
+        layer_names: The layer names in the model to capture
+        detach: Whether to detach the outputs from the autograd graph, keep them attached to differentiate through them
+
+    Yields:
+        activations: Dictionary of layer name to output, filled by forward passes inside the block
+    """
+    activations = {}
+    thread_id = threading.get_ident()
+    def make_hook(name):
+        def hook_fn(module, input, output):
+            if threading.get_ident() == thread_id:
+                activations[name] = output.detach() if detach else output
+        return hook_fn
+    layer_names = set(layer_names)
+    handles = [layer.register_forward_hook(make_hook(name)) for name, layer in model.named_modules() if name in layer_names]
+    try:
+        yield activations
+    finally:
+        for handle in handles:
+            handle.remove()
+
+
+class ActivationCache:
+    """
+    LRU cache of the layer activations of recent images, keyed by a hash of the image tensor.
+    One forward pass captures every top-level layer, so later requests for another layer or k reuse it.
+    """
+    def __init__(self, max_entries=32):
+        """
+        Args:
+            max_entries: The number of images to keep activations for
+        """
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_activations(self, model, img, layer_names) -> dict:
+        """
+        Get the activations of the named layers for an image, running the model only on a cache miss.
+
+        Args:
+            model: PyTorch model
+            img: torch tensor, already preprocessed by input transform
+            layer_names: The layer names in the model to get the activations of
+
+        Returns:
+            activations: Dictionary of layer name to output
+        """
+        key = hashlib.sha1(img.detach().cpu().numpy().tobytes()).hexdigest()
+        with self._lock:
+            cached = self._entries.get(key, {})
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        if all(name in cached for name in layer_names):
+            return {name: cached[name] for name in layer_names}
+        capture_names = {name for name, _ in model.named_children() if name != "fc"} | set(layer_names)
+        with capture_activations(model, capture_names) as activations:
+            with torch.no_grad():
+                model(img)
+        with self._lock:
+            self._entries[key] = {**cached, **activations}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return {name: activations[name] for name in layer_names}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+def get_feature_maps(model, img, layer_name="layer1", activation_cache=None) -> list:
     """
     Get the feature maps of a specific layer in a PyTorch model.
 
@@ -28,19 +113,65 @@ def get_feature_maps(model, img, layer_name="layer1") -> list:
         model: PyTorch model
         img: torch tensor, already preprocessed by input transform
         layer_name: The layer name in the model to get the feature maps from
+        activation_cache: Optional ActivationCache to reuse a previous forward pass on the same image
 
     Returns:
         feature_maps: List of feature maps
     """
-    feature_maps = []
-    def hook_fn(module, input, output):
-        feature_maps.append(output)
-    for name, layer in model.named_modules():
-        if name == layer_name:
-            layer.register_forward_hook(hook_fn)
-    with torch.no_grad():
-        model(img)
-    return feature_maps
+    if activation_cache is not None:
+        return [activation_cache.get_activations(model, img, [layer_name])[layer_name]]
+    with capture_activations(model, [layer_name]) as activations:
+        with torch.no_grad():
+            model(img)
+    return [activations[layer_name]] if layer_name in activations else []
+
+
+@lru_cache(maxsize=None)
+def viridis_lut() -> np.ndarray:
+    """
+    Get the viridis colormap as a lookup table from 256 intensity levels to RGB.
+
+    Returns:
+        lut: uint8 array of shape (256, 3)
+    """
+    from matplotlib import colormaps
+    return (colormaps["viridis"](np.linspace(0, 1, 256))[:, :3] * 255).round().astype(np.uint8)
+
+
+def render_feature_map_grid(feature_map, k=10, num_columns=5, cell_size=256, padding=8) -> list:
+    """
+    Render the first k channels of one or more feature maps as viridis image grids.
+    Each channel is min-max normalised on its own, like imshow does, with one tensor op for all channels.
+
+    Args:
+        feature_map: Feature map tensor. Shape: (N, C, H, W)
+        k: Number of feature map channels to display
+        num_columns: Maximum number of channels per row
+        cell_size: Approximate size in pixels of each channel, channels are upscaled by a whole factor
+        padding: White space in pixels between channels
+
+    Returns:
+        grids: List of N uint8 RGB arrays
+    """
+    channels = feature_map[:, :k].detach().float().cpu()
+    n, k, h, w = channels.shape
+    # Normalise each channel to [0, 255] and map it through the viridis lookup table
+    low = channels.amin(dim=(2, 3), keepdim=True)
+    high = channels.amax(dim=(2, 3), keepdim=True)
+    levels = ((channels - low) / (high - low).clamp_min(1e-12) * 255).round().to(torch.uint8).numpy()
+    colored = viridis_lut()[levels]
+    scale = max(1, cell_size // max(h, w))
+    colored = colored.repeat(scale, axis=2).repeat(scale, axis=3)
+    # Tile the channels into a grid with white padding
+    num_columns = min(k, num_columns)
+    num_rows = math.ceil(k / num_columns)
+    cell_h, cell_w = h * scale, w * scale
+    grids = np.full((n, num_rows * (cell_h + padding) + padding, num_columns * (cell_w + padding) + padding, 3), 255, dtype=np.uint8)
+    for i in range(k):
+        top = padding + (i // num_columns) * (cell_h + padding)
+        left = padding + (i % num_columns) * (cell_w + padding)
+        grids[:, top:top + cell_h, left:left + cell_w] = colored[:, i]
+    return list(grids)
 
 
 def show_k_feature_map_channels(feature_map, filepath='./static/images/feature_maps.png', k=10) -> None:
@@ -48,29 +179,9 @@ def show_k_feature_map_channels(feature_map, filepath='./static/images/feature_m
     Display the first k feature map channels in a grid.
     
     Args:
-        feature_map: List of feature maps
-        filepath: Filepath to save the plot
+        feature_map: Feature map tensor. Shape: (1, C, H, W)
+        filepath: Filepath or file object to save the plot
         k: Number of feature map channels to display
     """
-    # Calculate rows and columns for subplots
-    num_columns = min(k, 5)  
-    num_rows = math.ceil(k / num_columns)
-    # Adjust figsize based on rows and columns for better visibility
-    fig_width = num_columns * 4  
-    fig_height = num_rows * 3.2  
-    fig, ax = plt.subplots(num_rows, num_columns, figsize=(fig_width, fig_height))
-    # Flatten the axes array for easier iteration if there are multiple axes
-    ax_flat = ax.flat if k > 1 else [ax]
-    # Display the first k feature map channels
-    for i in range(k):
-        # Handle case where k=1 and ax is not an array
-        current_ax = ax_flat[i] if k > 1 else ax
-        # Plot the feature map
-        current_ax.imshow(feature_map[0, i].cpu().numpy(), cmap="viridis")
-        current_ax.axis('off')  # Hide axes ticks
-    for j in range(i + 1, num_rows * num_columns):
-        fig.delaxes(ax_flat[j])
-    plt.tight_layout()
-    plt.savefig(filepath)
-    plt.clf()
-    plt.close()
+    grid = render_feature_map_grid(feature_map[:1], k)[0]
+    Image.fromarray(grid).save(filepath, format="PNG")
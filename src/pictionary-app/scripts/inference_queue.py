@@ -0,0 +1,130 @@
+import time
+import queue
+import threading
+from collections import Counter
+from concurrent.futures import Future
+import numpy as np
+
+
+class BatchingPredictor:
+    """
+    Coalesce concurrent prediction requests into batched forward passes.
+
+    Callers submit single preprocessed images with predict(). A background thread gathers
+    the pending requests, waiting at most max_wait_ms for the batch to fill up to
+    max_batch_size, runs the model once and hands each caller its own row of scores.
+    """
+    def __init__(self, model, max_batch_size=16, max_wait_ms=5.0):
+        """
+        Args:
+            model: Callable mapping a NumPy batch of images to a NumPy batch of scores, e.g. TorchModel or OnnxModel
+            max_batch_size: The maximum number of images scored in one forward pass
+            max_wait_ms: The maximum time to wait for more requests once one has arrived
+        """
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._requests = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._batch_sizes = Counter()
+        self._total_wait = 0.0
+        self._max_wait_seen = 0.0
+        self._num_requests = 0
+        # Requests queued or being scored, background work can wait for it to drop to zero
+        self._pending = 0
+        self._idle = threading.Condition()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def predict(self, image, timeout=30.0) -> np.ndarray:
+        """
+        Score a single image, sharing the forward pass with any concurrent callers.
+
+        Args:
+            image: float32 NumPy array, already normalised. Shape: (1, 3, H, W)
+            timeout: Seconds to wait for the result before raising TimeoutError, None waits forever
+
+        Returns:
+            output: The model output for the image. Shape: (1, num_classes)
+        """
+        future = Future()
+        with self._idle:
+            self._pending += 1
+        future.add_done_callback(self._request_done)
+        self._requests.put((image, time.perf_counter(), future))
+        return future.result(timeout=timeout)
+
+    def wait_idle(self, timeout=None) -> bool:
+        """
+        Block until no prediction is queued or running, so lower priority work can yield to predictions.
+
+        Args:
+            timeout: The maximum number of seconds to wait
+
+        Returns:
+            idle: Whether the predictor became idle before the timeout
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout=timeout)
+
+    def _request_done(self, future) -> None:
+        with self._idle:
+            self._pending -= 1
+            if self._pending == 0:
+                self._idle.notify_all()
+
+    def stats(self) -> dict:
+        """
+        Report the batch-size distribution and the time requests spent queued.
+
+        Returns:
+            stats: Dictionary with the batch size histogram and queue wait times in milliseconds
+        """
+        with self._stats_lock:
+            num_batches = sum(self._batch_sizes.values())
+            return {
+                'requests': self._num_requests,
+                'batches': num_batches,
+                'batch_sizes': dict(sorted(self._batch_sizes.items())),
+                'mean_batch_size': self._num_requests / num_batches if num_batches else 0.0,
+                'mean_queue_wait_ms': 1000 * self._total_wait / self._num_requests if self._num_requests else 0.0,
+                'max_queue_wait_ms': 1000 * self._max_wait_seen,
+            }
+
+    def _collect_batch(self) -> list:
+        """
+        Block until a request arrives, then gather more until the batch is full or the wait expires.
+        """
+        batch = [self._requests.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect_batch()
+            started = time.perf_counter()
+            # Any error, e.g. images of different sizes, is handed to the callers so the thread keeps running
+            try:
+                images = np.concatenate([image for image, _, _ in batch])
+                output = self.model(images)
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            for row, (_, _, future) in enumerate(batch):
+                future.set_result(output[row:row+1])
+            with self._stats_lock:
+                self._batch_sizes[len(batch)] += 1
+                self._num_requests += len(batch)
+                for _, submitted, _ in batch:
+                    wait = started - submitted
+                    self._total_wait += wait
+                    self._max_wait_seen = max(self._max_wait_seen, wait)
@@ -0,0 +1,236 @@
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class QueueFullError(Exception):
+    """
+    Raised when a job is submitted while the maximum number of jobs is already pending.
+    """
+
+
+class Job:
+    """
+    A background job and its result. The job id is the content hash of its inputs.
+    """
+    def __init__(self, job_id, kind):
+        self.job_id = job_id
+        self.kind = kind
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.finished = None
+        self.done = threading.Event()
+
+    def to_dict(self) -> dict:
+        status = {'job_id': self.job_id, 'kind': self.kind, 'status': self.status}
+        if self.result is not None:
+            status['result'] = self.result
+        if self.error is not None:
+            status['error'] = self.error
+        return status
+
+    @classmethod
+    def from_dict(cls, status) -> "Job":
+        """
+        Rebuild a job from its status, e.g. one published by another server process.
+        """
+        job = cls(status['job_id'], status['kind'])
+        job.status = status['status']
+        job.result = status.get('result')
+        job.error = status.get('error')
+        if job.status in ("done", "failed"):
+            job.done.set()
+        return job
+
+
+def job_id_for(kind, params, data=b"") -> str:
+    """
+    Content hash identifying a job, identical requests get the same id.
+
+    Args:
+        kind: The type of job, e.g. "feature_maps"
+        params: JSON serialisable job parameters
+        data: The job's input bytes, e.g. the drawing
+
+    Returns:
+        job_id: Hex digest of the job inputs
+    """
+    digest = hashlib.sha256(kind.encode())
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    digest.update(data)
+    return digest.hexdigest()[:32]
+
+
+class JobQueue:
+    """
+    Bounded pool of worker threads running slow jobs, such as explanation plots, off the request threads.
+
+    Jobs are keyed by the hash of their inputs, so submitting an identical job returns the existing one,
+    queued, running or finished, instead of running it again. Before starting a job the workers wait
+    for interactive work (wait_idle, e.g. the prediction queue) to finish, so it keeps priority.
+
+    With a status_store, every status change is also written there as JSON, so the other processes of a
+    pre-forking server can report, wait for and reuse the jobs run by this one.
+    """
+    def __init__(self, num_workers=1, max_pending=16, max_jobs=256, wait_idle=None, max_idle_wait=2.0,
+                 status_store=None, status_namespace="jobs", stale_seconds=600.0, poll_interval=0.25):
+        """
+        Args:
+            num_workers: The number of jobs run at the same time
+            max_pending: The maximum number of queued or running jobs, further submissions raise QueueFullError
+            max_jobs: The maximum number of jobs remembered, the oldest finished jobs are forgotten first
+            wait_idle: Optional callable taking a timeout, which blocks until higher priority work is done
+            max_idle_wait: The maximum number of seconds a job waits for higher priority work
+            status_store: Optional store shared between processes, e.g. DiskArtifactStore, to publish the job statuses to
+            status_namespace: The store namespace of the job statuses
+            stale_seconds: Seconds after which a queued or running job of another process is presumed lost and run again
+            poll_interval: Seconds between reads of the store while waiting for a job of another process
+        """
+        self.max_pending = max_pending
+        self.max_jobs = max_jobs
+        self.wait_idle = wait_idle
+        self.max_idle_wait = max_idle_wait
+        self.status_store = status_store
+        self.status_namespace = status_namespace
+        self.stale_seconds = stale_seconds
+        self.poll_interval = poll_interval
+        # Threads are only started on the first submission, so the queue can be created before a fork
+        self._executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="job")
+        self._jobs = OrderedDict()
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def submit(self, job_id, kind, fn, *args, **kwargs) -> Job:
+        """
+        Queue fn(*args, **kwargs) unless a job with the same id exists, in this process or in the status store.
+        Failed jobs, and jobs of another process that stopped updating their status, are run again.
+
+        Args:
+            job_id: The content hash of the job inputs, see job_id_for
+            kind: The type of job
+            fn: The function to run, its return value is the job result and must be JSON serialisable
+
+        Returns:
+            job: The new or existing job
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and job.status != "failed":
+                self._jobs.move_to_end(job_id)
+                return job
+        shared = self._read_status(job_id) if job is None else None
+        if shared is not None and shared['status'] != "failed":
+            # Reuse the job of another process, unless it stopped updating its status, e.g. because the process died
+            if shared['status'] == "done" or time.time() - shared['updated'] < self.stale_seconds:
+                return Job.from_dict(shared)
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and job.status != "failed":
+                return job
+            if self._pending >= self.max_pending:
+                raise QueueFullError(f"{self._pending} jobs are already pending")
+            job = Job(job_id, kind)
+            self._jobs[job_id] = job
+            self._pending += 1
+            self._forget_finished()
+        self._publish(job)
+        self._executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def get(self, job_id):
+        """
+        Get a job by id, or None when it is unknown. Jobs of other processes are read from the status store.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return job
+        shared = self._read_status(job_id)
+        return Job.from_dict(shared) if shared is not None else None
+
+    def wait(self, job_id, timeout=None):
+        """
+        Wait until a job has finished or the timeout has passed.
+
+        Returns:
+            job: The job in its latest state, or None when it is unknown
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            job.done.wait(timeout)
+            return job
+        # Run by another process, whose status changes are only seen by polling the store
+        job = self.get(job_id)
+        deadline = time.monotonic() + (timeout if timeout is not None else float("inf"))
+        while job is not None and not job.done.is_set() and time.monotonic() < deadline:
+            time.sleep(min(self.poll_interval, max(deadline - time.monotonic(), 0)))
+            job = self.get(job_id) or job
+        return job
+
+    def discard(self, job_id) -> None:
+        """
+        Forget a finished job, so the next identical submission runs it again, e.g. after its results were evicted.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and job.done.is_set():
+                del self._jobs[job_id]
+            elif job is not None:
+                return
+        if self.status_store is not None:
+            self.status_store.delete(self.status_namespace, f"{job_id}.json")
+
+    def stats(self) -> dict:
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+            return {status: statuses.count(status) for status in ("queued", "running", "done", "failed")}
+
+    def _run(self, job, fn, args, kwargs) -> None:
+        if self.wait_idle is not None:
+            self.wait_idle(self.max_idle_wait)
+        job.status = "running"
+        self._publish(job)
+        try:
+            job.result = fn(*args, **kwargs)
+            job.status = "done"
+        except Exception as e:
+            job.error = repr(e)
+            job.status = "failed"
+        finally:
+            job.finished = time.time()
+            self._publish(job)
+            with self._lock:
+                self._pending -= 1
+            job.done.set()
+
+    def _publish(self, job) -> None:
+        if self.status_store is None:
+            return
+        status = job.to_dict()
+        status['updated'] = time.time()
+        try:
+            self.status_store.put(self.status_namespace, f"{job.job_id}.json", json.dumps(status).encode(), "application/json")
+        except OSError as e:
+            # The job still runs and is reported by this process, only the other processes miss the update
+            print(f"Failed to publish the status of job {job.job_id}: {e!r}")
+
+    def _read_status(self, job_id):
+        if self.status_store is None:
+            return None
+        try:
+            entry = self.status_store.get(self.status_namespace, f"{job_id}.json")
+            return json.loads(entry[0]) if entry is not None else None
+        except ValueError:
+            return None
+
+    def _forget_finished(self) -> None:
+        # Drop the least recently used finished jobs beyond max_jobs, pending jobs are always kept
+        excess = len(self._jobs) - self.max_jobs
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.done.is_set()][:max(excess, 0)]:
+            del self._jobs[job_id]
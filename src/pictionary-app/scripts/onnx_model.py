@@ -0,0 +1,40 @@
+import os
+import numpy as np
+
+
+class OnnxModel:
+    """
+    ONNX Runtime inference backend. Takes a batch of preprocessed images as a NumPy array and returns
+    the class scores as a NumPy array. Only NumPy and onnxruntime are needed, not torch.
+    """
+    def __init__(self, onnx_path, num_threads=None):
+        """
+        Args:
+            onnx_path: Path to a model exported with src/model/export_onnx.py
+            num_threads: Number of intra-op threads. Defaults to the ONNX Runtime default.
+        """
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(onnx_path, sess_options=options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, images) -> np.ndarray:
+        return self.session.run(None, {self.input_name: np.ascontiguousarray(images, dtype=np.float32)})[0]
+
+
+def load_onnx_model(artifact_path=None, num_threads=None) -> OnnxModel:
+    """
+    Load the ONNX model used for predictions.
+
+    Args:
+        artifact_path: Path to the ONNX model. Defaults to the MODEL_ARTIFACT environment variable, then ./models/TL_resnet18.onnx.
+        num_threads: Number of intra-op threads. Defaults to the ONNX_THREADS environment variable.
+
+    Returns:
+        inference_model: OnnxModel
+    """
+    artifact_path = artifact_path or os.environ.get("MODEL_ARTIFACT") or "./models/TL_resnet18.onnx"
+    num_threads = num_threads or int(os.environ.get("ONNX_THREADS", 0))
+    return OnnxModel(artifact_path, num_threads=num_threads)
@@ -1,14 +1,14 @@
+import time
 import torch
+import torch.nn.functional as F
 import numpy as np
-import matplotlib
-matplotlib.use('Agg')  # Set the backend before importing pyplot
-import matplotlib.pyplot as plt
 from torchvision import transforms
 from PIL import Image
+from scripts.feature_maps import capture_activations
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
-def save_n_pixel_importance_images(model, image, target_class, image_transform, n=10) -> list:
+def save_n_pixel_importance_images(model, image, target_class, image_transform, n=10, animation_path=None, method="occlusion", output_dir="./static/images") -> list:
     """
     Save n images, each showing progressively more important pixels for the target class.
 
@@ -18,27 +18,46 @@ def save_n_pixel_importance_images(model, image, target_class, image_transform,
         target_class: The numerical class representation for the image
         image_transform: The transformations to be applied to the image
         n: The number of images to be saved
+        animation_path: Optional path to also save all n images as one animated GIF or PNG
+        method: "occlusion", or a gradient method supported by find_important_pixels_gradient
+        output_dir: The directory to save the images in
 
     Returns:
         filenames: List of filenames for the saved images
     """
-    important_pixels = find_important_pixels(model, image, target_class, image_transform, num_pixel_groups=n)
-    # Convert PIL image to numpy array and get image size
-    image = np.array(image)
-    image_size = image.shape[:2]
-    filenames = []
-    for i in range(n):
-        important_pixel_groups = important_pixels[:i+1]
-        curr_filename = f'./static/images/important_pixels_{i+1}.png'
-        plot_important_pixels_only(image, important_pixel_groups, image_size, filename=curr_filename, highlight=True)
-        filenames.append(curr_filename)
+    frames = important_pixel_frames(model, image, target_class, image_transform, n, method)
+    filenames = [f'{output_dir}/important_pixels_{i+1}.png' for i in range(len(frames))]
+    save_frames(frames, filenames, animation_path=animation_path)
     return filenames
 
 
-def find_important_pixels(model, image, target_class, image_transform, num_pixel_groups=20, k=16) -> list:
+def important_pixel_frames(model, image, target_class, image_transform, n=10, method="occlusion") -> np.ndarray:
+    """
+    Compute n frames, each showing progressively more important pixels for the target class.
+
+    Args:
+        model: The model to be used for prediction
+        image: The UNNORMALIZED image to be used for prediction. Shape: (3, H, W)
+        target_class: The numerical class representation for the image
+        image_transform: The transformations to be applied to the image
+        n: The number of frames
+        method: "occlusion", or a gradient method supported by find_important_pixels_gradient
+
+    Returns:
+        frames: uint8 array of shape (n, H, W, 3)
+    """
+    if method == "occlusion":
+        important_pixels = find_important_pixels(model, image, target_class, image_transform, num_pixel_groups=n)
+    else:
+        important_pixels = find_important_pixels_gradient(model, image, target_class, image_transform, num_pixel_groups=n, method=method)
+    return composite_important_pixel_frames(image, important_pixels, highlight=True)
+
+
+def find_important_pixels(model, image, target_class, image_transform, num_pixel_groups=20, k=16, stride=None, batch_size=64) -> list:
     """
     Find the most important pixels in the image for the target class.
     For each pixel grouping, remove those pixels and check the change in the prediction score.
+    The occluded images are scored in mini-batches rather than one forward pass per pixel group.
 
     Args:
         model: The model to be used for prediction
@@ -46,38 +65,220 @@ def find_important_pixels(model, image, target_class, image_transform, num_pixel
         target_class: The numerical class representation for the image
         image_transform: The transformations to be applied to the image
         num_pixel_groups: The number of important pixel groups to be returned
-        k: The pixel grouping size (k x k pixels will be checked in each iteration)
+        k: The pixel grouping size (k x k pixels will be checked in each iteration).
+           A list of sizes checks every size in the same call.
+        stride: The step between pixel groups. Defaults to k. A list gives one stride per size in k.
+        batch_size: The maximum number of occluded images scored per forward pass
     
     Returns:
         pixel_groups: List of the most important pixels
     """
+    patch_sizes = list(k) if isinstance(k, (list, tuple)) else [k]
+    strides = list(stride) if isinstance(stride, (list, tuple)) else [stride] * len(patch_sizes)
+    if len(strides) != len(patch_sizes):
+        raise ValueError("stride must have one entry per pixel grouping size")
     with torch.no_grad():
         to_tensor = transforms.ToTensor()
         image = to_tensor(image).unsqueeze(0).to(DEVICE)
         # Find the prediction score for the original image
-        output = model(image)
+        output = model(image_transform(image))
         og_score = output[0][target_class].item()
 
+        # Top-left corner and size of every pixel group to occlude
+        occlusions = []
+        for size, step in zip(patch_sizes, strides):
+            step = step or size
+            for i in range(0, image.shape[2], step):
+                for j in range(0, image.shape[3], step):
+                    occlusions.append((i, j, size))
+
         pixel_groups = []
-        # Iterate across the image with step size k
-        for i in range(0, image.shape[2], k):
-            for j in range(0, image.shape[3], k):
-                # Create a copy of the image
-                image_copy = image.clone()
-                # Remove the pixel group and normalize the image
-                image_copy[:, :, i:i+k, j:j+k] = 1
-                image_copy = image_transform(image_copy)
-                # Get the prediction score
-                output = model(image_copy)
-                score_diff = og_score - output[0][target_class].item()
-                # Append the pixel group and the score to the list
-                pixel_groups.append((i, j, score_diff, k))
+        for start in range(0, len(occlusions), batch_size):
+            chunk = occlusions[start:start + batch_size]
+            # Copy the image once per pixel group in the chunk and remove each group
+            image_batch = image.repeat(len(chunk), 1, 1, 1)
+            for b, (i, j, size) in enumerate(chunk):
+                image_batch[b, :, i:i+size, j:j+size] = 1
+            # Score the whole chunk with a single forward pass
+            output = model(image_transform(image_batch))
+            score_diffs = og_score - output[:, target_class]
+            for (i, j, size), score_diff in zip(chunk, score_diffs.tolist()):
+                pixel_groups.append((i, j, score_diff, size))
 
         # Sort the pixel groups by the score difference
         pixel_groups = sorted(pixel_groups, key=lambda x: x[2], reverse=True)
         return pixel_groups[:num_pixel_groups]
 
 
+def compute_saliency(model, image, target_class, image_transform, method="smoothgrad", num_samples=16, noise_level=0.15, layer_name="layer4") -> torch.Tensor:
+    """
+    Compute a saliency map for the target class with a constant number of forward and backward passes.
+
+    Args:
+        model: The model to be used for prediction
+        image: The UNNORMALIZED image tensor. Shape: (1, 3, H, W)
+        target_class: The numerical class representation for the image
+        image_transform: The transformations to be applied to the image
+        method: "gradient" (vanilla gradients), "smoothgrad" (gradients averaged over noisy copies) or "gradcam"
+        num_samples: The number of noisy copies for SmoothGrad, scored in one batch
+        noise_level: The standard deviation of the SmoothGrad noise, relative to the image value range
+        layer_name: The layer used by Grad-CAM
+
+    Returns:
+        saliency: Saliency map of shape (H, W)
+    """
+    if method == "gradient":
+        inputs = image.clone().requires_grad_(True)
+        score = model(image_transform(inputs))[:, target_class].sum()
+        grad, = torch.autograd.grad(score, inputs)
+        return grad[0].abs().amax(dim=0)
+    if method == "smoothgrad":
+        noise = torch.randn((num_samples, *image.shape[1:]), device=image.device) * noise_level * (image.max() - image.min())
+        inputs = (image + noise).requires_grad_(True)
+        score = model(image_transform(inputs))[:, target_class].sum()
+        grad, = torch.autograd.grad(score, inputs)
+        return grad.abs().mean(dim=0).amax(dim=0)
+    if method == "gradcam":
+        if layer_name not in dict(model.named_modules()):
+            raise ValueError(f"Unknown layer {layer_name!r}")
+        # Only this thread's forward pass is recorded, the model may be shared with the prediction thread
+        with capture_activations(model, [layer_name], detach=False) as activations:
+            score = model(image_transform(image))[:, target_class].sum()
+        grad, = torch.autograd.grad(score, activations[layer_name])
+        # Weight each channel by its average gradient, then upsample the class activation map to the image
+        weights = grad.mean(dim=(2, 3), keepdim=True)
+        cam = torch.relu((weights * activations[layer_name]).sum(dim=1, keepdim=True))
+        return F.interpolate(cam, size=image.shape[2:], mode="bilinear", align_corners=False)[0, 0]
+    raise ValueError(f"Unknown saliency method {method!r}, expected 'gradient', 'smoothgrad' or 'gradcam'")
+
+
+def saliency_to_pixel_groups(saliency, num_pixel_groups=20, k=16, stride=None) -> list:
+    """
+    Rank k x k pixel groups by their total saliency, in the format returned by find_important_pixels.
+
+    Args:
+        saliency: Saliency map of shape (H, W)
+        num_pixel_groups: The number of important pixel groups to be returned
+        k: The pixel grouping size
+        stride: The step between pixel groups. Defaults to k.
+
+    Returns:
+        pixel_groups: List of (i, j, score, k) tuples for the most important pixel groups
+    """
+    stride = stride or k
+    height, width = saliency.shape
+    # Pad so the groups along the bottom and right edges are summed over the pixels they cover
+    padded = F.pad(saliency[None, None], (0, k, 0, k))
+    group_scores = F.avg_pool2d(padded, k, stride=stride)[0, 0] * k * k
+    group_scores = group_scores[:len(range(0, height, stride)), :len(range(0, width, stride))]
+    num_pixel_groups = min(num_pixel_groups, group_scores.numel())
+    scores, indices = group_scores.flatten().topk(num_pixel_groups)
+    num_columns = group_scores.shape[1]
+    return [((index // num_columns) * stride, (index % num_columns) * stride, score, k)
+            for index, score in zip(indices.tolist(), scores.tolist())]
+
+
+def find_important_pixels_gradient(model, image, target_class, image_transform, num_pixel_groups=20, k=16, method="smoothgrad", **saliency_kwargs) -> list:
+    """
+    Find the most important pixels in the image for the target class from a gradient-based saliency map.
+    Returns the same pixel groups format as find_important_pixels, at a fixed cost of a few forward and backward passes.
+
+    Args:
+        model: The model to be used for prediction
+        image: The UNNORMALIZED image to be used for prediction. Shape: (3, H, W)
+        target_class: The numerical class representation for the image
+        image_transform: The transformations to be applied to the image
+        num_pixel_groups: The number of important pixel groups to be returned
+        k: The pixel grouping size
+        method: "gradient", "smoothgrad" or "gradcam"
+        saliency_kwargs: Extra arguments for compute_saliency
+
+    Returns:
+        pixel_groups: List of the most important pixels
+    """
+    image = transforms.ToTensor()(image).unsqueeze(0).to(DEVICE)
+    saliency = compute_saliency(model, image, target_class, image_transform, method=method, **saliency_kwargs)
+    return saliency_to_pixel_groups(saliency.detach(), num_pixel_groups=num_pixel_groups, k=k)
+
+
+def benchmark_explanation_methods(model, image, target_class, image_transform, methods=("occlusion", "gradient", "smoothgrad", "gradcam"), repeats=5) -> dict:
+    """
+    Measure the latency of each explanation method on one image.
+
+    Args:
+        model: The model to be used for prediction
+        image: The UNNORMALIZED image to be used for prediction. Shape: (3, H, W)
+        target_class: The numerical class representation for the image
+        image_transform: The transformations to be applied to the image
+        methods: The methods to compare
+        repeats: The number of timed runs per method, after one warm-up run
+
+    Returns:
+        latencies: Dictionary of method to mean latency in milliseconds
+    """
+    latencies = {}
+    for method in methods:
+        if method == "occlusion":
+            explain = lambda: find_important_pixels(model, image, target_class, image_transform)
+        else:
+            explain = lambda: find_important_pixels_gradient(model, image, target_class, image_transform, method=method)
+        explain()
+        start = time.perf_counter()
+        for _ in range(repeats):
+            explain()
+        latencies[method] = 1000 * (time.perf_counter() - start) / repeats
+    return latencies
+
+
+def composite_important_pixel_frames(original_image, important_pixel_groups, highlight=True) -> np.ndarray:
+    """
+    Build every progressive frame of the important pixel groups at once.
+    Frame i shows only the first i+1 pixel groups, with all other pixels set to white.
+
+    Args:
+        original_image: The original image as a PIL Image or an RGB uint8 array.
+        important_pixel_groups: A list of tuples (i, j, score_diff, k), ordered from most to least important.
+        highlight: Whether to highlight the background of the important pixels.
+
+    Returns:
+        frames: uint8 array of shape (len(important_pixel_groups), H, W, 3)
+    """
+    original_image = np.asarray(original_image, dtype=np.uint8)
+    height, width = original_image.shape[:2]
+    num_frames = len(important_pixel_groups)
+    # The first frame in which each pixel is shown. Pixels outside every group are never shown.
+    first_frame = np.full((height, width), num_frames, dtype=np.int32)
+    for frame, (i, j, _, k) in enumerate(important_pixel_groups):
+        np.minimum(first_frame[i:i+k, j:j+k], frame, out=first_frame[i:i+k, j:j+k])
+    shown_image = original_image.copy()
+    if highlight:
+        # Pixels without any zero channel (the background) are shown light grey
+        shown_image[np.all(original_image != 0, axis=-1)] = 240
+    # Cumulative mask of the pixels visible in each frame
+    masks = first_frame[np.newaxis] <= np.arange(num_frames)[:, np.newaxis, np.newaxis]
+    return np.where(masks[..., np.newaxis], shown_image[np.newaxis], np.uint8(255))
+
+
+def save_frames(frames, filenames, scale=4, animation_path=None, frame_duration=200) -> None:
+    """
+    Save frames as PNGs and optionally as one animation.
+
+    Args:
+        frames: uint8 array of shape (N, H, W, 3)
+        filenames: The filename or file object for each frame, or None to only save the animation
+        scale: Whole factor to upscale the frames by, with nearest neighbour so the pixels stay sharp
+        animation_path: Optional path for an animated GIF or PNG of all frames
+        frame_duration: The duration of each animation frame in milliseconds
+    """
+    frames = frames.repeat(scale, axis=1).repeat(scale, axis=2)
+    images = [Image.fromarray(frame) for frame in frames]
+    if filenames is not None:
+        for image, filename in zip(images, filenames):
+            image.save(filename, format="PNG")
+    if animation_path is not None and images:
+        images[0].save(animation_path, save_all=True, append_images=images[1:], duration=frame_duration, loop=0)
+
+
 def plot_important_pixels_only(original_image, important_pixel_groups, image_size, filename, highlight=True):
     """
     Plot an image showing only the most important pixel groups, setting all other pixels to white.
@@ -92,30 +293,8 @@ def plot_important_pixels_only(original_image, important_pixel_groups, image_siz
         filename: The filename to save the image as.
         highlight: Whether to highlight the background of the important pixels.
     """
-    # Initialize a blank white image
-    new_image_array = np.ones((image_size[1], image_size[0], 3), dtype=np.uint8) * 255
-    original_image = np.array(original_image)
-
-    # Process each important pixel group
-    for group in important_pixel_groups:
-        i, j, _, k = group
-        # Loop over each pixel in the pixel group and set it in the new image
-        for dx in range(k):
-            for dy in range(k):
-                # Make sure we don't go out of bounds
-                if i+dx < image_size[1] and j+dy < image_size[0]:
-                    if highlight and original_image[i+dx, j+dy].all() == 1:
-                        new_image_array[i+dx, j+dy] = 240
-                    else:
-                        new_image_array[i+dx, j+dy] = original_image[i+dx, j+dy]
-
-    # Convert the array back to an image
-    new_image = Image.fromarray(new_image_array)
-    
-    # Display the image
-    plt.figure(figsize=(5, 5))
-    plt.imshow(new_image)
-    plt.axis('off') 
-    plt.savefig(filename)
-    plt.clf()
-    plt.close()
+    original_image = np.asarray(original_image, dtype=np.uint8)[:image_size[1], :image_size[0]]
+    frames = composite_important_pixel_frames(original_image, important_pixel_groups, highlight=highlight)
+    if len(frames) == 0:
+        frames = np.full((1, *original_image.shape), 255, dtype=np.uint8)
+    save_frames(frames[-1:], [filename])
@@ -0,0 +1,97 @@
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+class PredictionCache:
+    """
+    LRU cache of prediction results keyed by a hash of the decoded canvas pixels, with a time-to-live.
+
+    By default only identical canvases share an entry. With perceptual hashing, canvases whose
+    downscaled ink layout is the same (e.g. a few pixels drawn since the last poll) share an entry too.
+    """
+    def __init__(self, max_entries=1024, ttl_seconds=300.0, perceptual=False, hash_size=16, ink_threshold=0.02):
+        """
+        Args:
+            max_entries: The maximum number of cached results, which bounds the memory footprint
+            ttl_seconds: How long a cached result stays valid
+            perceptual: Whether to key on a perceptual hash instead of the exact pixels
+            hash_size: The perceptual hash grid size, the hash has hash_size x hash_size bits
+            ink_threshold: The fraction of drawn pixels above which a perceptual hash cell is set
+        """
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.perceptual = perceptual
+        self.hash_size = hash_size
+        self.ink_threshold = ink_threshold
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def key(self, pixels) -> str:
+        """
+        Compute the cache key of a canvas.
+
+        Args:
+            pixels: uint8 array of shape (H, W, 3)
+
+        Returns:
+            key: Hex digest identifying the canvas
+        """
+        if not self.perceptual:
+            return hashlib.blake2b(np.ascontiguousarray(pixels).tobytes(), digest_size=16).hexdigest()
+        # Fraction of drawn pixels in each cell of a hash_size x hash_size grid
+        height, width = pixels.shape[:2]
+        drawn = np.any(pixels < 250, axis=2)
+        rows = np.linspace(0, height, self.hash_size + 1).astype(int)
+        columns = np.linspace(0, width, self.hash_size + 1).astype(int)
+        ink = np.add.reduceat(np.add.reduceat(drawn, rows[:-1], axis=0), columns[:-1], axis=1)
+        cell_area = np.outer(np.diff(rows), np.diff(columns))
+        bits = ink / cell_area > self.ink_threshold
+        return "p" + np.packbits(bits).tobytes().hex()
+
+    def get(self, key):
+        """
+        Get a cached result, or None when it is missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl_seconds:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[1]
+
+    def put(self, key, result) -> None:
+        """
+        Store a result, evicting the least recently used entries beyond max_entries.
+        """
+        with self._lock:
+            self._entries[key] = (time.monotonic(), result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def stats(self) -> dict:
+        """
+        Report the cache size and hit rate.
+        """
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'hit_rate': self._hits / lookups if lookups else 0.0,
+            }
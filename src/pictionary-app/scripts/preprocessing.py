@@ -0,0 +1,108 @@
+import threading
+from io import BytesIO
+import numpy as np
+from PIL import Image
+
+
+class CanvasPreprocessor:
+    """
+    Fast path from encoded canvas bytes to a normalised model input.
+
+    ToTensor and Normalize are fused into one NumPy multiply-add written into a reusable per-thread input
+    buffer, so no arrays are allocated per request and serving does not need torch.
+    The canvas can optionally be cropped to the bounding box of the drawing before it is resized.
+    """
+    def __init__(self, image_size=(128, 128), crop_to_content=False, margin=4, background_threshold=250,
+                 mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+        """
+        Args:
+            image_size: The (height, width) of the model input
+            crop_to_content: Whether to crop the canvas to a square around the drawn pixels
+            margin: The number of background pixels kept around the drawing when cropping
+            background_threshold: Pixels with every channel at or above this value count as background
+            mean: The normalisation mean per channel
+            std: The normalisation standard deviation per channel
+        """
+        self.image_size = image_size
+        self.crop_to_content = crop_to_content
+        self.margin = margin
+        self.background_threshold = background_threshold
+        std = np.array(std, dtype=np.float32).reshape(3, 1, 1)
+        mean = np.array(mean, dtype=np.float32).reshape(3, 1, 1)
+        # (x / 255 - mean) / std == x * scale + bias
+        self.scale = 1 / (255 * std)
+        self.bias = -mean / std
+        self._buffers = threading.local()
+
+    def decode(self, data) -> np.ndarray:
+        """
+        Decode an encoded image into an RGB uint8 array of the model input size.
+
+        Args:
+            data: The encoded image bytes, e.g. a PNG
+
+        Returns:
+            pixels: uint8 array of shape (H, W, 3)
+        """
+        image = Image.open(BytesIO(data)).convert("RGB")
+        if self.crop_to_content:
+            image = self._crop(image)
+        height, width = self.image_size
+        if image.size != (width, height):
+            image = image.resize((width, height), Image.NEAREST)
+        return np.asarray(image)
+
+    def _crop(self, image):
+        pixels = np.asarray(image)
+        drawn = np.any(pixels < self.background_threshold, axis=2)
+        rows = np.flatnonzero(drawn.any(axis=1))
+        columns = np.flatnonzero(drawn.any(axis=0))
+        if len(rows) == 0:
+            return image
+        # Square box around the drawing so the aspect ratio is kept when resizing, areas outside the canvas are white
+        center_y = (rows[0] + rows[-1] + 1) / 2
+        center_x = (columns[0] + columns[-1] + 1) / 2
+        half = max(rows[-1] + 1 - rows[0], columns[-1] + 1 - columns[0]) / 2 + self.margin
+        left, top = int(round(center_x - half)), int(round(center_y - half))
+        size = int(round(2 * half))
+        cropped = Image.new("RGB", (size, size), (255, 255, 255))
+        cropped.paste(image, (-left, -top))
+        return cropped
+
+    def _get_buffers(self):
+        """
+        Get this thread's reusable input buffer, creating it on first use.
+        """
+        buffers = self._buffers
+        if not hasattr(buffers, "input"):
+            buffers.input = np.empty((1, 3, *self.image_size), dtype=np.float32)
+        return buffers
+
+    def normalize(self, pixels) -> np.ndarray:
+        """
+        Normalise decoded pixels into the model input.
+        The returned array is a per-thread buffer, overwritten by the next call from the same thread.
+
+        Args:
+            pixels: uint8 array of shape (H, W, 3), as returned by decode
+
+        Returns:
+            image: Normalised float32 array. Shape: (1, 3, H, W)
+        """
+        image = self._get_buffers().input
+        # Channels-first view of the pixels, scaled and shifted in place in the input buffer
+        np.multiply(pixels.transpose(2, 0, 1), self.scale, out=image[0])
+        np.add(image[0], self.bias, out=image[0])
+        return image
+
+    def __call__(self, data) -> np.ndarray:
+        """
+        Decode and normalise an encoded image, see normalize.
+
+        Args:
+            data: The encoded image bytes, e.g. a PNG
+
+        Returns:
+            image: Normalised float32 array. Shape: (1, 3, H, W)
+        """
+        return self.normalize(self.decode(data))
@@ -1,11 +1,39 @@
+import os
+import argparse
+import numpy as np
 import torch
 from torchvision import transforms, models
 from collections import OrderedDict
+from PIL import Image
+
+
+def build_model(device):
+    """
+    Build the ResNet18 architecture with the custom classifier, without any weights.
+    The ImageNet weights are not loaded since the fine-tuned state dict overwrites every parameter.
+
+    Args:
+        device: torch device
+
+    Returns:
+        model: torch model
+    """
+    model = models.resnet18(weights=None)
+    classifier = torch.nn.Sequential(OrderedDict([
+        ('fc1', torch.nn.Linear(512, 256)),
+        ('relu', torch.nn.ReLU()),
+        ('fc2', torch.nn.Linear(256, 10)),
+        ('output', torch.nn.Softmax(dim=1))
+    ]))
+    model.fc = classifier
+    return model.to(device)
 
 
 def load_model():
     """
     Load the model and return it along with the device and input transform.
+    The weights are read from MODEL_WEIGHTS, by default ./models/TL_resnet18.pth. They are not kept in git,
+    copy the state dict saved by src/model/resnet18.py there, either of the custom model or of its inner ResNet.
 
     Returns:
         model: torch model
@@ -25,15 +53,158 @@ def load_model():
                         mean=[0.485, 0.456, 0.406],
                         std=[0.229, 0.224, 0.225])
                     ])
-    model = models.resnet18(weights="DEFAULT")
-    classifier = torch.nn.Sequential(OrderedDict([
-        ('fc1', torch.nn.Linear(512, 256)),
-        ('relu', torch.nn.ReLU()),
-        ('fc2', torch.nn.Linear(256, 10)),
-        ('output', torch.nn.Softmax(dim=1))
-    ]))
-    model.fc = classifier
-    model = model.to(device)
-    model.load_state_dict(torch.load("./models/TL_resnet18.pth", map_location=device))
+    model = build_model(device)
+    weights_path = os.environ.get("MODEL_WEIGHTS", "./models/TL_resnet18.pth")
+    if not os.path.exists(weights_path):
+        raise FileNotFoundError(f"Model weights not found at {weights_path}, copy the trained weights there or set MODEL_WEIGHTS")
+    state_dict = torch.load(weights_path, map_location=device)
+    # State dicts saved from CustomResNet18 prefix the parameters of the inner ResNet with "model."
+    if all(key.startswith("model.") for key in state_dict):
+        state_dict = {key[len("model."):]: value for key, value in state_dict.items()}
+    model.load_state_dict(state_dict)
     model.eval()
     return model, device, base_transform, normalize_transform
+
+
+class TorchModel:
+    """
+    Adapts a torch model, or TorchScript module, to the NumPy interface of the ONNX backend.
+    Takes a batch of preprocessed images as a NumPy array and returns the class scores as a NumPy array.
+    """
+    def __init__(self, model, device):
+        """
+        Args:
+            model: torch model or TorchScript module, in eval mode
+            device: torch device the model lives on
+        """
+        self.model = model
+        self.device = device
+
+    def __call__(self, images) -> np.ndarray:
+        with torch.no_grad():
+            return self.model(torch.from_numpy(images).to(self.device)).cpu().numpy()
+
+
+def load_inference_model(model, device, backend=None, artifact_path=None, num_threads=None):
+    """
+    Load the model used for predictions, using the configured backend.
+    The eager model is still needed for feature maps and pixel importance, which hook into its layers.
+
+    Args:
+        model: The eager torch model, used by the "torch" backend when no artifact is configured
+        device: torch device
+        backend: "torch" or "onnx". Defaults to the MODEL_BACKEND environment variable, then "torch".
+        artifact_path: Optional path to a TorchScript artifact created by export_optimized_model, or to the
+                       ONNX model for the "onnx" backend. Defaults to the MODEL_ARTIFACT environment variable.
+        num_threads: Number of intra-op threads for the "onnx" backend. Defaults to the ONNX_THREADS environment variable.
+
+    Returns:
+        inference_model: TorchModel or OnnxModel, both taking and returning NumPy arrays
+    """
+    backend = backend or os.environ.get("MODEL_BACKEND", "torch")
+    artifact_path = artifact_path or os.environ.get("MODEL_ARTIFACT")
+    if backend == "onnx":
+        from scripts.onnx_model import load_onnx_model
+        return load_onnx_model(artifact_path, num_threads)
+    if backend != "torch":
+        raise ValueError(f"Unknown model backend {backend!r}, expected 'torch' or 'onnx'")
+    if not artifact_path:
+        return TorchModel(model, device)
+    inference_model = torch.jit.load(artifact_path, map_location=device)
+    # Graph optimisations such as operator fusion are not serializable, so they are applied after loading
+    return TorchModel(torch.jit.optimize_for_inference(inference_model), device)
+
+
+def optimize_model(model, mode="traced", image_size=(128, 128)):
+    """
+    Create an optimised TorchScript version of a model for CPU inference.
+
+    Args:
+        model: The fp32 torch model, in eval mode
+        mode: "traced" (traced and frozen, which folds batch norm into the convolutions),
+              "channels_last" (traced and frozen with channels-last memory format)
+              or "dynamic_int8" (int8 dynamic quantization of the linear layers, then traced and frozen)
+        image_size: The input size used to trace the model
+
+    Returns:
+        optimized_model: TorchScript module
+    """
+    if mode not in ("traced", "channels_last", "dynamic_int8"):
+        raise ValueError(f"Unknown mode {mode!r}, expected 'traced', 'channels_last' or 'dynamic_int8'")
+    model = model.cpu().eval()
+    example_input = torch.rand(1, 3, *image_size)
+    if mode == "channels_last":
+        model = model.to(memory_format=torch.channels_last)
+        example_input = example_input.to(memory_format=torch.channels_last)
+    if mode == "dynamic_int8":
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    with torch.no_grad():
+        traced_model = torch.jit.trace(model, example_input)
+        return torch.jit.freeze(traced_model)
+
+
+def evaluate_accuracy(model, data_root_dir, input_transform, batch_size=64) -> float:
+    """
+    Compute the accuracy of a model on an image folder dataset.
+    The class folders sorted by name give the label order used by the app.
+
+    Args:
+        model: torch model
+        data_root_dir: The root directory containing one folder of images per class
+        input_transform: The transformations to be applied to each image
+        batch_size: The number of images per forward pass
+
+    Returns:
+        accuracy: The fraction of correctly predicted images
+    """
+    samples = []
+    for label, category in enumerate(sorted(os.listdir(data_root_dir))):
+        category_path = os.path.join(data_root_dir, category)
+        samples.extend((os.path.join(category_path, name), label) for name in os.listdir(category_path))
+    correct = 0
+    with torch.no_grad():
+        for start in range(0, len(samples), batch_size):
+            batch = samples[start:start + batch_size]
+            images = torch.stack([input_transform(Image.open(path).convert("RGB")) for path, _ in batch])
+            labels = torch.tensor([label for _, label in batch])
+            correct += (model(images).argmax(dim=1) == labels).sum().item()
+    return correct / len(samples)
+
+
+def export_optimized_model(model, output_path, data_root_dir, input_transform, mode="traced", max_accuracy_drop=0.01) -> float:
+    """
+    Export an optimised artifact of the model, gated by its accuracy against the fp32 model.
+    The artifact is only written when its accuracy is at most max_accuracy_drop below the fp32 accuracy.
+
+    Args:
+        model: The fp32 torch model, in eval mode
+        output_path: The path to save the TorchScript artifact to
+        data_root_dir: The root directory of the images used for the accuracy check
+        input_transform: The transformations to be applied to each image
+        mode: The optimisation mode, see optimize_model
+        max_accuracy_drop: The maximum allowed accuracy drop compared to the fp32 model
+
+    Returns:
+        accuracy: The accuracy of the exported artifact
+    """
+    model = model.cpu().eval()
+    optimized_model = optimize_model(model, mode)
+    fp32_accuracy = evaluate_accuracy(model, data_root_dir, input_transform)
+    accuracy = evaluate_accuracy(optimized_model, data_root_dir, input_transform)
+    if accuracy < fp32_accuracy - max_accuracy_drop:
+        raise ValueError(f"{mode} artifact accuracy {accuracy:.4f} is more than {max_accuracy_drop} below the fp32 accuracy {fp32_accuracy:.4f}")
+    torch.jit.save(optimized_model, output_path)
+    return accuracy
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export an optimised CPU inference artifact of the model.")
+    parser.add_argument("--mode", default="traced", choices=["traced", "channels_last", "dynamic_int8"])
+    parser.add_argument("--output", default=None, help="Defaults to ./models/TL_resnet18_<mode>.pt")
+    parser.add_argument("--data", default="../../data", help="Image folders used for the accuracy check")
+    parser.add_argument("--max-accuracy-drop", type=float, default=0.01)
+    args = parser.parse_args()
+    model, device, input_transform, normalize_transform = load_model()
+    output_path = args.output or f"./models/TL_resnet18_{args.mode}.pt"
+    accuracy = export_optimized_model(model, output_path, args.data, input_transform, args.mode, args.max_accuracy_drop)
+    print(f"Saved {output_path} with accuracy {accuracy:.4f}")
@@ -0,0 +1,343 @@
+import io
+import os
+import re
+import json
+import time
+import zlib
+import fcntl
+import secrets
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+import numpy as np
+
+# Bounds on client input, so one request cannot make the server allocate or paint without limit
+MAX_BRUSH_SIZE = 16
+# Painted in chunks of at most this many brush cells, so memory use does not grow with the request
+CHUNK_CELLS = 16384
+
+
+class CanvasSession:
+    """
+    Server-side copy of one player's canvas, updated from stroke deltas.
+
+    Tracks which pixels changed since the last inference, so the caller can skip re-running
+    the model until the drawing has changed enough.
+    """
+    def __init__(self, image_size=(128, 128)):
+        """
+        Args:
+            image_size: The (height, width) of the canvas, which matches the model input
+        """
+        self.pixels = np.full((*image_size, 3), 255, dtype=np.uint8)
+        self.dirty = np.zeros(image_size, dtype=bool)
+        self.result = None
+        self.last_inference = float("-inf")
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+
+    def clear(self) -> None:
+        """
+        Reset the canvas to white. The next update always runs inference.
+        """
+        self.pixels.fill(255)
+        self.dirty.fill(False)
+        self.result = None
+
+    def apply_strokes(self, strokes, max_points=None, max_cells=None) -> int:
+        """
+        Paint stroke deltas onto the canvas, the same way the client paints its grid.
+
+        Args:
+            strokes: List of dicts with "points" ([[row, col], ...]), "color" ("#rrggbb" or [r, g, b])
+                     and optionally "size", the brush width in cells (default 1, clamped to 1..MAX_BRUSH_SIZE)
+            max_points: The maximum total number of points, defaults to the number of canvas cells so a
+                        whole canvas can be resent one cell per point
+            max_cells: The maximum total number of cells painted by the brushes, defaults to 4 times the canvas cells
+
+        Returns:
+            changed_pixels: The number of pixels changed since the last inference
+        """
+        height, width = self.dirty.shape
+        max_points = max_points or height * width
+        max_cells = max_cells or 4 * height * width
+        # Check and parse everything first, so an invalid request leaves the canvas unchanged
+        num_points = sum(len(stroke["points"]) for stroke in strokes)
+        if num_points > max_points:
+            raise ValueError(f"Too many points: {num_points} > {max_points}")
+        parsed = []
+        for stroke in strokes:
+            points = np.asarray(stroke["points"], dtype=np.int64).reshape(-1, 2)
+            size = min(max(int(stroke.get("size", 1)), 1), MAX_BRUSH_SIZE)
+            parsed.append((points, parse_color(stroke.get("color", "#000000")), size))
+        num_cells = sum(len(points) * (size // 2 * 2 + 1) ** 2 for points, _, size in parsed)
+        if num_cells > max_cells:
+            raise ValueError(f"Too many brush cells: {num_cells} > {max_cells}")
+        for points, color, size in parsed:
+            # Square brush centered on each point, as in the client's activateCell
+            offset = size // 2
+            steps = np.arange(-offset, offset + 1)
+            chunk_size = max(CHUNK_CELLS // len(steps) ** 2, 1)
+            for start in range(0, len(points), chunk_size):
+                chunk = points[start:start + chunk_size]
+                shape = (len(chunk), len(steps), len(steps))
+                rows = np.broadcast_to(chunk[:, 0, None, None] + steps[None, :, None], shape).ravel()
+                columns = np.broadcast_to(chunk[:, 1, None, None] + steps[None, None, :], shape).ravel()
+                inside = (rows >= 0) & (rows < height) & (columns >= 0) & (columns < width)
+                rows, columns = rows[inside], columns[inside]
+                self.dirty[rows, columns] |= np.any(self.pixels[rows, columns] != color, axis=1)
+                self.pixels[rows, columns] = color
+        return int(self.dirty.sum())
+
+    def needs_inference(self, min_changed_pixels=0, debounce_seconds=0.0) -> bool:
+        """
+        Whether the canvas has changed enough since the last inference, and the debounce interval has passed.
+        """
+        if self.result is None:
+            return True
+        if time.monotonic() - self.last_inference < debounce_seconds:
+            return False
+        changed_pixels = int(self.dirty.sum())
+        return changed_pixels > 0 and changed_pixels >= min_changed_pixels
+
+    def set_result(self, result) -> None:
+        """
+        Record an inference result for the current canvas.
+        """
+        self.result = result
+        self.dirty.fill(False)
+        self.last_inference = time.monotonic()
+
+    def to_bytes(self) -> bytes:
+        """
+        Serialize the canvas, its changed pixels and the last result, e.g. to share the session between processes.
+        """
+        buffer = io.BytesIO()
+        np.savez(buffer, pixels=self.pixels, dirty=self.dirty, result=json.dumps(self.result),
+                 last_inference=self.last_inference)
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data) -> "CanvasSession":
+        arrays = np.load(io.BytesIO(data), allow_pickle=False)
+        session = cls(arrays["pixels"].shape[:2])
+        session.pixels[:] = arrays["pixels"]
+        session.dirty[:] = arrays["dirty"]
+        result = json.loads(str(arrays["result"]))
+        session.result = tuple(result) if result is not None else None
+        session.last_inference = float(arrays["last_inference"])
+        return session
+
+
+def parse_color(color) -> np.ndarray:
+    """
+    Convert a "#rgb"/"#rrggbb" string or an [r, g, b] list into a uint8 array.
+    """
+    if isinstance(color, str):
+        color = color.lstrip("#")
+        if len(color) == 3:
+            color = "".join(channel * 2 for channel in color)
+        if len(color) != 6:
+            raise ValueError(f"Invalid color {color!r}")
+        color = [int(color[i:i + 2], 16) for i in (0, 2, 4)]
+    color = np.asarray(color)
+    if color.shape != (3,) or color.min() < 0 or color.max() > 255:
+        raise ValueError(f"Invalid color {color.tolist()!r}")
+    return color.astype(np.uint8)
+
+
+class StrokeSessionStore:
+    """
+    Bounded store of canvas sessions. The least recently used sessions are dropped beyond
+    max_sessions, and idle sessions expire after ttl_seconds.
+    """
+    def __init__(self, max_sessions=256, ttl_seconds=900.0, image_size=(128, 128)):
+        """
+        Args:
+            max_sessions: The maximum number of live sessions
+            ttl_seconds: How long an idle session is kept
+            image_size: The (height, width) of each canvas
+        """
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.image_size = image_size
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self) -> str:
+        """
+        Start a new session with a blank canvas.
+
+        Returns:
+            session_id: The id used to send strokes to the session
+        """
+        session_id = secrets.token_urlsafe(16)
+        with self._lock:
+            self._expire()
+            self._sessions[session_id] = CanvasSession(self.image_size)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        return session_id
+
+    def get(self, session_id):
+        """
+        Get a session, or None when it does not exist or has expired.
+        """
+        with self._lock:
+            self._expire()
+            session = self._sessions.get(session_id)
+            if session is not None:
+                session.last_used = time.monotonic()
+                self._sessions.move_to_end(session_id)
+            return session
+
+    @contextmanager
+    def session(self, session_id):
+        """
+        Use a session while holding its lock, yielding None when it does not exist or has expired.
+        """
+        session = self.get(session_id)
+        if session is None:
+            yield None
+            return
+        with session.lock:
+            yield session
+
+    def delete(self, session_id) -> bool:
+        """
+        End a session, returning whether it existed.
+        """
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _expire(self) -> None:
+        # Sessions are ordered by last use, so expired ones are at the front
+        now = time.monotonic()
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if now - session.last_used <= self.ttl_seconds:
+                break
+            del self._sessions[session_id]
+
+
+class DiskStrokeSessionStore:
+    """
+    StrokeSessionStore interface backed by a directory, so every worker process of a pre-forking server can
+    update the same sessions. Each session is a file, used under an exclusive file lock shared with the
+    sessions hashed to the same lock stripe. Idle sessions expire after ttl_seconds, and the least recently
+    used ones are deleted beyond max_sessions when a session is created.
+    """
+    def __init__(self, root_dir, max_sessions=256, ttl_seconds=900.0, image_size=(128, 128), num_lock_stripes=64):
+        """
+        Args:
+            root_dir: The directory holding the sessions
+            max_sessions: The maximum number of live sessions
+            ttl_seconds: How long an idle session is kept
+            image_size: The (height, width) of each canvas
+            num_lock_stripes: The number of lock files, which are never deleted
+        """
+        self.root_dir = root_dir
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.image_size = image_size
+        self.num_lock_stripes = num_lock_stripes
+        os.makedirs(os.path.join(root_dir, "locks"), exist_ok=True)
+
+    def create(self) -> str:
+        """
+        Start a new session with a blank canvas.
+
+        Returns:
+            session_id: The id used to send strokes to the session
+        """
+        self._expire()
+        session_id = secrets.token_urlsafe(16)
+        with self._locked(session_id):
+            self._save(session_id, CanvasSession(self.image_size))
+        return session_id
+
+    @contextmanager
+    def session(self, session_id):
+        """
+        Use a session while holding its lock, yielding None when it does not exist or has expired.
+        Changes to the session are saved when the block exits.
+        """
+        path = self._path(session_id)
+        if path is None:
+            yield None
+            return
+        with self._locked(session_id):
+            try:
+                if time.time() - os.path.getmtime(path) > self.ttl_seconds:
+                    raise FileNotFoundError(path)
+                with open(path, "rb") as f:
+                    session = CanvasSession.from_bytes(f.read())
+            except (OSError, ValueError):
+                yield None
+                return
+            yield session
+            self._save(session_id, session)
+
+    def delete(self, session_id) -> bool:
+        """
+        End a session, returning whether it existed.
+        """
+        path = self._path(session_id)
+        if path is None:
+            return False
+        with self._locked(session_id):
+            try:
+                os.remove(path)
+            except OSError:
+                return False
+        return True
+
+    def __len__(self):
+        return len(self._list_sessions())
+
+    def _path(self, session_id):
+        if not isinstance(session_id, str) or not re.fullmatch(r"[A-Za-z0-9_\-]{1,64}", session_id):
+            return None
+        return os.path.join(self.root_dir, f"{session_id}.npz")
+
+    @contextmanager
+    def _locked(self, session_id):
+        stripe = zlib.crc32(session_id.encode()) % self.num_lock_stripes
+        with open(os.path.join(self.root_dir, "locks", f"{stripe}.lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _save(self, session_id, session) -> None:
+        path = self._path(session_id)
+        # Write to a temporary file first so readers never see a partial session
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary_path, "wb") as f:
+            f.write(session.to_bytes())
+        os.replace(temporary_path, path)
+
+    def _list_sessions(self) -> list:
+        sessions = []
+        for filename in os.listdir(self.root_dir):
+            if not filename.endswith(".npz"):
+                continue
+            path = os.path.join(self.root_dir, filename)
+            try:
+                sessions.append((os.path.getmtime(path), path))
+            except OSError:
+                continue
+        return sorted(sessions)
+
+    def _expire(self) -> None:
+        sessions = self._list_sessions()
+        now = time.time()
+        for i, (modified, path) in enumerate(sessions):
+            # One slot is kept free for the session being created
+            if now - modified <= self.ttl_seconds and len(sessions) - i < self.max_sessions:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -31,6 +31,9 @@ document.addEventListener('DOMContentLoaded', () => {
     let drawingsCompleted = 0;
     let drawingsNeeded = 4;
     let imageSaveNames = [];
+    let sessionId = null; // Server-side canvas session, updated with stroke deltas
+    let pendingStrokes = []; // Strokes drawn since the last update was sent
+    let pendingClear = false;
 
     let matrix = Array.from({ length: gridSize }, () =>
     Array.from({ length: gridSize }, () =>
@@ -129,6 +132,7 @@ document.addEventListener('DOMContentLoaded', () => {
                     updateCell(r, c, colorValue);
                 }
             }
+            recordStrokePoint(row, col);
             strokesMade++;
             // If strokesMade is a multiple of predictionFreq, classify the image
             if (strokesMade % predictionFreq === 0)  {
@@ -137,6 +141,16 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    // Queue a brush stamp to send to the server, consecutive stamps with the same brush share a stroke
+    function recordStrokePoint(row, col) {
+        const lastStroke = pendingStrokes[pendingStrokes.length - 1];
+        if (lastStroke && lastStroke.color === currentColor && lastStroke.size === brushSize) {
+            lastStroke.points.push([row, col]);
+        } else {
+            pendingStrokes.push({ color: currentColor, size: brushSize, points: [[row, col]] });
+        }
+    }
+
     function updateCell(row, col, colorValue) {
         // Check boundaries
         if (row >= 0 && row < gridSize && col >= 0 && col < gridSize) {
@@ -215,7 +229,7 @@ document.addEventListener('DOMContentLoaded', () => {
         document.body.appendChild(popup);  
 
         const response = await saveMatrixAsImage(currentSubjectIndex);
-        imageSaveNames.push(response.filename);
+        imageSaveNames.push(response.url);
 
         return popup;
     }
@@ -276,6 +290,8 @@ document.addEventListener('DOMContentLoaded', () => {
             cell.style.backgroundColor = '#f0f0f0'; // Reset cells to white
         });
         strokesMade = 0;
+        pendingStrokes = [];
+        pendingClear = true;
         classifyImage();
         setTimeout(() => {
             updateChart({"Airplane":0, "Bicycle":0, "Butterfly":0, "Car":0, "Flower":0});
@@ -408,19 +424,83 @@ document.addEventListener('DOMContentLoaded', () => {
     });
 
 
-    // Send image to /predict enpoint
-    async function predictAndDisplayResults(imageData) {
-        const response = await fetch('/predict', {
+    // Send the raw PNG to /predict enpoint
+    async function predictAndDisplayResults(imageBlob) {
+        const subject = encodeURIComponent(sketchSubjects[currentSubjectIndex]);
+        const response = await fetch(`/predict?sketchsubject=${subject}`, {
             method: 'POST',
             headers: {
-                'Content-Type': 'application/json'
+                'Content-Type': 'image/png'
             },
-            body: JSON.stringify({
-                image: imageData,
-                sketchsubject: sketchSubjects[currentSubjectIndex] 
-            })
+            body: imageBlob
         });
         const data = await response.json();
+        displayPrediction(data);
+    }
+
+
+    // Start a server-side canvas session, falls back to sending whole PNGs when it is unavailable
+    async function startSession() {
+        try {
+            const response = await fetch('/session', { method: 'POST' });
+            sessionId = (await response.json()).session_id;
+        } catch (error) {
+            console.error('Error starting a drawing session:', error);
+            sessionId = null;
+        }
+    }
+    startSession();
+
+
+    // Every drawn cell of the matrix as strokes, used to rebuild an expired session
+    function matrixToStrokes() {
+        const strokesByColor = {};
+        for (let row = 0; row < gridSize; row++) {
+            for (let col = 0; col < gridSize; col++) {
+                const [r, g, b] = matrix[row][col];
+                if (r === 255 && g === 255 && b === 255) continue;
+                const color = `${r},${g},${b}`;
+                (strokesByColor[color] = strokesByColor[color] || []).push([row, col]);
+            }
+        }
+        return Object.entries(strokesByColor).map(([color, points]) => ({ color: color.split(',').map(Number), size: 1, points: points }));
+    }
+
+
+    // Send the strokes drawn since the last update, the server only re-runs the model once enough has changed
+    async function sendStrokes() {
+        const body = {
+            strokes: pendingStrokes,
+            clear: pendingClear,
+            sketchsubject: sketchSubjects[currentSubjectIndex]
+        };
+        pendingStrokes = [];
+        pendingClear = false;
+        let response = await fetch(`/session/${sessionId}/strokes`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify(body)
+        });
+        if (response.status === 404) {
+            // The session expired, start a new one from the full canvas
+            await startSession();
+            body.strokes = matrixToStrokes();
+            body.clear = false;
+            response = await fetch(`/session/${sessionId}/strokes`, {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify(body)
+            });
+        }
+        displayPrediction(await response.json());
+    }
+
+
+    function displayPrediction(data) {
         const topPredictionElement = document.getElementById('topPrediction');
         const topPredictionClassElement = document.getElementById('topPredictionClass');
         const correctPredictionElement = document.getElementById('correctPredictionClass');
@@ -455,6 +535,15 @@ document.addEventListener('DOMContentLoaded', () => {
 
     // Function to classify the image and display results
     async function classifyImage() {
+        if (sessionId) {
+            try {
+                await sendStrokes();
+                return;
+            } catch (error) {
+                console.error('Error in sending the strokes for classification:', error);
+                sessionId = null; // The server canvas may be out of sync, send whole PNGs from now on
+            }
+        }
         const canvas = document.createElement('canvas');
         const ctx = canvas.getContext('2d');
         canvas.width = gridSize;
@@ -469,12 +558,12 @@ document.addEventListener('DOMContentLoaded', () => {
             }
         }
     
-        // Convert the canvas to a Base64-encoded image
-        const imageData = canvas.toDataURL('image/png').replace(/^data:image\/(png|jpg);base64,/, '');
+        // Convert the canvas to a PNG blob, sent as is without base64 encoding
+        const imageBlob = await new Promise(resolve => canvas.toBlob(resolve, 'image/png'));
     
         // Send this image data to Flask `/predict` endpoint
         try {
-            await predictAndDisplayResults(imageData);      
+            await predictAndDisplayResults(imageBlob);      
         } catch (error) {
             console.error('Error in sending the image for classification:', error);
         }
@@ -523,7 +612,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
         // Save the last image
         const response = await saveMatrixAsImage(currentSubjectIndex);
-        imageSaveNames.push(response.filename);
+        imageSaveNames.push(response.url);
 
         // Create overlay
         const overlay = document.createElement('div');
@@ -555,13 +644,13 @@ document.addEventListener('DOMContentLoaded', () => {
         imagesContainer.className = 'final-images-container';
 
         // Array of image names 
-        imageSaveNames.forEach(name => {
+        imageSaveNames.forEach(url => {
             const img = document.createElement('img');
             const imgSubContainer = document.createElement('div');
             imgSubContainer.className = 'final-image-sub-container';
             img.className = 'final-image';
-            img.src = `./static/images/${name}`;
-            img.id = `./static/images/${name}`;
+            img.src = url;
+            img.id = url;
 
             img.addEventListener('click', () => {
                 fetchInsight(img.id);
@@ -593,6 +682,34 @@ document.addEventListener('DOMContentLoaded', () => {
         document.body.appendChild(overlay);
     }
 
+    // Wait for a background job submitted by the server, returns its result
+    async function waitForJob(response) {
+        const job = await response.json();
+        if (job.status === 'done') {
+            return job.result;
+        }
+        if (!response.ok && response.status !== 202) {
+            throw new Error(job.error);
+        }
+        return new Promise((resolve, reject) => {
+            const source = new EventSource(`${job.status_url}/stream`);
+            source.onmessage = (event) => {
+                const update = JSON.parse(event.data);
+                if (update.status === 'done') {
+                    source.close();
+                    resolve(update.result);
+                } else if (update.status === 'failed') {
+                    source.close();
+                    reject(new Error(update.error));
+                }
+            };
+            source.onerror = () => {
+                source.close();
+                reject(new Error('Lost the connection while waiting for the job'));
+            };
+        });
+    }
+
     async function fetchInsight(imagePath) {
         // Create insight overlay before fetching data
         const insightOverlay = document.createElement('div');
@@ -617,7 +734,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 num_plots: 32
             })
         });
-        const data = await response.json();
+        const data = await waitForJob(response);
         const filepaths = data.filepaths;
         console.log(filepaths);
         
@@ -632,7 +749,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 k: 4
             })
         });
-        const data2 = await response2.json();
+        const data2 = await waitForJob(response2);
         const featureMapFilepath = data2.filepath;
         console.log(featureMapFilepath);
 
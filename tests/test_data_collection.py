@@ -0,0 +1,133 @@
+import io
+import os
+import sys
+import time
+import base64
+import tarfile
+import pytest
+
+os.environ.setdefault("STORAGE_BACKEND", "local")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "data-collection-app"))
+from scripts.ingest import ShardWriter, LocalBackend, PNG_SIGNATURE, read_shard_drawings
+import app as data_collection_app
+
+DRAWING = PNG_SIGNATURE + b"drawing"
+
+
+class FlakyBackend:
+    """
+    Records the uploaded objects, failing the first num_failures uploads.
+    """
+    def __init__(self, num_failures=0):
+        self.num_failures = num_failures
+        self.objects = {}
+
+    def put(self, key, data, content_type):
+        if self.num_failures > 0:
+            self.num_failures -= 1
+            raise ConnectionError("Backend unavailable")
+        self.objects[key] = data
+
+
+def shard_members(data):
+    with tarfile.open(fileobj=io.BytesIO(data), mode="r:") as archive:
+        return {member.name: archive.extractfile(member).read() for member in archive}
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Timed out"
+        time.sleep(0.01)
+
+
+def test_shard_writer_flush(tmp_path):
+    """
+    Verify that flushed drawings are uploaded in one tar shard under unique names, and removed from the spool.
+    """
+    writer = ShardWriter(LocalBackend(str(tmp_path / "storage")), spool_dir=str(tmp_path / "spool"))
+    names = writer.add_many([("Car", DRAWING), ("Car", DRAWING), ("Tree", DRAWING)])
+    writer.flush()
+    writer.close()
+    assert len(set(names)) == 3
+    shards = os.listdir(tmp_path / "storage" / "shards")
+    assert len(shards) == 1
+    members = shard_members((tmp_path / "storage" / "shards" / shards[0]).read_bytes())
+    assert set(members) == {"Car/" + names[0], "Car/" + names[1], "Tree/" + names[2]}
+    assert all(data == DRAWING for data in members.values())
+    assert not [name for name in os.listdir(tmp_path / "spool") if name.endswith(".tar")]
+    assert writer.stats()["uploaded_drawings"] == 3
+
+
+def test_shard_writer_retries_failed_upload(tmp_path):
+    """
+    Verify that a shard whose upload failed is kept in the spool and uploaded by a later attempt.
+    """
+    backend = FlakyBackend(num_failures=2)
+    writer = ShardWriter(backend, spool_dir=str(tmp_path), max_age_seconds=0.05, max_retry_delay=0.05)
+    writer.add("Car", DRAWING)
+    writer.flush()
+    wait_for(lambda: writer.stats()["failed_uploads"] >= 1)
+    assert [name for name in os.listdir(tmp_path) if name.endswith(".tar")]
+    wait_for(lambda: backend.objects)
+    writer.close()
+    assert writer.stats()["failed_uploads"] == 2
+    assert writer.stats()["uploaded_drawings"] == 1
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tar")]
+
+
+def test_shard_writer_recovers_partial_shard(tmp_path):
+    """
+    Verify that the complete drawings of a shard cut short by a crash are uploaded by the next writer.
+    """
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode="w") as archive:
+        for name in ["Car/a.png", "Tree/b.png", "Car/c.png"]:
+            info = tarfile.TarInfo(name)
+            info.size = len(DRAWING)
+            archive.addfile(info, io.BytesIO(DRAWING))
+    # Keep the two complete members and the start of a third one, without the end of archive blocks
+    truncated = data.getvalue()[:2 * 1024 + 512 + 3]
+    (tmp_path / "20240101-000000_0000.tar.part").write_bytes(truncated)
+    backend = FlakyBackend()
+    writer = ShardWriter(backend, spool_dir=str(tmp_path))
+    writer.close()
+    assert len(backend.objects) == 1
+    assert shard_members(next(iter(backend.objects.values()))) == {"Car/a.png": DRAWING, "Tree/b.png": DRAWING}
+    assert not [name for name in os.listdir(tmp_path) if name.endswith((".tar", ".part"))]
+
+
+def test_shard_writer_spool_lock(tmp_path):
+    """
+    Verify that two writers cannot use the same spool directory at the same time.
+    """
+    writer = ShardWriter(FlakyBackend(), spool_dir=str(tmp_path))
+    with pytest.raises(RuntimeError):
+        ShardWriter(FlakyBackend(), spool_dir=str(tmp_path))
+    writer.close()
+    ShardWriter(FlakyBackend(), spool_dir=str(tmp_path)).close()
+
+
+def test_read_shard_drawings_missing_file(tmp_path):
+    """
+    Verify that reading a missing shard returns no drawings instead of raising.
+    """
+    assert read_shard_drawings(str(tmp_path / "missing.tar")) == []
+
+
+@pytest.mark.parametrize("body", [
+    {"drawings": []},
+    {"drawings": [{"sketchsubject": "Car", "image": "x"}] * (data_collection_app.MAX_DRAWINGS_PER_REQUEST + 1)},
+    {"drawings": [{"sketchsubject": "../Car", "image": base64.b64encode(DRAWING).decode()}]},
+    {"drawings": [{"sketchsubject": "Car", "image": base64.b64encode(b"GIF89a").decode()}]},
+    {"drawings": [{"sketchsubject": "Car", "image": "not base64!"}]},
+    {"drawings": [{"sketchsubject": "Car", "image": 42}]},
+    {"drawings": [{"sketchsubject": "Car"}]},
+    {"drawings": "Car"},
+])
+def test_upload_batch_rejects_invalid_drawings(body):
+    """
+    Verify that /upload_batch responds 400 to an invalid number of drawings, subject or image.
+    """
+    response = data_collection_app.app.test_client().post("/upload_batch", json=body)
+    assert response.status_code == 400
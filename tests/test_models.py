@@ -1,7 +1,17 @@
+import os
+import glob
+import json
+import pytest
+import numpy as np
 import torch
+from torchvision import models
+from src.model.data_processing import CustomImageFolderDataset, DecodedImageCache, BatchAugmentCollate, augment_batch
+from src.model.naive_model import ColorClassifier, get_dominant_color, get_dominant_colors
+from src.model.feature_cache import build_feature_store, feature_store_key, get_head
 from src.model.resnet18 import CustomResNet18
 from src.model.resnet50 import CustomResNet50
-from src.model.svm import create_svm_dataset, train_svm
+from src.model.svm import create_svm_dataset, train_svm, list_svm_images, train_svm_streaming, evaluate_streaming, load_images
+from src.model.packed_dataset import pack_dataset, unpack_shards
 
 
 def test_resnet18_model():
@@ -61,4 +71,164 @@ def test_svm_model():
     """
     X_train, X_test, y_train, y_test = create_svm_dataset(data_root_dir="./data", image_size=(128, 128))
     model = train_svm(X_train, y_train)
-    assert model is not None
\ No newline at end of file
+    assert model is not None
+
+
+def test_decoded_image_cache(tmp_path):
+    """
+    Verify that images served from the decoded image cache match the images decoded from the PNG files.
+    """
+    image_paths = sorted(glob.glob("data/Airplane/*.png"))[:4]
+    image_cache = DecodedImageCache(image_paths, str(tmp_path))
+    cached_dataset = CustomImageFolderDataset(image_paths, extra_transforms=False, image_cache=image_cache)
+    png_dataset = CustomImageFolderDataset(image_paths, extra_transforms=False)
+    for idx in range(len(image_paths)):
+        cached_images, cached_label = cached_dataset[idx]
+        png_images, png_label = png_dataset[idx]
+        assert cached_label == png_label
+        assert torch.equal(cached_images[0], png_images[0])
+    # A second cache over the same unchanged images reuses the cache file
+    assert DecodedImageCache(image_paths, str(tmp_path)).cache_path == image_cache.cache_path
+
+
+def test_feature_store(tmp_path):
+    """
+    Verify that the classifier applied to the cached backbone embeddings matches the full forward pass.
+    """
+    model = models.resnet18(weights=None, num_classes=10).eval()
+    image_paths = sorted(glob.glob("data/Car/*.png"))[:3]
+    dataset = CustomImageFolderDataset(image_paths, extra_transforms=True)
+    feature_store = build_feature_store(model, dataset, str(tmp_path), num_views=2, batch_size=4)
+    # 4 views on the first pass, then only the 2 random views on the second pass
+    assert len(feature_store) == 3 * 6
+    test_dataset = CustomImageFolderDataset(image_paths, extra_transforms=False)
+    features, labels = build_feature_store(model, test_dataset).tensors
+    images = torch.stack([test_dataset[idx][0][0] for idx in range(len(test_dataset))])
+    with torch.no_grad():
+        assert torch.allclose(get_head(model)(features), model(images), atol=1e-5)
+    # Stored embeddings are reused
+    assert torch.equal(build_feature_store(model, dataset, str(tmp_path), num_views=2).tensors[0], feature_store.tensors[0])
+    # Datasets with batched augmentation get the same views
+    batched_dataset = CustomImageFolderDataset(image_paths, extra_transforms=False, batched_augmentation=True)
+    assert torch.allclose(build_feature_store(model, batched_dataset).tensors[0], features, atol=1e-5)
+    assert len(build_feature_store(model, CustomImageFolderDataset(image_paths, batched_augmentation=True), num_views=2)) == 3 * 6
+    # A different backbone does not load them
+    other_model = models.resnet50(weights=None, num_classes=10).eval()
+    assert feature_store_key(other_model, dataset, 2) != feature_store_key(model, dataset, 2)
+
+
+def test_batched_augmentation():
+    """
+    Verify that batched augmentation is reproducible with a seed, keeps the dataloader layout,
+    and fills the area outside the warped image with white.
+    """
+    image_paths = sorted(glob.glob("data/Tree/*.png"))[:4]
+    dataset = CustomImageFolderDataset(image_paths, batched_augmentation=True)
+    batch = [dataset[idx] for idx in range(len(dataset))]
+    images, labels = BatchAugmentCollate(seed=0)(batch)
+    repeat_images, _ = BatchAugmentCollate(seed=0)(batch)
+    assert images.shape == (16, 3, 128, 128)
+    assert labels.tolist() == [8] * 16
+    assert torch.equal(images, repeat_images)
+    white_images = torch.full((2, 3, 32, 32), 255, dtype=torch.uint8)
+    assert torch.equal(augment_batch(white_images), torch.ones(2, 4, 3, 32, 32))
+
+
+def test_dominant_colors():
+    """
+    Verify that the dominant color is the second most common color, and the only color of a blank image.
+    """
+    drawing = np.full((8, 8, 3), 255, dtype=np.uint8)
+    drawing[0, :3] = (255, 0, 0)
+    drawing[1, :2] = (0, 0, 255)
+    blank = np.full((8, 8, 3), 255, dtype=np.uint8)
+    assert get_dominant_color(drawing) == (255, 0, 0)
+    assert get_dominant_colors(np.stack([drawing, blank])).tolist() == [[255, 0, 0], [255, 255, 255]]
+    # Two shades of red only outnumber the blue pixels once they are quantized together
+    shaded = blank.copy()
+    shaded[0, :2] = (255, 0, 0)
+    shaded[1, :2] = (250, 0, 0)
+    shaded[2, :3] = (0, 0, 255)
+    assert get_dominant_color(shaded) == (0, 0, 255)
+    assert get_dominant_color(shaded, quantize_bits=4) == (240, 0, 0)
+
+
+def test_color_classifier(tmp_path):
+    """
+    Verify that the color classifier predicts the labels of the closest class color and rejects invalid color maps.
+    """
+    colormap_path = tmp_path / "colormap.json"
+    colormap_path.write_text(json.dumps({"(0, 0, 255)": [9], "(255, 0, 0)": [4, 6]}))
+    classifier = ColorClassifier(str(colormap_path), seed=0)
+    labels = classifier.predict_batch(dominant_colors=[[10, 0, 240], [250, 5, 0], [240, 0, 20]])
+    assert labels[0] == 9
+    assert labels[1] in (4, 6) and labels[2] in (4, 6)
+    drawing = np.full((8, 8, 3), 255, dtype=np.uint8)
+    drawing[0, :3] = (0, 0, 255)
+    assert classifier.predict_batch(np.stack([drawing])).tolist() == [9]
+    colormap_path.write_text(json.dumps({"(0, 0)": [9]}))
+    with pytest.raises(ValueError):
+        ColorClassifier(str(colormap_path))
+
+
+def test_svm_streaming():
+    """
+    Verify that the SVM can be trained out-of-core on chunks of reduced features.
+    """
+    image_paths, labels = list_svm_images(data_root_dir="data")
+    model = train_svm_streaming(image_paths[::4], labels[::4], image_size=(32, 32), chunk_size=64, reduction="pca", n_components=32, epochs=2)
+    accuracy = evaluate_streaming(model, image_paths[1::4], labels[1::4], image_size=(32, 32), chunk_size=64)
+    assert 0 <= accuracy <= 1
+    assert model.named_steps["reduction"].n_components_ == 32
+
+
+def test_packed_dataset(tmp_path):
+    """
+    Verify that images read from a packed dataset match the images read from the PNG files.
+    """
+    packed_dataset = pack_dataset("data", str(tmp_path), shard_size=2**16, seed=0)
+    image_paths = [os.path.join("data", path) for path in packed_dataset.paths]
+    assert len(packed_dataset) == len(image_paths) == len(glob.glob("data/*/*.png"))
+    assert len(packed_dataset.shard_names) > 1
+    assert packed_dataset.shuffled and not pack_dataset("data", str(tmp_path / "unshuffled")).shuffled
+    # The SVM labels are the same for the packed and the unpacked images
+    svm_paths, svm_labels = list_svm_images("data")
+    svm_label_of = dict(zip(svm_paths, svm_labels))
+    assert [svm_label_of[path] for path in image_paths] == packed_dataset.labels.tolist()
+    indices = [0, 1, len(packed_dataset) - 1]
+    packed = CustomImageFolderDataset(indices, extra_transforms=False, packed_dataset=packed_dataset)
+    png = CustomImageFolderDataset([image_paths[i] for i in indices], extra_transforms=False)
+    for idx in range(len(indices)):
+        packed_images, packed_label = packed[idx]
+        png_images, png_label = png[idx]
+        assert packed_label == png_label
+        assert torch.equal(packed_images[0], png_images[0])
+    X_packed = load_images(indices, (32, 32), num_workers=1, packed_dataset=packed_dataset)
+    X_png = load_images([image_paths[i] for i in indices], (32, 32), num_workers=1)
+    assert np.array_equal(X_packed, X_png)
+    # The process pool workers open the dataset themselves and read the same images
+    all_indices = np.arange(len(packed_dataset))
+    X_pool = load_images(all_indices, (32, 32), num_workers=2, chunk_size=64, packed_dataset=packed_dataset)
+    assert np.array_equal(X_pool, load_images(all_indices, (32, 32), num_workers=1, packed_dataset=packed_dataset))
+
+
+def test_unpack_shards(tmp_path):
+    """
+    Verify that unpack_shards extracts the drawings of the uploaded shards into the class folders,
+    skipping the drawings already unpacked and members outside "<class>/<name>.png".
+    """
+    import io
+    import tarfile
+    shard_dir = tmp_path / "shards"
+    shard_dir.mkdir()
+    with tarfile.open(shard_dir / "20240101-000000_0000.tar", "w") as archive:
+        for name in ["Car/Car_1_a.png", "Tree/Tree_2_b.png", "../evil.png", "Car/../../evil.png", "Car/notes.txt"]:
+            info = tarfile.TarInfo(name)
+            info.size = 3
+            archive.addfile(info, io.BytesIO(b"png"))
+    data_dir = tmp_path / "data"
+    assert unpack_shards(str(shard_dir), str(data_dir)) == 2
+    assert sorted(os.listdir(data_dir)) == ["Car", "Tree"]
+    assert (data_dir / "Car" / "Car_1_a.png").read_bytes() == b"png"
+    assert not (tmp_path / "evil.png").exists()
+    assert unpack_shards(str(shard_dir), str(data_dir)) == 0
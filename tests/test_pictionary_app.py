@@ -0,0 +1,247 @@
+import os
+import threading
+import importlib.util
+import pytest
+import numpy as np
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(__file__), "..", "src", "pictionary-app", "scripts")
+
+
+def load_script(name):
+    """
+    Import a module of the pictionary app's scripts folder by its path, as the data collection app
+    also has a scripts folder.
+    """
+    spec = importlib.util.spec_from_file_location(f"pictionary_{name}", os.path.join(SCRIPTS_DIR, f"{name}.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+stroke_sessions = load_script("stroke_sessions")
+jobs = load_script("jobs")
+artifact_store = load_script("artifact_store")
+inference_queue = load_script("inference_queue")
+
+
+def test_disk_stroke_sessions_shared(tmp_path):
+    """
+    Verify that a session created through one DiskStrokeSessionStore is updated and deleted through another
+    one on the same directory, as by two server workers.
+    """
+    worker_1 = stroke_sessions.DiskStrokeSessionStore(str(tmp_path))
+    worker_2 = stroke_sessions.DiskStrokeSessionStore(str(tmp_path))
+    session_id = worker_1.create()
+    with worker_2.session(session_id) as session:
+        session.apply_strokes([{"points": [[0, 0], [1, 1]], "color": "#000000"}])
+        session.set_result(("Car", {"Car": 1.0}))
+    with worker_1.session(session_id) as session:
+        assert session.pixels[1, 1].tolist() == [0, 0, 0]
+        assert session.result == ("Car", {"Car": 1.0})
+        assert not session.dirty.any()
+    assert worker_1.delete(session_id)
+    with worker_2.session(session_id) as session:
+        assert session is None
+    with worker_2.session("../../etc/passwd") as session:
+        assert session is None
+
+
+def test_disk_stroke_sessions_limit(tmp_path):
+    """
+    Verify that the least recently used sessions are deleted beyond max_sessions.
+    """
+    store = stroke_sessions.DiskStrokeSessionStore(str(tmp_path), max_sessions=2)
+    session_ids = [store.create() for _ in range(3)]
+    os.utime(tmp_path / f"{session_ids[1]}.npz", (0, 0))
+    store.create()
+    assert len(store) == 2
+    with store.session(session_ids[1]) as session:
+        assert session is None
+    with store.session(session_ids[2]) as session:
+        assert np.all(session.pixels == 255)
+
+
+def test_canvas_session_apply_strokes():
+    """
+    Verify that strokes are painted with a square brush centered on each point and clipped to the canvas,
+    and that the changed pixels are counted until the next inference.
+    """
+    session = stroke_sessions.CanvasSession((8, 8))
+    changed_pixels = session.apply_strokes([{"points": [[0, 0], [4, 4]], "color": [255, 0, 0], "size": 3}])
+    assert changed_pixels == 4 + 9
+    assert session.pixels[5, 5].tolist() == [255, 0, 0]
+    assert session.pixels[6, 6].tolist() == [255, 255, 255]
+    session.set_result(("Car", {"Car": 1.0}))
+    assert session.apply_strokes([{"points": [[4, 4]], "color": "#ff0000"}]) == 0
+    assert not session.needs_inference()
+    assert session.apply_strokes([{"points": [[7, 7]], "color": "#000"}]) == 1
+    assert session.needs_inference()
+    assert not session.needs_inference(min_changed_pixels=2)
+
+
+@pytest.mark.parametrize("strokes", [
+    [{"points": [[0, 0]] * 65, "color": "#000000"}],
+    [{"points": [[0, 0]] * 8, "color": "#000000", "size": 5}],
+    [{"points": [[0, 0]], "color": "#000000"}, {"points": [[1, 1]], "color": "#00000g"}],
+    [{"points": [[0, 0]], "color": "#000000"}, {"points": [[1, 1, 1]], "color": "#000000"}],
+    [{"points": [[0, 0]], "color": "#000000"}, {"color": "#000000"}],
+])
+def test_canvas_session_rejects_invalid_strokes(strokes):
+    """
+    Verify that too many points or brush cells, and malformed strokes, raise without changing the canvas.
+    """
+    session = stroke_sessions.CanvasSession((8, 8))
+    with pytest.raises((KeyError, ValueError)):
+        session.apply_strokes(strokes, max_points=64, max_cells=128)
+    assert np.all(session.pixels == 255)
+    assert not session.dirty.any()
+
+
+def test_job_queue_deduplicates():
+    """
+    Verify that submitting a job with the id of a queued, running or finished job returns that job instead of running it again.
+    """
+    queue = jobs.JobQueue()
+    release = threading.Event()
+    calls = []
+
+    def run(value):
+        calls.append(value)
+        release.wait(5)
+        return value
+
+    job_id = jobs.job_id_for("square", {"size": 3}, b"drawing")
+    assert job_id == jobs.job_id_for("square", {"size": 3}, b"drawing")
+    assert job_id != jobs.job_id_for("square", {"size": 4}, b"drawing")
+    job = queue.submit(job_id, "square", run, 1)
+    assert queue.submit(job_id, "square", run, 2) is job
+    release.set()
+    assert queue.wait(job_id, timeout=5).result == 1
+    assert queue.submit(job_id, "square", run, 3) is job
+    assert calls == [1]
+
+
+def test_job_queue_reruns_failed_job():
+    """
+    Verify that a failed job reports its error, and is run again when submitted again.
+    """
+    queue = jobs.JobQueue()
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RuntimeError("Out of memory")
+        return "plot.png"
+
+    job = queue.wait(queue.submit("job", "plot", flaky).job_id, timeout=5)
+    assert job.status == "failed" and "Out of memory" in job.error
+    job = queue.wait(queue.submit("job", "plot", flaky).job_id, timeout=5)
+    assert job.status == "done" and job.result == "plot.png"
+
+
+def test_job_queue_full():
+    """
+    Verify that submissions beyond max_pending raise QueueFullError, and are accepted again once a job finished.
+    """
+    queue = jobs.JobQueue(max_pending=1)
+    release = threading.Event()
+    queue.submit("slow", "plot", release.wait, 5)
+    with pytest.raises(jobs.QueueFullError):
+        queue.submit("other", "plot", lambda: None)
+    release.set()
+    queue.wait("slow", timeout=5)
+    assert queue.wait(queue.submit("other", "plot", lambda: "ok").job_id, timeout=5).result == "ok"
+
+
+def test_job_queue_shared_status(tmp_path):
+    """
+    Verify that a job run by one process is reported, awaited and reused by another one sharing the status store.
+    """
+    worker_1 = jobs.JobQueue(status_store=artifact_store.DiskArtifactStore(str(tmp_path)))
+    worker_2 = jobs.JobQueue(status_store=artifact_store.DiskArtifactStore(str(tmp_path)), poll_interval=0.01)
+    release = threading.Event()
+    worker_1.submit("job", "plot", lambda: release.wait(5) and "plot.png")
+    assert worker_2.get("job").status in ("queued", "running")
+    assert worker_2.wait("job", timeout=0.05).status in ("queued", "running")
+    release.set()
+    assert worker_2.wait("job", timeout=5).result == "plot.png"
+    assert worker_2.submit("job", "plot", lambda: "rerun").result == "plot.png"
+    assert worker_2.get("missing") is None
+
+
+class GatedModel:
+    """
+    Sums each image, recording the batch sizes. The first batch waits until the gate is opened.
+    """
+    def __init__(self):
+        self.batch_sizes = []
+        self.started = threading.Event()
+        self.gate = threading.Event()
+
+    def __call__(self, images):
+        self.batch_sizes.append(len(images))
+        self.started.set()
+        self.gate.wait(5)
+        if np.isnan(images).any():
+            raise ValueError("Invalid image")
+        return images.reshape(len(images), -1).sum(axis=1, keepdims=True)
+
+
+def predict_concurrently(predictor, images):
+    results = [None] * len(images)
+
+    def predict(i):
+        try:
+            results[i] = predictor.predict(images[i], timeout=5)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=predict, args=(i,)) for i in range(len(images))]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def test_batching_predictor_coalesces_requests():
+    """
+    Verify that requests queued while the model is busy are scored in one batch, each caller getting its own row.
+    """
+    model = GatedModel()
+    predictor = inference_queue.BatchingPredictor(model, max_batch_size=7, max_wait_ms=1000)
+    first, _ = predict_concurrently(predictor, [np.zeros((1, 1, 2, 2), dtype=np.float32)])
+    assert model.started.wait(5)
+    images = [np.full((1, 1, 2, 2), i, dtype=np.float32) for i in range(7)]
+    threads, results = predict_concurrently(predictor, images)
+    model.gate.set()
+    for thread in first + threads:
+        thread.join(5)
+    assert model.batch_sizes == [1, 7]
+    assert [result.tolist() for result in results] == [[[4.0 * i]] for i in range(7)]
+    assert predictor.stats()["batch_sizes"] == {1: 1, 7: 1}
+    assert predictor.wait_idle(timeout=5)
+
+
+def test_batching_predictor_errors():
+    """
+    Verify that a failed batch raises in every caller, and that the predictor keeps serving requests afterwards.
+    """
+    model = GatedModel()
+    predictor = inference_queue.BatchingPredictor(model, max_batch_size=3, max_wait_ms=1000)
+    first, _ = predict_concurrently(predictor, [np.zeros((1, 1, 2, 2), dtype=np.float32)])
+    assert model.started.wait(5)
+    images = [np.zeros((1, 1, 2, 2), dtype=np.float32), np.full((1, 1, 2, 2), np.nan, dtype=np.float32),
+              np.zeros((1, 1, 2, 2), dtype=np.float32)]
+    threads, results = predict_concurrently(predictor, images)
+    model.gate.set()
+    for thread in first + threads:
+        thread.join(5)
+    assert all(isinstance(result, ValueError) for result in results)
+    # Images of different sizes cannot be batched, which also fails the batch instead of the thread
+    threads, results = predict_concurrently(predictor, [np.zeros((1, 1, 2, 2), dtype=np.float32),
+                                                        np.zeros((1, 1, 3, 3), dtype=np.float32)])
+    for thread in threads:
+        thread.join(5)
+    assert all(isinstance(result, Exception) for result in results)
+    assert predictor.predict(np.ones((1, 1, 2, 2), dtype=np.float32), timeout=5).tolist() == [[4.0]]
+    assert predictor.wait_idle(timeout=5)